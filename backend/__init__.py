@@ -1 +1,5 @@
 # Backend package
+from dotenv import load_dotenv
+
+# Загрузить переменные окружения до импорта модулей пакета: их настройки читаются при импорте
+load_dotenv()
@@ -1,15 +1,25 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
 from pathlib import Path
 import os
-from dotenv import load_dotenv
-
-# Загрузить переменные окружения
-load_dotenv()
+import asyncio
+import logging
 
+# Переменные окружения загружает пакет backend (backend/__init__.py) до импорта модулей
 from backend.database import init_db
 from backend.routes import auth, tasks, admin
+from backend.services.claude_service import close_async_client
+from backend.services.pricelist_store import get_pricelist_store
+from backend.services.uploads import UPLOAD_MAX_BATCH_MB, UPLOAD_MAX_REQUEST_MB, UploadTooLarge
+from backend.worker import Worker
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+# Запускать воркер очереди в процессе API (выключается, если воркеры запущены отдельно)
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() in ("1", "true", "yes")
 
 app = FastAPI(
     title="Smeta AI",
@@ -33,9 +43,89 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class UploadSizeLimitMiddleware:
+    """Ограничение размера тела POST-запроса
+
+    Заголовок Content-Length проверяется сразу, а тело считается по мере чтения:
+    при chunked-загрузке без заголовка Starlette иначе принял бы весь multipart
+    на диск, прежде чем маршрут увидит размер.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        limit_mb = UPLOAD_MAX_BATCH_MB if scope["path"] == "/api/tasks/batch" else UPLOAD_MAX_REQUEST_MB
+        limit = limit_mb * 1024 * 1024
+        too_large = JSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={"detail": f"Размер загрузки превышает {limit_mb} МБ"}
+        )
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            # Слишком большую загрузку отклоняем по заголовку, не принимая тело запроса
+            await too_large(scope, receive, send)
+            return
+
+        state = {"received": 0, "exceeded": False, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > limit and not state["started"]:
+                    state["exceeded"] = True
+                    raise UploadTooLarge(f"Размер загрузки превышает {limit_mb} МБ")
+            return message
+
+        async def guarded_send(message):
+            # Ответ маршрута на оборванное чтение (FastAPI превращает ошибку в 400) заменяется на 413
+            if state["exceeded"]:
+                return
+            state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not state["exceeded"]:
+                raise
+        if state["exceeded"]:
+            await too_large(scope, receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
 # Инициализация базы данных
 init_db()
 
+@app.on_event("startup")
+async def startup():
+    # Загрузить прайс-листы заранее, чтобы первая Смета не ждала чтения файлов
+    store = get_pricelist_store()
+    for kind in ("works", "materials"):
+        try:
+            await asyncio.to_thread(store.get, kind)
+        except Exception as e:
+            logging.getLogger(__name__).warning("Прайс-лист %s не загружен: %s", kind, e)
+
+    if EMBEDDED_WORKER:
+        app.state.worker = Worker()
+        app.state.worker_task = asyncio.create_task(app.state.worker.run())
+
+@app.on_event("shutdown")
+async def shutdown():
+    worker = getattr(app.state, "worker", None)
+    if worker is not None:
+        worker.stop()
+        await app.state.worker_task
+    await close_async_client()
+
 # Подключение маршрутов
 app.include_router(auth.router, prefix="/api/auth", tags=["auth"])
 app.include_router(tasks.router, prefix="/api/tasks", tags=["tasks"])
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Float, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from backend.database import Base
@@ -11,12 +11,18 @@ class Request(Base):
     input_type = Column(String(100))  # ТЗ, ТЗ+Проект и т.д.
     uploaded_files = Column(JSON)  # [{name, size, format}]
     requested_outputs = Column(JSON)  # ["estimate", "list", "comparison"]
-    status = Column(String(20), default="pending")  # pending, success, error
+    status = Column(String(20), default="pending")  # pending, processing, success, error, cancelled
     claude_prompt = Column(Text, nullable=True)
     claude_response = Column(Text, nullable=True)
     output_files = Column(JSON, nullable=True)  # [{name, path, type}]
     error_message = Column(Text, nullable=True)
     user_comment = Column(Text, nullable=True)
+    progress = Column(JSON, nullable=True)  # {stage, items} — позиции, полученные из потока Claude
+    stage_timings = Column(JSON, nullable=True)  # {stage: {start, duration}} — секунды от начала обработки
+    fingerprint = Column(String(64), nullable=True, index=True)  # отпечаток содержимого запроса для склейки повторов
+    duplicate_of = Column(Integer, ForeignKey("requests.id"), nullable=True, index=True)  # запрос, чьи результаты переиспользуются
+    batch_id = Column(Integer, ForeignKey("batches.id"), nullable=True, index=True)  # пакет, в составе которого отправлен запрос
+    label = Column(String(255), nullable=True)  # название объекта в пакете
 
     # Отношения
     output_files_rel = relationship("OutputFile", back_populates="request")
@@ -34,3 +40,108 @@ class OutputFile(Base):
 
     # Отношения
     request = relationship("Request", back_populates="output_files_rel")
+
+
+class Batch(Base):
+    __tablename__ = "batches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    input_type = Column(String(100))
+    requested_outputs = Column(JSON)
+    max_concurrency = Column(Integer, default=2)  # сколько запросов пакета обрабатывается одновременно
+    requests_count = Column(Integer, default=0)
+    archive_path = Column(String(500), nullable=True)  # общий архив результатов
+
+
+class StageCheckpoint(Base):
+    __tablename__ = "stage_checkpoints"
+    __table_args__ = (
+        Index("ix_stage_checkpoints_request_stage", "request_id", "stage", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    request_id = Column(Integer, ForeignKey("requests.id"))
+    stage = Column(String(50))  # parse, list_llm, estimate_llm, ...
+    result = Column(JSON)  # результат этапа — с него продолжается обработка после ошибки
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    request_id = Column(Integer, ForeignKey("requests.id"), index=True)
+    batch_id = Column(Integer, ForeignKey("batches.id"), nullable=True, index=True)
+    status = Column(String(20), default="queued", index=True)  # queued, running, done, failed, cancelled
+    payload = Column(JSON)  # аргументы обработки: файлы, результаты, комментарий
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    worker_id = Column(String(100), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True, index=True)  # до какого времени задача закреплена за воркером
+    heartbeat_at = Column(DateTime, nullable=True)
+    error_message = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True)  # sha256(model + max_tokens + prompt)
+    model = Column(String(100))
+    response = Column(Text)
+    size = Column(Integer, default=0)  # длина ответа в символах
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class ClaudeRateWindow(Base):
+    __tablename__ = "claude_rate_windows"
+
+    window_start = Column(DateTime, primary_key=True)  # начало минуты (UTC)
+    requests = Column(Integer, default=0)
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+
+
+class PricelistVersion(Base):
+    __tablename__ = "pricelist_versions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(20), index=True)  # works, materials
+    version = Column(Integer)  # порядковый номер версии в рамках вида прайса
+    file_name = Column(String(255))
+    price_columns = Column(JSON)  # заголовки колонок с ценами
+    rows_count = Column(Integer, default=0)
+    status = Column(String(20), default="importing")  # importing, ready, error
+    is_active = Column(Boolean, default=False, index=True)
+    error_message = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    activated_at = Column(DateTime, nullable=True)
+
+    # Отношения
+    items = relationship("PricelistItem", back_populates="version_rel", cascade="all, delete-orphan", passive_deletes=True)
+
+
+class PricelistItem(Base):
+    __tablename__ = "pricelist_items"
+    __table_args__ = (
+        Index("ix_pricelist_items_version_name", "version_id", "name_normalized"),
+        Index("ix_pricelist_items_version_unit", "version_id", "unit_normalized"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    version_id = Column(Integer, ForeignKey("pricelist_versions.id", ondelete="CASCADE"), index=True)
+    row_num = Column(Integer)  # порядок строки в исходном файле
+    name = Column(Text)
+    name_normalized = Column(Text)
+    unit = Column(String(50))
+    unit_normalized = Column(String(50))
+    prices = Column(JSON)  # {колонка прайса: цена}
+    price = Column(Float, nullable=True)  # самая низкая цена
+
+    # Отношения
+    version_rel = relationship("PricelistVersion", back_populates="items")
@@ -1,9 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from backend.database import get_db
-from backend.models import Request, OutputFile
+from backend.models import Request, OutputFile, PricelistItem, PricelistVersion
 from backend.auth import get_current_admin
+from backend.services.parse_cache import get_parse_cache
+from backend.services.job_queue import queue_stats
+from backend.services.pricelist_store import PRICELIST_FILES, get_pricelist_store, normalize_name
+from backend.services.units import normalize_unit
+from backend.services.pricelist_import import (
+    ALLOWED_EXTENSIONS, activate_version, import_pricelist, list_versions
+)
 
 router = APIRouter()
 
@@ -85,7 +93,8 @@ async def get_request_detail(
         "claude_response": request.claude_response,
         "output_files": request.output_files,
         "error_message": request.error_message,
-        "user_comment": request.user_comment
+        "user_comment": request.user_comment,
+        "stage_timings": request.stage_timings
     }
 
 @router.get("/export-csv")
@@ -155,5 +164,123 @@ async def get_stats(
         "successful": successful,
         "failed": failed,
         "success_rate": round(100 * successful / total_requests, 2) if total_requests > 0 else 0,
-        "input_types_distribution": type_counts
+        "input_types_distribution": type_counts,
+        "parse_cache": _parse_cache_stats(),
+        "queue": queue_stats(db)
+    }
+
+@router.get("/parse-cache")
+async def get_parse_cache_stats(
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Получить статистику кэша парсинга загруженных файлов"""
+    
+    return _parse_cache_stats()
+
+def _parse_cache_stats():
+    cache = get_parse_cache()
+    if cache is None:
+        return {"enabled": False}
+    return cache.stats()
+
+
+@router.get("/pricelists")
+async def get_pricelists(
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Получить версии прайс-листов"""
+    
+    return {"versions": await asyncio.to_thread(list_versions)}
+
+@router.post("/pricelists/{kind}/upload")
+async def upload_pricelist(
+    kind: str,
+    file: UploadFile = File(...),
+    activate: bool = Query(True),
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Загрузить новую версию прайс-листа (Excel или CSV)"""
+    
+    if kind not in PRICELIST_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Неизвестный прайс-лист: {kind}"
+        )
+    if not file.filename.lower().endswith(ALLOWED_EXTENSIONS):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Поддерживаются только файлы .xlsx и .csv"
+        )
+    
+    try:
+        # Импорт читает загруженный файл потоково, в отдельном потоке
+        version = await asyncio.to_thread(import_pricelist, kind, file.file, file.filename, activate)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    # Этот процесс перечитает прайс сразу, остальные воркеры — при очередной проверке версии
+    get_pricelist_store().invalidate(kind)
+    return version
+
+@router.post("/pricelists/versions/{version_id}/activate")
+async def activate_pricelist_version(
+    version_id: int,
+    current_admin: dict = Depends(get_current_admin)
+):
+    """Сделать версию прайс-листа активной (откат)"""
+    
+    try:
+        version = await asyncio.to_thread(activate_version, version_id)
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    get_pricelist_store().invalidate(version["kind"])
+    return version
+
+@router.get("/pricelists/{kind}/search")
+async def search_pricelist(
+    kind: str,
+    q: str = Query(...),
+    unit: str = Query(None),
+    limit: int = Query(50),
+    current_admin: dict = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """Найти позиции активной версии прайса по наименованию (начало нормализованного наименования)"""
+    
+    prefix = normalize_name(q)
+    if not prefix:
+        # Запрос из одних знаков препинания ("%") нашёл бы все строки прайса
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="В запросе нет букв или цифр"
+        )
+    
+    version = db.query(PricelistVersion).filter(
+        PricelistVersion.kind == kind, PricelistVersion.is_active.is_(True)
+    ).first()
+    if not version:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Активная версия прайс-листа не найдена"
+        )
+    
+    # % и _ из запроса — обычные символы, а не шаблон LIKE
+    prefix = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    query = db.query(PricelistItem).filter(
+        PricelistItem.version_id == version.id,
+        PricelistItem.name_normalized.like(f"{prefix}%", escape="\\")
+    )
+    if unit:
+        query = query.filter(PricelistItem.unit_normalized == normalize_unit(unit))
+    items = query.order_by(PricelistItem.row_num).limit(limit).all()
+    
+    return {
+        "version": version.version,
+        "items": [
+            {"name": item.name, "unit": item.unit, "prices": item.prices, "price": item.price}
+            for item in items
+        ]
     }
@@ -1,165 +1,246 @@
 import os
-import tempfile
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, status, BackgroundTasks
-from fastapi.responses import FileResponse
+import asyncio
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, status
+from fastapi.responses import FileResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from datetime import datetime
 from pathlib import Path
 from typing import List, Optional
 import json
 
 from backend.database import get_db, SessionLocal
-from backend.models import Request, OutputFile
+from backend.models import Batch, Job, Request, OutputFile
 from backend.auth import get_current_user
-from backend.services.file_parser import FileParser
-from backend.services.claude_service import ClaudeService
-from backend.services.excel_builder import ExcelBuilder
-from backend.services.pdf_builder import PDFBuilder
+from backend.services.pipeline import RESULTS_DIR, parsed_files_available
+from backend.services.job_queue import cancel_jobs, detach_duplicates, enqueue_job
+from backend.services.checkpoints import checkpoint_stages, load_checkpoint
+from backend.services.events import publish, request_events
+from backend.services.coalesce import (
+    COALESCE_ENABLED, coalesce_progress, find_original, pricelist_tokens, submission_fingerprint
+)
+from backend.services.batches import (
+    BATCH_MAX_CONCURRENCY, FINISHED_STATUSES, batch_summary, build_batch_archive, parse_groups
+)
+from backend.worker import cancel_local
+from backend.services.uploads import (
+    UPLOAD_MAX_BATCH_MB, UPLOAD_MAX_FILE_MB, UPLOAD_MAX_REQUEST_MB, UploadTooLarge, release_uploads, store_upload,
+    unhold_uploads
+)
 
 router = APIRouter()
 
-RESULTS_DIR = Path("/data/results")
-RESULTS_DIR.mkdir(exist_ok=True)
+def _discard_uploads(stored: List[dict]):
+    """Снять удержание и удалить загрузки запроса, который не был поставлен в очередь"""
+    unhold_uploads(stored)
+    release_uploads(upload["path"] for upload in stored)
 
 
-def process_in_background(request_id: int, temp_files: dict, outputs: list, user_comment):
-    db = SessionLocal()
-    request_record = None
+async def _store_files(files: List[UploadFile], max_total_mb: int) -> List[dict]:
+    """Скопировать загрузки на диск блоками, без чтения целиком в память"""
+    stored = []
+    remaining = max_total_mb * 1024 * 1024
     try:
-        request_record = db.query(Request).filter(Request.id == request_id).first()
-
-        file_parser = FileParser()
-        parsed_files = {}
-        for file_name, file_path in temp_files.items():
-            try:
-                parsed_files[file_name] = file_parser.parse_file(file_path)
-            except Exception as e:
-                request_record.status = "error"
-                request_record.error_message = f"Ошибка файла {file_name}: {str(e)}"
-                db.commit()
-                return
-
-        claude_service = ClaudeService()
-        output_files = {}
-        list_data = None
-        estimate_data = None
-
-        if "list" in outputs or "estimate" in outputs or "comparison" in outputs:
-            try:
-                prompt = claude_service.create_list_prompt(parsed_files, user_comment)
-                request_record.claude_prompt = prompt[:5000]
-                db.commit()
-                response = claude_service.call_claude(prompt, max_tokens=8000)
-                request_record.claude_response = response[:5000]
-                list_data = claude_service.parse_json_response(response)
-
-                if "list" in outputs:
-                    excel_builder = ExcelBuilder()
-                    list_bytes = excel_builder.create_list_workbook(list_data)
-                    list_filename = f"Перечень_работ_и_материалов_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
-                    list_path = RESULTS_DIR / list_filename
-                    list_path.write_bytes(list_bytes)
-                    output_files["list"] = {"name": list_filename, "path": str(list_path), "type": "excel_list"}
-                    db.add(OutputFile(request_id=request_id, file_name=list_filename, file_path=str(list_path), file_type="excel_list"))
-                    db.commit()
-            except Exception as e:
-                request_record.status = "error"
-                request_record.error_message = f"Ошибка Перечня: {str(e)}"
-                db.commit()
-                return
-
-        if "estimate" in outputs:
-            try:
-                pricelist_works = _read_pricelist("pricelists/price_works.xlsx")
-                pricelist_materials = _read_pricelist("pricelists/price_materials.xlsx")
-                prompt = claude_service.create_estimate_prompt(list_data, pricelist_works, pricelist_materials)
-                response = claude_service.call_claude(prompt, max_tokens=8000)
-                estimate_data = claude_service.parse_json_response(response)
-
-                excel_builder = ExcelBuilder()
-                estimate_bytes = excel_builder.create_estimate_workbook(estimate_data)
-                estimate_filename = f"Смета_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
-                estimate_path = RESULTS_DIR / estimate_filename
-                estimate_path.write_bytes(estimate_bytes)
-                output_files["estimate"] = {"name": estimate_filename, "path": str(estimate_path), "type": "excel_estimate"}
-                db.add(OutputFile(request_id=request_id, file_name=estimate_filename, file_path=str(estimate_path), file_type="excel_estimate"))
-                db.commit()
-            except Exception as e:
-                request_record.status = "error"
-                request_record.error_message = f"Ошибка Сметы: {str(e)}"
-                db.commit()
-                return
-
-        if "comparison" in outputs:
-            try:
-                project_content = "\n".join([str(v) for v in parsed_files.values()])
-                estimate_content = json.dumps(estimate_data or list_data, ensure_ascii=False)
-                prompt = claude_service.create_comparison_prompt(project_content, estimate_content)
-                response = claude_service.call_claude(prompt, max_tokens=4000)
-                comparison_data = claude_service.parse_json_response(response)
-
-                pdf_builder = PDFBuilder()
-                pdf_bytes = pdf_builder.create_comparison_report(comparison_data)
-                comparison_filename = f"Сравнительный_анализ_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.pdf"
-                comparison_path = RESULTS_DIR / comparison_filename
-                comparison_path.write_bytes(pdf_bytes)
-                output_files["comparison"] = {"name": comparison_filename, "path": str(comparison_path), "type": "pdf_comparison"}
-                db.add(OutputFile(request_id=request_id, file_name=comparison_filename, file_path=str(comparison_path), file_type="pdf_comparison"))
-                db.commit()
-            except Exception as e:
-                request_record.status = "error"
-                request_record.error_message = f"Ошибка анализа: {str(e)}"
-                db.commit()
-                return
-
-        request_record.status = "success"
-        request_record.output_files = output_files
-        db.commit()
+        for file in files:
+            limit = min(UPLOAD_MAX_FILE_MB * 1024 * 1024, remaining)
+            upload = await asyncio.to_thread(store_upload, file.file, file.filename, limit)
+            upload["format"] = file.content_type
+            stored.append(upload)
+            remaining -= upload["size"]
+    except UploadTooLarge as e:
+        _discard_uploads(stored)
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"{e} (не более {UPLOAD_MAX_FILE_MB} МБ на файл и {max_total_mb} МБ на запрос)"
+        )
+    except BaseException:
+        # Ошибка записи на диск, обрыв соединения — уже сохранённые файлы никому не нужны
+        _discard_uploads(stored)
+        raise
+    return stored
 
-    except Exception as e:
-        if request_record:
-            request_record.status = "error"
-            request_record.error_message = str(e)
-            db.commit()
-    finally:
-        for temp_path in temp_files.values():
-            Path(temp_path).unlink(missing_ok=True)
-        db.close()
+
+async def _submit_request(
+    db: Session,
+    stored: List[dict],
+    input_type: str,
+    outputs: list,
+    user_comment: Optional[str],
+    bypass_cache: bool,
+    batch_id: Optional[int] = None,
+    label: Optional[str] = None
+) -> Request:
+    """Создать запрос по сохранённым файлам и поставить его обработку в очередь
+
+    Повтор того же пакета (двойной клик, повторная отправка) присоединяется к уже
+    идущей или недавно завершённой обработке вместо новых вызовов Claude — тогда
+    у запроса заполнен duplicate_of, а задача не создаётся.
+    """
+    fingerprint = None
+    original = None
+    if COALESCE_ENABLED:
+        tokens = await asyncio.to_thread(pricelist_tokens) if "estimate" in outputs else {}
+        fingerprint = submission_fingerprint(
+            (upload["sha256"] for upload in stored), input_type, outputs, user_comment, tokens
+        )
+        if not bypass_cache:
+            original = find_original(db, fingerprint)
+
+    request_record = Request(
+        input_type=input_type,
+        requested_outputs=outputs,
+        status=original.status if original else "processing",
+        uploaded_files=[
+            {"name": upload["name"], "size": upload["size"], "format": upload["format"], "sha256": upload["sha256"]}
+            for upload in stored
+        ],
+        user_comment=user_comment,
+        fingerprint=fingerprint,
+        duplicate_of=original.id if original else None,
+        output_files=original.output_files if original else None,
+        batch_id=batch_id,
+        label=label
+    )
+    db.add(request_record)
+    db.commit()
+    db.refresh(request_record)
+
+    if not original:
+        # Обработку выполнит воркер (см. backend/worker.py); задача переживает перезапуск API
+        enqueue_job(db, request_record.id, {
+            "temp_files": {upload["name"]: upload["path"] for upload in stored},
+            "outputs": outputs,
+            "user_comment": user_comment,
+            "bypass_cache": bypass_cache,
+        }, batch_id=batch_id)
+    return request_record
 
 
 @router.post("/process")
 async def process_request(
-    background_tasks: BackgroundTasks,
     files: List[UploadFile] = File(...),
     input_type: str = Form(...),
     requested_outputs: str = Form(...),
     user_comment: Optional[str] = Form(None),
+    bypass_cache: bool = Form(False),
     current_user: dict = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     outputs = json.loads(requested_outputs)
+    stored = await _store_files(files, UPLOAD_MAX_REQUEST_MB)
+    try:
+        request_record = await _submit_request(db, stored, input_type, outputs, user_comment, bypass_cache)
+    except BaseException:
+        # Запрос не создан — файлы не нужны ни одной задаче
+        _discard_uploads(stored)
+        raise
+    # Задача уже в очереди (или не нужна) — дальше файлы защищает она
+    unhold_uploads(stored)
 
-    temp_files = {}
-    for file in files:
-        content = await file.read()
-        temp_path = Path(tempfile.gettempdir()) / f"{datetime.now().timestamp()}_{file.filename}"
-        temp_path.write_bytes(content)
-        temp_files[file.filename] = str(temp_path)
+    if request_record.duplicate_of:
+        release_uploads(upload["path"] for upload in stored)
+        return {
+            "request_id": request_record.id,
+            "status": request_record.status,
+            "duplicate_of": request_record.duplicate_of
+        }
+    return {"request_id": request_record.id, "status": "processing"}
 
-    request_record = Request(
-        input_type=input_type,
-        requested_outputs=outputs,
-        status="processing",
-        uploaded_files=[{"name": f.filename, "size": f.size, "format": f.content_type} for f in files],
-        user_comment=user_comment
-    )
-    db.add(request_record)
-    db.commit()
-    db.refresh(request_record)
 
-    background_tasks.add_task(process_in_background, request_record.id, temp_files, outputs, user_comment)
+@router.post("/batch")
+async def process_batch(
+    files: List[UploadFile] = File(...),
+    input_type: str = Form(...),
+    requested_outputs: str = Form(...),
+    groups: Optional[str] = Form(None),
+    user_comment: Optional[str] = Form(None),
+    max_concurrency: Optional[int] = Form(None),
+    bypass_cache: bool = Form(False),
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Пакетная обработка: каждая группа файлов — отдельный объект (запрос)
+
+    groups — JSON [{"name", "files": [имена файлов], "user_comment"}]; без него
+    каждый файл обрабатывается отдельно. Одновременно обрабатывается не больше
+    max_concurrency объектов пакета (не больше BATCH_MAX_CONCURRENCY).
+    """
+    outputs = json.loads(requested_outputs)
+    try:
+        specs = parse_groups(groups, [file.filename for file in files])
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    stored = await _store_files(files, UPLOAD_MAX_BATCH_MB)
+    by_name = {upload["name"]: upload for upload in stored}
+
+    try:
+        batch = Batch(
+            input_type=input_type,
+            requested_outputs=outputs,
+            max_concurrency=max(1, min(max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)),
+            requests_count=len(specs)
+        )
+        db.add(batch)
+        db.commit()
+        db.refresh(batch)
+
+        request_ids = []
+        for spec in specs:
+            request_record = await _submit_request(
+                db,
+                [by_name[name] for name in spec["files"]],
+                input_type,
+                outputs,
+                spec["user_comment"] or user_comment,
+                bypass_cache,
+                batch_id=batch.id,
+                label=spec["name"]
+            )
+            request_ids.append(request_record.id)
+    finally:
+        # Файлы уже поставленных задач release_uploads не тронет; остальные (объекты,
+        # склеенные с готовыми запросами, или все — если пакет не создан) не нужны никому
+        _discard_uploads(stored)
+    return {
+        "batch_id": batch.id,
+        "request_ids": request_ids,
+        "max_concurrency": batch.max_concurrency,
+        "status": "processing"
+    }
+
+
+@router.get("/batch/{batch_id}")
+async def get_batch_status(
+    batch_id: int,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    batch = db.query(Batch).filter(Batch.id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Пакет не найден")
+    requests = db.query(Request).filter(Request.batch_id == batch_id).order_by(Request.id).all()
+    return batch_summary(batch, requests)
 
-    return {"request_id": request_record.id, "status": "processing"}
+
+@router.get("/batch/{batch_id}/download")
+async def download_batch(
+    batch_id: int,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Скачать результаты всех объектов пакета одним ZIP-архивом"""
+    batch = db.query(Batch).filter(Batch.id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Пакет не найден")
+    requests = db.query(Request).filter(Request.batch_id == batch_id).order_by(Request.id).all()
+    if any(req.status not in FINISHED_STATUSES for req in requests):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Пакет ещё обрабатывается")
+
+    archive = await asyncio.to_thread(build_batch_archive, batch, requests, RESULTS_DIR)
+    if archive is None:
+        raise HTTPException(status_code=404, detail="В пакете нет готовых результатов")
+    batch.archive_path = str(archive)
+    db.commit()
+    return FileResponse(path=archive, filename=archive.name, media_type="application/zip")
 
 
 @router.get("/status/{request_id}")
@@ -175,10 +256,114 @@ async def get_status(
         "request_id": req.id,
         "status": req.status,
         "output_files": req.output_files or {},
-        "error_message": req.error_message
+        "error_message": req.error_message,
+        "progress": coalesce_progress(db, req),
+        "duplicate_of": req.duplicate_of,
+        "checkpoints": checkpoint_stages(db, req.id)
     }
 
 
+@router.get("/{request_id}/events")
+async def stream_events(
+    request_id: int,
+    current_user: dict = Depends(get_current_user)
+):
+    """Поток событий обработки (SSE): этапы, число полученных позиций и итог"""
+    # Сессия БД не держится открытой на всё время потока
+    db = SessionLocal()
+    try:
+        req = db.query(Request.id, Request.duplicate_of).filter(Request.id == request_id).first()
+    finally:
+        db.close()
+    if not req:
+        raise HTTPException(status_code=404, detail="Запрос не найден")
+    return StreamingResponse(
+        request_events(request_id, channel_id=req.duplicate_of or request_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post("/{request_id}/cancel")
+async def cancel_request(
+    request_id: int,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Отменить обработку: прервать вызовы Claude и парсинг, освободить воркер"""
+    req = db.query(Request).filter(Request.id == request_id).first()
+    if not req:
+        raise HTTPException(status_code=404, detail="Запрос не найден")
+
+    updated = db.query(Request).filter(Request.id == request_id, Request.status == "processing").update(
+        {Request.status: "cancelled", Request.error_message: "Обработка отменена пользователем"},
+        synchronize_session=False
+    )
+    db.commit()
+    if not updated:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Запрос уже завершён")
+    db.refresh(req)
+
+    # Повтор только отсоединяется: обработку исходного запроса ждут другие
+    if not req.duplicate_of:
+        # Повторы (возможно, чужие) не отменяются вместе с исходным — один из них
+        # продолжает обработку; его задача ставится до освобождения загрузок
+        detach_duplicates(db, request_id)
+        for payload in cancel_jobs(db, request_id):
+            release_uploads(payload.get("temp_files", {}).values())
+        # Если обработка идёт в этом процессе — прерываем сразу, иначе воркер
+        # остановит её при ближайшем heartbeat
+        cancel_local(request_id)
+
+    publish(request_id, "done", {
+        "status": req.status,
+        "output_files": req.output_files or {},
+        "error_message": req.error_message,
+    })
+    return {"request_id": request_id, "status": req.status}
+
+
+@router.post("/{request_id}/retry")
+async def retry_request(
+    request_id: int,
+    current_user: dict = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Продолжить запрос, завершившийся ошибкой, с первого невыполненного этапа"""
+    req = db.query(Request).filter(Request.id == request_id).first()
+    if not req:
+        raise HTTPException(status_code=404, detail="Запрос не найден")
+    done = checkpoint_stages(db, request_id)
+    if not parsed_files_available(load_checkpoint(db, request_id, "parse")):
+        # Загруженные файлы удаляются после обработки, а разобранных данных в кэше нет
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Файлы запроса не сохранились — отправьте запрос заново"
+        )
+
+    # Условное обновление: повторный клик не поставит запрос в очередь дважды
+    updated = db.query(Request).filter(Request.id == request_id, Request.status.in_(("error", "cancelled"))).update(
+        {Request.status: "processing", Request.error_message: None, Request.progress: None},
+        synchronize_session=False
+    )
+    db.commit()
+    if not updated:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Повторить можно только запрос, завершившийся ошибкой или отменённый"
+        )
+
+    # Параметры обработки — как у исходной задачи (bypass_cache не хранится в запросе)
+    last_job = db.query(Job).filter(Job.request_id == request_id).order_by(Job.id.desc()).first()
+    enqueue_job(db, request_id, {
+        "temp_files": {},
+        "outputs": req.requested_outputs,
+        "user_comment": req.user_comment,
+        "bypass_cache": bool(((last_job.payload or {}) if last_job else {}).get("bypass_cache", False)),
+    }, batch_id=req.batch_id)
+    return {"request_id": request_id, "status": "processing", "completed_stages": done}
+
+
 @router.get("/download/{file_id}")
 async def download_file(
     file_id: int,
@@ -218,17 +403,8 @@ async def get_history(
             "requested_outputs": r.requested_outputs,
             "status": r.status,
             "output_files": r.output_files,
-            "error_message": r.error_message
+            "error_message": r.error_message,
+            "duplicate_of": r.duplicate_of
         } for r in requests
     ]}
 
-
-def _read_pricelist(file_path: str) -> str:
-    try:
-        import pandas as pd
-        if Path(file_path).exists():
-            df = pd.read_excel(file_path, nrows=100)
-            return df.to_string()
-    except:
-        pass
-    return "(прайс-лист не найден)"
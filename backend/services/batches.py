@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from backend.models import Batch, Request
+from backend.services.rate_limiter import CLAUDE_MAX_CONCURRENCY
+
+# Сколько запросов одного пакета обрабатывается одновременно (по умолчанию — половина
+# параллельных вызовов Claude, чтобы одиночные запросы не ждали весь пакет)
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", str(max(1, CLAUDE_MAX_CONCURRENCY // 2))))
+# Максимум объектов в одном пакете
+BATCH_MAX_GROUPS = int(os.getenv("BATCH_MAX_GROUPS", "100"))
+
+FINISHED_STATUSES = ("success", "error", "cancelled")
+
+
+def parse_groups(groups: Optional[str], file_names: List[str]) -> List[Dict[str, Any]]:
+    """Разобрать описание групп файлов пакета
+
+    groups — JSON-список [{"name": ..., "files": [имена файлов], "user_comment": ...}];
+    если не задан, каждый файл — отдельный объект.
+    """
+    if len(set(file_names)) != len(file_names):
+        raise ValueError("Имена файлов в пакете должны быть уникальны")
+    if not groups:
+        specs = [{"name": name, "files": [name]} for name in file_names]
+    else:
+        try:
+            specs = json.loads(groups)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Некорректное описание групп: {str(e)}")
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            raise ValueError("Описание групп должно быть списком объектов")
+
+    if not specs:
+        raise ValueError("Пакет не содержит ни одного объекта")
+    if len(specs) > BATCH_MAX_GROUPS:
+        raise ValueError(f"В пакете больше {BATCH_MAX_GROUPS} объектов")
+
+    known = set(file_names)
+    used = set()
+    result = []
+    for i, spec in enumerate(specs, start=1):
+        files = spec.get("files")
+        if not isinstance(files, list) or not files:
+            raise ValueError(f"Группа {i}: не указаны файлы")
+        missing = [name for name in files if name not in known]
+        if missing:
+            raise ValueError(f"Группа {i}: файлы не загружены: {', '.join(map(str, missing))}")
+        used.update(files)
+        result.append({
+            "name": str(spec.get("name") or f"Объект {i}"),
+            "files": files,
+            "user_comment": spec.get("user_comment"),
+        })
+    unused = known - used
+    if unused:
+        raise ValueError(f"Файлы не входят ни в одну группу: {', '.join(sorted(unused))}")
+    return result
+
+
+def batch_summary(batch: Batch, requests: List[Request]) -> Dict[str, Any]:
+    """Сводный прогресс пакета по его запросам"""
+    counts: Dict[str, int] = {}
+    for req in requests:
+        counts[req.status] = counts.get(req.status, 0) + 1
+    finished = sum(counts.get(status, 0) for status in FINISHED_STATUSES)
+    succeeded = counts.get("success", 0)
+
+    if finished < len(requests):
+        batch_status = "processing"
+    elif succeeded == len(requests):
+        batch_status = "success"
+    elif succeeded:
+        batch_status = "partial"
+    else:
+        batch_status = "error"
+
+    return {
+        "batch_id": batch.id,
+        "status": batch_status,
+        "total": len(requests),
+        "finished": finished,
+        "progress": round(100 * finished / len(requests)) if requests else 100,
+        "counts": counts,
+        "max_concurrency": batch.max_concurrency,
+        "download_ready": batch_status != "processing" and succeeded > 0,
+        "requests": [
+            {
+                "request_id": req.id,
+                "name": req.label,
+                "status": req.status,
+                "progress": req.progress or {},
+                "error_message": req.error_message,
+                "output_files": req.output_files or {},
+            }
+            for req in requests
+        ],
+    }
+
+
+def build_batch_archive(batch: Batch, requests: List[Request], results_dir: Path) -> Optional[Path]:
+    """Общий ZIP с результатами всех успешных запросов пакета (папка на объект)
+
+    Архив пересобирается, только если изменился набор файлов (например, после
+    повтора упавшего объекта).
+    """
+    entries = []
+    for i, req in enumerate(requests, start=1):
+        if req.status != "success":
+            continue
+        folder = f"{i:02d}_{(req.label or f'Объект {i}').replace('/', '_').replace(chr(92), '_')}"
+        for output in (req.output_files or {}).values():
+            path = Path(output["path"])
+            if path.exists():
+                entries.append((path, f"{folder}/{output['name']}"))
+    if not entries:
+        return None
+
+    digest = hashlib.sha1("\n".join(f"{path}|{arcname}" for path, arcname in entries).encode("utf-8")).hexdigest()
+    archive = results_dir / f"Пакет_{batch.id}_{digest[:8]}.zip"
+    if archive.exists():
+        return archive
+
+    tmp_path = archive.with_suffix(".zip.part")
+    # xlsx и pdf уже сжаты — файлы кладутся в архив без повторного сжатия
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for path, arcname in entries:
+            zf.write(path, arcname)
+    os.replace(tmp_path, archive)
+    if batch.archive_path and batch.archive_path != str(archive):
+        Path(batch.archive_path).unlink(missing_ok=True)
+    return archive
@@ -0,0 +1,43 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from backend.models import StageCheckpoint
+
+logger = logging.getLogger(__name__)
+
+
+def load_checkpoints(db, request_id: int) -> Dict[str, Any]:
+    """Сохранённые результаты этапов запроса: {этап: результат}"""
+    rows = db.query(StageCheckpoint).filter(StageCheckpoint.request_id == request_id).all()
+    return {row.stage: row.result for row in rows}
+
+
+def load_checkpoint(db, request_id: int, stage: str) -> Optional[Any]:
+    """Сохранённый результат одного этапа (None, если этап не выполнялся)"""
+    row = (
+        db.query(StageCheckpoint.result)
+        .filter(StageCheckpoint.request_id == request_id, StageCheckpoint.stage == stage)
+        .first()
+    )
+    return row.result if row else None
+
+
+def checkpoint_stages(db, request_id: int) -> List[str]:
+    rows = db.query(StageCheckpoint.stage).filter(StageCheckpoint.request_id == request_id).all()
+    return sorted(stage for (stage,) in rows)
+
+
+def save_checkpoint(db, request_id: int, stage: str, result: Any):
+    """Сохранить результат этапа (повторное сохранение заменяет прежний)"""
+    try:
+        # Результат должен быть JSON: иначе этап просто выполнится заново при возобновлении
+        json.dumps(result, ensure_ascii=False)
+    except (TypeError, ValueError) as e:
+        logger.warning("Результат этапа %s запроса %s не сохранён: %s", stage, request_id, e)
+        return
+    db.query(StageCheckpoint).filter(
+        StageCheckpoint.request_id == request_id, StageCheckpoint.stage == stage
+    ).delete(synchronize_session=False)
+    db.add(StageCheckpoint(request_id=request_id, stage=stage, result=result))
+    db.commit()
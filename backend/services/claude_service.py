@@ -1,25 +1,32 @@
 import os
 import json
 import base64
-from typing import Dict, List, Any, Optional
+import asyncio
+import logging
+import functools
+from dataclasses import dataclass
+from typing import Dict, List, Any, Optional, Callable, Tuple, Union
 import anthropic
-from pathlib import Path
-import pandas as pd
 
-class ClaudeService:
-    """Сервис для взаимодействия с Claude API"""
+from backend.services.llm_cache import get_llm_cache
+from backend.services.file_parser import PROMPT_FILE_CHARS
+from backend.services.json_stream import JSONArrayStream, decode_json_text
+from backend.services.rate_limiter import get_rate_governor, estimate_tokens
 
-    def __init__(self):
-        self.api_key = os.getenv("CLAUDE_API_KEY", "")
-        self.client = anthropic.Anthropic(api_key=self.api_key)
-        self.model = os.getenv("CLAUDE_MODEL", "claude-opus-4-5")
+# Параметры общего для процесса пула соединений с Claude API
+CLAUDE_MAX_CONNECTIONS = int(os.getenv("CLAUDE_MAX_CONNECTIONS", "20"))
+CLAUDE_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("CLAUDE_MAX_KEEPALIVE_CONNECTIONS", "10"))
+CLAUDE_TIMEOUT = float(os.getenv("CLAUDE_TIMEOUT", "600"))
+CLAUDE_CONNECT_TIMEOUT = float(os.getenv("CLAUDE_CONNECT_TIMEOUT", "10"))
+# Сколько раз дозапрашивать ответ, обрезанный по max_tokens
+CLAUDE_MAX_CONTINUATIONS = int(os.getenv("CLAUDE_MAX_CONTINUATIONS", "2"))
+# Минимальная длина кэшируемого префикса промпта (токенов) — зависит от модели
+# (4096 для claude-opus-4-5, 1024 для Sonnet); более короткие префиксы API не кэширует
+CLAUDE_CACHE_MIN_TOKENS = int(os.getenv("CLAUDE_CACHE_MIN_TOKENS", "4096"))
 
-    def create_list_prompt(self, file_contents: Dict[str, Any], user_comment: Optional[str] = None) -> str:
-        """Создать промпт для формирования Перечня работ и материалов"""
-        
-        files_context = self._format_file_contents(file_contents)
-        
-        prompt = f"""Ты — опытный инженер-сметчик в строительстве. 
+logger = logging.getLogger(__name__)
+
+LIST_INSTRUCTIONS = """Ты — опытный инженер-сметчик в строительстве. 
 На основании предоставленных документов (ТЗ, проект, спецификации, смета) необходимо составить полный и структурированный Перечень работ и материалов.
 
 Требования:
@@ -32,33 +39,23 @@ class ClaudeService:
 7. Если загружена смета ГрандСмета или ЭДЦ — извлеки позиции напрямую из неё, сохраняя наименования
 8. Если загружен проект со спецификацией — используй спецификацию для объёмов в приоритете
 
-Документы:
-{files_context}
-
-Комментарий пользователя:
-{user_comment or "(нет комментария)"}
+Документы и комментарий пользователя приведены в сообщении пользователя.
 
 Формат ответа: только структурированные данные в JSON следующего вида:
 [
-  {{
+  {
     "type": "Работа" или "Материал",
     "name": "Наименование позиции",
     "unit": "Ед. изм.",
     "quantity": число или null
-  }},
+  },
   ...
 ]
 
 Возвращай ТОЛЬКО JSON массив, без дополнительных объяснений."""
-        
-        return prompt
 
-    def create_estimate_prompt(self, list_content: Dict[str, Any], pricelist_works: str, pricelist_materials: str) -> str:
-        """Создать промпт для формирования Сметы"""
-        
-        list_context = self._format_list_content(list_content)
-        
-        prompt = f"""Ты — снабженец/сметчик с опытом в строительстве. На основании полученного перечня нужно подготовить полную смету в рекомендуемом качестве для закупки/бюджетирования.
+ESTIMATE_INSTRUCTIONS = """Ты — снабженец/сметчик с опытом в строительстве.
+На основании полученного перечня нужно подготовить полную смету в рекомендуемом качестве для закупки/бюджетирования.
 
 Найди позиции материала и работ в соответствующих прайсах. Проставь цены из прайсов, если такие найдены. В колонку «Наименование в прайсе» поставь найденное наименование из прайса.
 
@@ -71,18 +68,11 @@ class ClaudeService:
 - Если источник даёт цену без НДС — пересчитай «с НДС» (ставка 22%)
 - Для работ: если подрядчик на УСН — укажи это, НДС = 0, но отрази в примечании
 
-Перечень:
-{list_context}
-
-Прайс на работы (первые 50 строк):
-{pricelist_works[:3000]}
-
-Прайс на материалы (первые 50 строк):
-{pricelist_materials[:3000]}
+Перечень и подходящие к его позициям строки прайсов приведены в сообщении пользователя.
 
 Формат ответа: только JSON-массив:
 [
-  {{
+  {
     "type": "Работа" или "Материал",
     "name": "Наименование",
     "unit": "Ед. изм.",
@@ -91,18 +81,15 @@ class ClaudeService:
     "price_material_per_unit": число или null,
     "name_in_pricelist": "Наименование в прайсе или источник",
     "note": "Примечание (НДС, УСН, источник цены и т.д.)"
-  }},
+  },
   ...
 ]
 
 Возвращай ТОЛЬКО JSON массив, без дополнительных объяснений."""
-        
-        return prompt
 
-    def create_comparison_prompt(self, project_content: str, estimate_content: str) -> str:
-        """Создать промпт для сравнительного анализа"""
-        
-        prompt = f"""Ты — опытный строительный эксперт и сметчик. Проведи детальный сравнительный анализ между проектной документацией (спецификация, ТЗ) и сметой/перечнем работ и материалов.
+COMPARISON_INSTRUCTIONS = """Ты — опытный строительный эксперт и сметчик.
+Проведи детальный сравнительный анализ между проектной документацией (спецификация, ТЗ)
+и сметой/перечнем работ и материалов.
 
 Задача:
 1. Найди позиции, которые есть в проекте, но отсутствуют в смете — потенциальные упущения
@@ -112,69 +99,331 @@ class ClaudeService:
 5. Сформируй список из 5–10 критических замечаний, на которые нужно обратить особое внимание
 6. Дай итоговую оценку: насколько смета соответствует проекту (в %)
 
-Проект и спецификация:
-{project_content[:2000]}
-
-Смета/Перечень:
-{estimate_content[:2000]}
+Проект и смета приведены в сообщении пользователя.
 
 Формат ответа: JSON следующей структуры:
-{{
-  "missing_in_estimate": [ {{ "name": "...", "unit": "...", "quantity": ..., "note": "..." }} ],
-  "extra_in_estimate": [ {{ "name": "...", "unit": "...", "quantity": ..., "note": "..." }} ],
-  "quantity_discrepancies": [ {{ "name": "...", "project_qty": ..., "estimate_qty": ..., "diff_pct": ..., "note": "..." }} ],
-  "unit_discrepancies": [ {{ "name": "...", "project_unit": "...", "estimate_unit": "...", "note": "..." }} ],
+{
+  "missing_in_estimate": [ { "name": "...", "unit": "...", "quantity": ..., "note": "..." } ],
+  "extra_in_estimate": [ { "name": "...", "unit": "...", "quantity": ..., "note": "..." } ],
+  "quantity_discrepancies": [
+    { "name": "...", "project_qty": ..., "estimate_qty": ..., "diff_pct": ..., "note": "..." }
+  ],
+  "unit_discrepancies": [ { "name": "...", "project_unit": "...", "estimate_unit": "...", "note": "..." } ],
   "critical_notes": [ "...", "...", "..." ],
   "compliance_pct": 85,
   "summary": "Общий текстовый вывод"
-}}
+}
 
 Возвращай ТОЛЬКО JSON, без дополнительных объяснений."""
+
+
+def _system_blocks(*texts: str) -> List[Dict[str, Any]]:
+    """Блоки system-префикса; точка кэширования — на последнем, если префикс достигает минимума"""
+    blocks = [{"type": "text", "text": text} for text in texts if text]
+    if blocks and estimate_tokens("".join(texts)) >= CLAUDE_CACHE_MIN_TOKENS:
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return blocks
+
+
+@dataclass
+class Prompt:
+    """Промпт: стабильный кэшируемый префикс (system) и переменная часть (user)"""
+    system: List[Dict[str, Any]]
+    user: str
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"system": self.system, "user": self.user}
+
+    def to_text(self) -> str:
+        """Плоский текст промпта для истории запросов"""
+        return "\n\n".join([block["text"] for block in self.system] + [self.user])
+
+
+_async_client: Optional[anthropic.AsyncAnthropic] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_client() -> anthropic.AsyncAnthropic:
+    """Лениво создать единый AsyncAnthropic клиент с keep-alive пулом соединений"""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    # Пул соединений httpx привязан к event loop, в котором он создан
+    if _async_client is None or _async_client_loop is not loop:
+        # Типы Timeout/Limits берём из SDK, чтобы не зависеть от версии его HTTP-клиента
+        limits_cls = type(anthropic.DEFAULT_CONNECTION_LIMITS)
+        _async_client = anthropic.AsyncAnthropic(
+            api_key=os.getenv("CLAUDE_API_KEY", ""),
+            # Повторы выполняет ClaudeRateGovernor с учётом общих лимитов
+            max_retries=0,
+            timeout=anthropic.Timeout(CLAUDE_TIMEOUT, connect=CLAUDE_CONNECT_TIMEOUT),
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=limits_cls(
+                    max_connections=CLAUDE_MAX_CONNECTIONS,
+                    max_keepalive_connections=CLAUDE_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+            ),
+        )
+        _async_client_loop = loop
+    return _async_client
+
+
+async def close_async_client():
+    """Закрыть общий клиент при остановке приложения"""
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.close()
+    _async_client = None
+    _async_client_loop = None
+
+
+class ClaudeService:
+    """Сервис для взаимодействия с Claude API"""
+
+    def __init__(self, use_cache: bool = True):
+        self.model = os.getenv("CLAUDE_MODEL", "claude-opus-4-5")
+        self.cache = get_llm_cache()
+        # use_cache=False — не читать кэш ответов (флаг "bypass cache" запроса);
+        # свежий ответ всё равно записывается и заменяет прежний
+        self.read_cache = use_cache
+
+    @property
+    def client(self) -> anthropic.AsyncAnthropic:
+        return get_async_client()
+
+    def create_list_prompt(self, file_contents: Dict[str, Any], user_comment: Optional[str] = None) -> Prompt:
+        """Создать промпт для формирования Перечня работ и материалов"""
         
-        return prompt
+        files_context = self._format_file_contents(file_contents)
+        
+        user = f"""Документы:
+{files_context}
 
-    def call_claude(self, prompt: str, max_tokens: int = 8000) -> str:
-        """Отправить запрос в Claude и получить ответ"""
+Комментарий пользователя:
+{user_comment or "(нет комментария)"}"""
         
-        try:
-            message = self.client.messages.create(
-                model=self.model,
-                max_tokens=max_tokens,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.2
-            )
-            
-            return message.content[0].text
-        except Exception as e:
-            raise Exception(f"Ошибка при запросе к Claude: {str(e)}")
+        return Prompt(system=_system_blocks(LIST_INSTRUCTIONS), user=user)
+
+    def create_estimate_prompt(
+        self,
+        list_content: Dict[str, Any],
+        pricelist_works: str,
+        pricelist_materials: str,
+        works_head: str = "",
+        materials_head: str = "",
+    ) -> Prompt:
+        """Создать промпт для формирования Сметы
+
+        works_head/materials_head — начало прайсов: оно одинаково для всех заданий и уходит
+        в кэшируемый префикс вместе с инструкциями; pricelist_works/pricelist_materials —
+        подобранные под перечень строки сверх него.
+        """
+        
+        list_context = self._format_list_content(list_content)
+        
+        pricelists, rows_label = "", "подходящие позиции"
+        if works_head or materials_head:
+            rows_label = "другие подходящие позиции"
+            pricelists = f"""Прайс на работы:
+{works_head or "(прайс-лист не найден)"}
+
+Прайс на материалы:
+{materials_head or "(прайс-лист не найден)"}"""
+        
+        user = f"""Прайс на работы ({rows_label}):
+{pricelist_works}
+
+Прайс на материалы ({rows_label}):
+{pricelist_materials}
+
+Перечень:
+{list_context}"""
+        
+        return Prompt(system=_system_blocks(ESTIMATE_INSTRUCTIONS, pricelists), user=user)
+
+    def create_comparison_prompt(self, project_content: str, estimate_content: str) -> Prompt:
+        """Создать промпт для сравнительного анализа"""
+        
+        user = f"""Проект и спецификация:
+{project_content[:PROMPT_FILE_CHARS]}
+
+Смета/Перечень:
+{estimate_content[:2000]}"""
+        
+        return Prompt(system=_system_blocks(COMPARISON_INSTRUCTIONS), user=user)
+
+    def _request_params(self, prompt, max_tokens: int, prefill: Optional[str] = None) -> Dict[str, Any]:
+        """Параметры messages API: кэшируемый system-префикс и переменное сообщение пользователя"""
+        
+        if isinstance(prompt, Prompt):
+            system, content = prompt.system, prompt.user
+        else:
+            system, content = None, prompt
+        
+        params = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ],
+            "temperature": 0.2
+        }
+        if prefill:
+            params["messages"].append({"role": "assistant", "content": prefill})
+        if system:
+            params["system"] = system
+        return params
+
+    def _estimate_input_tokens(self, params: Dict[str, Any]) -> int:
+        """Оценка входных токенов запроса для ограничителя скорости"""
+        system_text = "".join(block["text"] for block in params.get("system", []))
+        return estimate_tokens(system_text + "".join(m["content"] for m in params["messages"]))
+
+    def _cache_key(self, prompt, max_tokens: int) -> str:
+        key_prompt = prompt.as_dict() if isinstance(prompt, Prompt) else prompt
+        return self.cache.make_key(self.model, max_tokens, key_prompt)
+
+    def _log_usage(self, message):
+        """Записать в лог расход токенов, включая попадания в кэш промпта"""
+        usage = getattr(message, "usage", None)
+        if usage is None:
+            return
+        logger.info(
+            "Claude usage: input=%s cache_write=%s cache_read=%s output=%s stop=%s",
+            usage.input_tokens,
+            getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            getattr(usage, "cache_read_input_tokens", 0) or 0,
+            usage.output_tokens,
+            message.stop_reason,
+        )
+
+    async def call_claude(self, prompt: Union[str, "Prompt"], max_tokens: int = 8000) -> str:
+        """Отправить запрос в Claude и получить ответ (обрезанный ответ дозапрашивается)"""
+        
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt, max_tokens)
+            cached = await asyncio.to_thread(self.cache.get, cache_key) if self.read_cache else None
+            if cached is not None:
+                return cached
+
+        governor = get_rate_governor()
+        text = ""
+        message = None
+        for continuation in range(CLAUDE_MAX_CONTINUATIONS + 1):
+            # Продолжение: уже полученный текст передаётся как начало ответа ассистента
+            prefill = text.rstrip() if continuation else None
+            params = self._request_params(prompt, max_tokens, prefill)
+            input_estimate = self._estimate_input_tokens(params)
+            try:
+                message = await governor.run(
+                    functools.partial(self.client.messages.create, **params), input_estimate, max_tokens
+                )
+            except Exception as e:
+                if not continuation:
+                    raise Exception(f"Ошибка при запросе к Claude: {str(e)}")
+                logger.warning("Не удалось получить продолжение ответа: %s", e)
+                return text
+            governor.settle(message.usage, input_estimate, max_tokens)
+            self._log_usage(message)
+            text = (prefill or "") + message.content[0].text
+            if message.stop_reason != "max_tokens":
+                break
+            logger.info("Ответ обрезан по max_tokens, запрос продолжения №%s", continuation + 1)
+
+        # Обрезанные по max_tokens ответы не кэшируем
+        if cache_key and message.stop_reason != "max_tokens":
+            await asyncio.to_thread(self.cache.put, cache_key, self.model, text)
+        return text
+
+    async def stream_json_array(
+        self,
+        prompt: Union[str, "Prompt"],
+        max_tokens: int = 8000,
+        on_item: Optional[Callable[[Any], None]] = None,
+    ) -> Tuple[str, List[Any]]:
+        """Получить JSON-массив потоком, передавая элементы в on_item по мере их закрытия"""
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(prompt, max_tokens)
+            cached = await asyncio.to_thread(self.cache.get, cache_key) if self.read_cache else None
+            if cached is not None:
+                items = self.parse_json_response(cached)
+                if on_item:
+                    for item in items:
+                        on_item(item)
+                return cached, items
+
+        parser = JSONArrayStream()
+        items = []
+        governor = get_rate_governor()
+        response = ""
+        message = None
+
+        async def consume(params, base):
+            # Каждая попытка разбирает ответ заново с состояния до неё: текст
+            # оборвавшейся попытки не должен попасть в разборщик повтора
+            nonlocal parser
+            parser = base.copy()
+            del items[emitted:]
+            async with self.client.messages.stream(**params) as stream:
+                async for text in stream.text_stream:
+                    for item in parser.feed(text):
+                        items.append(item)
+                        if on_item:
+                            on_item(item)
+                return await stream.get_final_message()
+
+        for continuation in range(CLAUDE_MAX_CONTINUATIONS + 1):
+            # Продолжение обрезанного ответа дописывается в тот же разборщик
+            prefill = response.rstrip() if continuation else None
+            params = self._request_params(prompt, max_tokens, prefill)
+            input_estimate = self._estimate_input_tokens(params)
+            emitted = len(items)
+            try:
+                # Повтор возможен, только пока элементы этого вызова не переданы потребителям
+                message = await governor.run(
+                    functools.partial(consume, params, parser.copy()), input_estimate, max_tokens,
+                    can_retry=lambda: len(items) == emitted
+                )
+            except Exception as e:
+                if not continuation:
+                    raise Exception(f"Ошибка при запросе к Claude: {str(e)}")
+                logger.warning("Не удалось получить продолжение ответа: %s", e)
+                message = None
+                break
+            governor.settle(message.usage, input_estimate, max_tokens)
+            self._log_usage(message)
+            response = (prefill or "") + message.content[0].text
+            if message.stop_reason != "max_tokens" or parser.done:
+                break
+            logger.info("Ответ обрезан по max_tokens, запрос продолжения №%s", continuation + 1)
+
+        if not parser.started:
+            # Модель вернула не массив — разбираем ответ целиком
+            items = self.parse_json_response(response)
+            if on_item and isinstance(items, list):
+                for item in items:
+                    on_item(item)
+        elif not parser.done:
+            # Массив не закрыт и после всех попыток — неполный результат за успех не выдаём
+            raise Exception(f"Ошибка при запросе к Claude: ответ обрезан после {len(items)} позиций")
+
+        if cache_key and message is not None and message.stop_reason != "max_tokens":
+            await asyncio.to_thread(self.cache.put, cache_key, self.model, response)
+        return response, items
 
     def parse_json_response(self, response: str) -> Dict[str, Any]:
-        """Парсить JSON ответ от Claude"""
+        """Парсить JSON ответ от Claude (из обрезанного массива берутся завершённые элементы)"""
         
         try:
-            # Попытка найти JSON в ответе
-            start_idx = response.find('[') if response.find('[') != -1 else response.find('{')
-            if start_idx == -1:
-                raise ValueError("JSON не найден в ответе")
-            
-            json_str = response[start_idx:]
-            # Найти конец JSON
-            bracket_count = 0
-            for i, char in enumerate(json_str):
-                if char in '[{':
-                    bracket_count += 1
-                elif char in ']}':
-                    bracket_count -= 1
-                    if bracket_count == 0:
-                        json_str = json_str[:i+1]
-                        break
-            
-            return json.loads(json_str)
+            value, complete = decode_json_text(response)
+            if not complete:
+                logger.warning("JSON в ответе обрезан, сохранено %s завершённых элементов", len(value))
+            return value
         except Exception as e:
             raise Exception(f"Ошибка при парсинге JSON ответа: {str(e)}")
 
@@ -187,16 +436,16 @@ class ClaudeService:
             
             if isinstance(content, dict):
                 if 'text' in content:
-                    result += content['text'][:2000]
+                    result += content['text'][:PROMPT_FILE_CHARS]
                 elif 'content' in content:
                     if isinstance(content['content'], str):
-                        result += content['content'][:2000]
+                        result += content['content'][:PROMPT_FILE_CHARS]
                     else:
-                        result += json.dumps(content['content'], ensure_ascii=False)[:2000]
+                        result += json.dumps(content['content'], ensure_ascii=False)[:PROMPT_FILE_CHARS]
                 else:
-                    result += json.dumps(content, ensure_ascii=False)[:2000]
+                    result += json.dumps(content, ensure_ascii=False)[:PROMPT_FILE_CHARS]
             else:
-                result += str(content)[:2000]
+                result += str(content)[:PROMPT_FILE_CHARS]
         
         return result
 
@@ -209,16 +458,3 @@ class ClaudeService:
             return json.dumps(list_content, ensure_ascii=False, indent=2)
         else:
             return str(list_content)
-
-    def _read_pricelist(self, file_path: str) -> str:
-        """Прочитать прайс-лист и вернуть в виде текста"""
-        
-        if not Path(file_path).exists():
-            return "(прайс-лист не найден)"
-        
-        try:
-            # Читаем только первые строки
-            df = pd.read_excel(file_path, nrows=100)
-            return df.to_string()
-        except Exception as e:
-            return f"(ошибка при чтении прайс-листа: {str(e)})"
@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from backend.models import Request
+from backend.services.pricelist_store import get_pricelist_store
+
+# Склеивать одинаковые запросы: повтор получает результаты уже идущей или недавней обработки
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+# Сколько минут успешный результат переиспользуется для одинаковых запросов
+COALESCE_WINDOW_MINUTES = int(os.getenv("COALESCE_WINDOW_MINUTES", "60"))
+
+
+def pricelist_tokens() -> Dict[str, str]:
+    """Версии прайс-листов (токены хранилища) — от них зависит Смета"""
+    store = get_pricelist_store()
+    tokens = {}
+    for kind in ("works", "materials"):
+        pricelist = store.get(kind)
+        tokens[kind] = pricelist.token if pricelist is not None else ""
+    return tokens
+
+
+def submission_fingerprint(
+    file_hashes: Iterable[str],
+    input_type: str,
+    outputs: List[str],
+    user_comment: Optional[str],
+    pricelists: Optional[Dict[str, str]] = None,
+) -> str:
+    """Отпечаток запроса: содержимое файлов, параметры обработки и версии прайсов"""
+    raw = json.dumps(
+        [sorted(file_hashes), input_type, sorted(outputs), (user_comment or "").strip(), pricelists or {}],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def find_original(db, fingerprint: str) -> Optional[Request]:
+    """Запрос с тем же отпечатком, который ещё обрабатывается или недавно успешно завершён"""
+    recent = datetime.utcnow() - timedelta(minutes=COALESCE_WINDOW_MINUTES)
+    return (
+        db.query(Request)
+        .filter(
+            Request.fingerprint == fingerprint,
+            Request.duplicate_of.is_(None),
+            (Request.status == "processing") | ((Request.status == "success") & (Request.created_at >= recent)),
+        )
+        .order_by(Request.id.desc())
+        .first()
+    )
+
+
+def settle_duplicates(db, request_record: Request) -> int:
+    """Передать итог обработки запросам, присоединённым к нему как повторы"""
+    updated = (
+        db.query(Request)
+        .filter(Request.duplicate_of == request_record.id, Request.status == "processing")
+        .update(
+            {
+                Request.status: request_record.status,
+                Request.output_files: request_record.output_files,
+                Request.error_message: request_record.error_message,
+                Request.stage_timings: request_record.stage_timings,
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return updated
+
+
+def coalesce_progress(db, request_record: Request) -> Dict[str, Any]:
+    """Прогресс запроса; у повтора — прогресс исходного запроса"""
+    if request_record.duplicate_of and request_record.status == "processing":
+        original = db.query(Request).filter(Request.id == request_record.duplicate_of).first()
+        if original is not None:
+            return original.progress or {}
+    return request_record.progress or {}
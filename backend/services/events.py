@@ -0,0 +1,242 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from backend.database import SessionLocal
+from backend.models import Request
+
+logger = logging.getLogger(__name__)
+
+# Как часто процесс сверяет с БД состояние запросов, на которые открыты потоки событий (сек)
+EVENTS_DB_POLL_SECONDS = float(os.getenv("EVENTS_DB_POLL_SECONDS", "2"))
+# Комментарий-пинг, чтобы прокси не закрывали простаивающее соединение
+EVENTS_KEEPALIVE_SECONDS = 15.0
+
+TERMINAL_STATUSES = ("success", "error", "cancelled")
+
+
+class ProgressBroker:
+    """Pub/sub событий обработки запросов внутри процесса
+
+    Публиковать можно из любого потока: события доставляются подписчикам в их event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        # Запросы, которые сейчас обрабатываются в этом процессе
+        self._local: Set[int] = set()
+
+    def subscribe(self, request_id: int, queue: Optional[asyncio.Queue] = None) -> asyncio.Queue:
+        queue = queue or asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(request_id, set()).add((asyncio.get_running_loop(), queue))
+        return queue
+
+    def unsubscribe(self, request_id: int, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(request_id, set())
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(request_id, None)
+
+    def publish(self, request_id: int, event: str, data: Dict[str, Any]):
+        with self._lock:
+            if event in ("done", "requeued"):
+                self._local.discard(request_id)
+            else:
+                self._local.add(request_id)
+            subscribers = list(self._subscribers.get(request_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    def is_local(self, request_id: int) -> bool:
+        with self._lock:
+            return request_id in self._local
+
+
+_broker: Optional[ProgressBroker] = None
+_broker_lock = threading.Lock()
+
+
+def get_progress_broker() -> ProgressBroker:
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = ProgressBroker()
+        return _broker
+
+
+def publish(request_id: int, event: str, data: Dict[str, Any]):
+    get_progress_broker().publish(request_id, event, data)
+
+
+def format_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _state_from_row(row) -> Dict[str, Any]:
+    return {
+        "status": row.status,
+        "progress": row.progress or {},
+        "output_files": row.output_files or {},
+        "error_message": row.error_message,
+    }
+
+
+def request_state(request_id: int) -> Optional[Dict[str, Any]]:
+    """Текущее состояние запроса из БД (только нужные колонки, короткая сессия)"""
+    return request_states([request_id]).get(request_id)
+
+
+def request_states(request_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Состояния нескольких запросов одним запросом к БД"""
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(Request.id, Request.status, Request.progress, Request.output_files, Request.error_message)
+            .filter(Request.id.in_(list(request_ids)))
+            .all()
+        )
+    finally:
+        db.close()
+    return {row.id: _state_from_row(row) for row in rows}
+
+
+def request_channel(request_id: int) -> int:
+    """Чьи события слушать: у повтора — исходного запроса"""
+    db = SessionLocal()
+    try:
+        row = db.query(Request.duplicate_of).filter(Request.id == request_id).first()
+    finally:
+        db.close()
+    return (row.duplicate_of if row else None) or request_id
+
+
+# Событие сверки с БД: доставляется только в очередь потока, наружу не отправляется
+DB_STATE_EVENT = "_db_state"
+
+
+class RequestStatePoller:
+    """Общая для процесса сверка с БД состояния запросов, на которые открыты потоки SSE
+
+    Один фоновый цикл раз в EVENTS_DB_POLL_SECONDS читает состояния всех наблюдаемых
+    запросов одним запросом и раскладывает их по очередям потоков — нагрузка на БД
+    не растёт с числом подключений. Цикл работает, пока есть хотя бы один поток.
+    """
+
+    def __init__(self):
+        self._watchers: Dict[int, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, request_id: int, queue: asyncio.Queue):
+        self._watchers.setdefault(request_id, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def unwatch(self, request_id: int, queue: asyncio.Queue):
+        queues = self._watchers.get(request_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                self._watchers.pop(request_id, None)
+
+    async def _run(self):
+        while self._watchers:
+            await asyncio.sleep(EVENTS_DB_POLL_SECONDS)
+            request_ids = list(self._watchers)
+            if not request_ids:
+                break
+            try:
+                states = await asyncio.to_thread(request_states, request_ids)
+            except Exception as e:
+                logger.warning("Не удалось прочитать состояние запросов для потоков событий: %s", e)
+                continue
+            for request_id in request_ids:
+                for queue in list(self._watchers.get(request_id, ())):
+                    queue.put_nowait((DB_STATE_EVENT, states.get(request_id)))
+
+
+_poller: Optional[RequestStatePoller] = None
+_poller_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_state_poller() -> RequestStatePoller:
+    """Сверка с БД общая для event loop процесса (потоки SSE живут в нём)"""
+    global _poller, _poller_loop
+    loop = asyncio.get_running_loop()
+    if _poller is None or _poller_loop is not loop:
+        _poller = RequestStatePoller()
+        _poller_loop = loop
+    return _poller
+
+
+async def request_events(request_id: int, channel_id: Optional[int] = None):
+    """Поток SSE по запросу: этапы, число позиций и итог обработки
+
+    События публикует конвейер в этом процессе; если запрос обрабатывает отдельный
+    воркер, изменения приходят из общей для процесса сверки с БД. channel_id — запрос,
+    чьи события слушать (у повтора — исходный запрос).
+    """
+    broker = get_progress_broker()
+    poller = get_state_poller()
+    channel_id = channel_id or request_id
+    queue = broker.subscribe(channel_id)
+    poller.watch(request_id, queue)
+    try:
+        state = await asyncio.to_thread(request_state, request_id)
+        if state is None:
+            return
+        yield format_event("state", state)
+        if state["status"] in TERMINAL_STATUSES:
+            yield format_event("done", state)
+            return
+
+        loop = asyncio.get_running_loop()
+        last_sent = loop.time()
+        while True:
+            timeout = EVENTS_KEEPALIVE_SECONDS - (loop.time() - last_sent)
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                event = None
+
+            if event == DB_STATE_EVENT:
+                if data is None:
+                    return
+                if data != state:
+                    state = data
+                    if data["status"] in TERMINAL_STATUSES:
+                        yield format_event("done", data)
+                        return
+                    # Прогресс запроса этого процесса уже пришёл событиями конвейера
+                    if not broker.is_local(channel_id):
+                        last_sent = loop.time()
+                        yield format_event("progress", data["progress"])
+            elif event == "done" and channel_id != request_id:
+                # Исходный запрос завершён: повтор либо уже получил его итог, либо
+                # отсоединён при отмене и обрабатывается сам — тогда слушаем его канал
+                current = await asyncio.to_thread(request_state, request_id)
+                if current is None:
+                    return
+                if current["status"] in TERMINAL_STATUSES:
+                    yield format_event("done", current)
+                    return
+                broker.unsubscribe(channel_id, queue)
+                channel_id = await asyncio.to_thread(request_channel, request_id)
+                broker.subscribe(channel_id, queue)
+            elif event is not None:
+                last_sent = loop.time()
+                yield format_event(event, data)
+                if event == "done":
+                    return
+
+            if loop.time() - last_sent >= EVENTS_KEEPALIVE_SECONDS:
+                last_sent = loop.time()
+                yield ": ping\n\n"
+    finally:
+        poller.unwatch(request_id, queue)
+        broker.unsubscribe(channel_id, queue)
@@ -5,6 +5,8 @@ from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 
+from backend.services.units import normalize_unit
+
 class ExcelBuilder:
     """Построитель Excel файлов"""
 
@@ -19,28 +21,14 @@ class ExcelBuilder:
     def create_list_workbook(self, data: List[Dict[str, Any]]) -> bytes:
         """Создать Excel файл с Перечнем работ и материалов"""
         
-        wb = Workbook()
-        
-        # Лист 1: Полный перечень
-        ws_all = wb.active
-        ws_all.title = "Перечень работ и материалов"
-        self._create_list_sheet(ws_all, data)
-        
-        # Лист 2: Только работы
-        works = [item for item in data if item.get('type') == 'Работа']
-        ws_works = wb.create_sheet("Перечень работ")
-        self._create_works_sheet(ws_works, works)
-        
-        # Лист 3: Только материалы
-        materials = [item for item in data if item.get('type') == 'Материал']
-        ws_materials = wb.create_sheet("Перечень материалов")
-        self._create_materials_sheet(ws_materials, materials)
-        
-        # Сохранить в памяти
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        return output.getvalue()
+        writer = self.list_workbook_writer()
+        for item in data:
+            writer.append(item)
+        return writer.finish()
+
+    def list_workbook_writer(self) -> "ListWorkbookWriter":
+        """Начать построчную запись Перечня (позиции добавляются по мере поступления)"""
+        return ListWorkbookWriter(self)
 
     def create_estimate_workbook(self, data: List[Dict[str, Any]]) -> bytes:
         """Создать Excel файл со сметой"""
@@ -71,7 +59,14 @@ class ExcelBuilder:
     def _create_list_sheet(self, ws, data: List[Dict[str, Any]]):
         """Создать лист с Перечнем"""
         
-        # Заголовок
+        self._start_list_sheet(ws)
+        for idx, item in enumerate(data, 1):
+            self._append_list_row(ws, idx, item)
+        self._finish_list_sheet(ws)
+
+    def _start_list_sheet(self, ws):
+        """Заголовок листа с Перечнем"""
+        
         headers = ["№ п/п", "Работа/Материал", "Наименование", "Ед. изм.", "Кол-во"]
         ws.append(headers)
         
@@ -80,26 +75,30 @@ class ExcelBuilder:
             cell.font = Font(bold=True)
             cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
             cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        
-        # Данные
-        for idx, item in enumerate(data, 1):
-            ws.append([
-                idx,
-                item.get('type', ''),
-                item.get('name', ''),
-                item.get('unit', ''),
-                item.get('quantity', '')
-            ])
-            
-            # Чередующаяся заливка
-            if idx % 2 == 0:
-                for cell in ws[idx + 1]:
-                    cell.fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
-            
-            # Границы
+
+    def _append_list_row(self, ws, idx: int, item: Dict[str, Any]):
+        """Добавить строку Перечня"""
+        
+        ws.append([
+            idx,
+            item.get('type', ''),
+            item.get('name', ''),
+            normalize_unit(item.get('unit')),
+            item.get('quantity', '')
+        ])
+        
+        # Чередующаяся заливка
+        if idx % 2 == 0:
             for cell in ws[idx + 1]:
-                cell.border = self.thin_border
-                cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+                cell.fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
+        
+        # Границы
+        for cell in ws[idx + 1]:
+            cell.border = self.thin_border
+            cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+
+    def _finish_list_sheet(self, ws):
+        """Ширина колонок и закрепление заголовка листа с Перечнем"""
         
         # Установить ширину колонок
         ws.column_dimensions['A'].width = 8
@@ -114,38 +113,22 @@ class ExcelBuilder:
     def _create_works_sheet(self, ws, data: List[Dict[str, Any]]):
         """Создать лист только с работами"""
         
-        headers = ["№ п/п", "Наименование", "Ед. изм.", "Кол-во"]
-        ws.append(headers)
-        
-        for cell in ws[1]:
-            cell.font = Font(bold=True)
-            cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        
+        self._start_simple_list_sheet(ws)
         for idx, item in enumerate(data, 1):
-            ws.append([
-                idx,
-                item.get('name', ''),
-                item.get('unit', ''),
-                item.get('quantity', '')
-            ])
-            
-            if idx % 2 == 0:
-                for cell in ws[idx + 1]:
-                    cell.fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
-            
-            for cell in ws[idx + 1]:
-                cell.border = self.thin_border
-        
-        ws.column_dimensions['A'].width = 8
-        ws.column_dimensions['B'].width = 45
-        ws.column_dimensions['C'].width = 12
-        ws.column_dimensions['D'].width = 12
-        ws.freeze_panes = "A2"
+            self._append_simple_list_row(ws, idx, item)
+        self._finish_simple_list_sheet(ws)
 
     def _create_materials_sheet(self, ws, data: List[Dict[str, Any]]):
         """Создать лист только с материалами"""
         
+        self._start_simple_list_sheet(ws)
+        for idx, item in enumerate(data, 1):
+            self._append_simple_list_row(ws, idx, item)
+        self._finish_simple_list_sheet(ws)
+
+    def _start_simple_list_sheet(self, ws):
+        """Заголовок листа работ/материалов"""
+        
         headers = ["№ п/п", "Наименование", "Ед. изм.", "Кол-во"]
         ws.append(headers)
         
@@ -153,21 +136,26 @@ class ExcelBuilder:
             cell.font = Font(bold=True)
             cell.fill = PatternFill(start_color="D3D3D3", end_color="D3D3D3", fill_type="solid")
             cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+
+    def _append_simple_list_row(self, ws, idx: int, item: Dict[str, Any]):
+        """Добавить строку на лист работ/материалов"""
         
-        for idx, item in enumerate(data, 1):
-            ws.append([
-                idx,
-                item.get('name', ''),
-                item.get('unit', ''),
-                item.get('quantity', '')
-            ])
-            
-            if idx % 2 == 0:
-                for cell in ws[idx + 1]:
-                    cell.fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
-            
+        ws.append([
+            idx,
+            item.get('name', ''),
+            normalize_unit(item.get('unit')),
+            item.get('quantity', '')
+        ])
+        
+        if idx % 2 == 0:
             for cell in ws[idx + 1]:
-                cell.border = self.thin_border
+                cell.fill = PatternFill(start_color="F0F0F0", end_color="F0F0F0", fill_type="solid")
+        
+        for cell in ws[idx + 1]:
+            cell.border = self.thin_border
+
+    def _finish_simple_list_sheet(self, ws):
+        """Ширина колонок и закрепление заголовка листа работ/материалов"""
         
         ws.column_dimensions['A'].width = 8
         ws.column_dimensions['B'].width = 45
@@ -209,7 +197,7 @@ class ExcelBuilder:
                 idx,
                 item.get('type', ''),
                 item.get('name', ''),
-                item.get('unit', ''),
+                normalize_unit(item.get('unit')),
                 item.get('quantity', ''),
                 item.get('price_work_per_unit', '') if item.get('type') == 'Работа' else '',
                 work_cost if item.get('type') == 'Работа' else '',
@@ -287,7 +275,7 @@ class ExcelBuilder:
             ws.append([
                 idx,
                 item.get('name', ''),
-                item.get('unit', ''),
+                normalize_unit(item.get('unit')),
                 item.get('quantity', ''),
                 item.get('price_work_per_unit', ''),
                 cost,
@@ -351,7 +339,7 @@ class ExcelBuilder:
             ws.append([
                 idx,
                 item.get('name', ''),
-                item.get('unit', ''),
+                normalize_unit(item.get('unit')),
                 item.get('quantity', ''),
                 item.get('price_material_per_unit', ''),
                 cost,
@@ -394,3 +382,54 @@ class ExcelBuilder:
         ws.column_dimensions['G'].width = 25
         ws.column_dimensions['H'].width = 20
         ws.freeze_panes = "A2"
+
+
+class ListWorkbookWriter:
+    """Построчная запись Перечня: строки попадают в книгу по мере разбора ответа Claude"""
+
+    def __init__(self, builder: ExcelBuilder):
+        self.builder = builder
+        self.wb = Workbook()
+        
+        # Лист 1: Полный перечень
+        self.ws_all = self.wb.active
+        self.ws_all.title = "Перечень работ и материалов"
+        builder._start_list_sheet(self.ws_all)
+        
+        # Лист 2: Только работы
+        self.ws_works = self.wb.create_sheet("Перечень работ")
+        builder._start_simple_list_sheet(self.ws_works)
+        
+        # Лист 3: Только материалы
+        self.ws_materials = self.wb.create_sheet("Перечень материалов")
+        builder._start_simple_list_sheet(self.ws_materials)
+        
+        self.count = 0
+        self.works_count = 0
+        self.materials_count = 0
+
+    def append(self, item: Dict[str, Any]):
+        """Добавить позицию на общий лист и на лист её типа"""
+        
+        self.count += 1
+        self.builder._append_list_row(self.ws_all, self.count, item)
+        
+        if item.get('type') == 'Работа':
+            self.works_count += 1
+            self.builder._append_simple_list_row(self.ws_works, self.works_count, item)
+        elif item.get('type') == 'Материал':
+            self.materials_count += 1
+            self.builder._append_simple_list_row(self.ws_materials, self.materials_count, item)
+
+    def finish(self) -> bytes:
+        """Завершить оформление листов и вернуть содержимое книги"""
+        
+        self.builder._finish_list_sheet(self.ws_all)
+        self.builder._finish_simple_list_sheet(self.ws_works)
+        self.builder._finish_simple_list_sheet(self.ws_materials)
+        
+        # Сохранить в памяти
+        output = io.BytesIO()
+        self.wb.save(output)
+        output.seek(0)
+        return output.getvalue()
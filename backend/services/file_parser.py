@@ -1,8 +1,9 @@
 import os
-import json
-import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterator, Optional, Tuple
 import pdfplumber
 import openpyxl
 from openpyxl import load_workbook
@@ -10,114 +11,340 @@ import pandas as pd
 from lxml import etree
 import zipfile
 
+from backend.services.parse_cache import get_parse_cache, file_sha256, json_safe
+from backend.services.units import normalize_unit
+
+# Версия формата результата парсинга — менять при изменении парсеров (инвалидирует кэш)
+PARSER_VERSION = "3"
+# Число процессов для параллельного извлечения текста из PDF (1 — последовательно)
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", "1"))
+# Размер диапазона страниц, обрабатываемого одной задачей пула
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Сколько символов содержимого файла попадает в промпт (ClaudeService._format_file_contents)
+PROMPT_FILE_CHARS = 2000
+# Лимит символов на файл: по умолчанию — сколько войдёт в промпт (0 — без ограничения)
+PARSE_MAX_CHARS = int(os.getenv("PARSE_MAX_CHARS", str(PROMPT_FILE_CHARS))) or None
+# Лимит строк Excel и записей XML на файл (0 — без ограничения): пустые значения
+# почти не занимают символов, и без него огромные разреженные таблицы читаются целиком
+PARSE_MAX_ROWS = int(os.getenv("PARSE_MAX_ROWS", "1000")) or None
+
+# Теги и атрибуты позиций ГрандСметы, из которых собираются плоские записи
+GS_POSITION_TAGS = {"Position", "Позиция", "Item"}
+GS_SECTION_TAGS = {"Chapter", "Section", "Раздел"}
+GS_FIELD_ATTRS = {
+    "code": ("Code", "Шифр", "Обоснование", "Justification"),
+    "name": ("Caption", "Name", "Наименование"),
+    "unit": ("Units", "Unit", "ЕдИзм", "Измеритель"),
+    "quantity": ("Quantity", "Количество", "Qty"),
+    "price": ("PriceCurrent", "Price", "Цена", "Стоимость"),
+}
+GS_QUANTITY_TAGS = ("Quantity", "Количество")
+GS_PRICE_TAGS = ("PriceCurrent", "Price", "Цена", "PriceBase")
+GS_VALUE_ATTRS = ("Result", "Total", "Value", "PZ")
+
+
+class ParseCancelled(Exception):
+    """Парсинг прерван: обработка запроса отменена"""
+
+
+def _check_cancelled(cancel: Optional[threading.Event]):
+    if cancel is not None and cancel.is_set():
+        raise ParseCancelled("Парсинг отменён")
+
+
+def _extract_pdf_pages(file_path: str, start: int, end: int) -> List[str]:
+    """Извлечь текст страниц [start, end) — выполняется в дочернем процессе"""
+    with pdfplumber.open(file_path) as pdf:
+        return [(pdf.pages[i].extract_text() or "") for i in range(start, end)]
+
+
 class FileParser:
     """Парсер для различных форматов файлов"""
 
     @staticmethod
-    def parse_pdf(file_path: str) -> str:
+    def iter_pdf_pages(
+        file_path: str,
+        workers: Optional[int] = None,
+        max_pages: Optional[int] = None,
+        max_chars: Optional[int] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> Iterator[str]:
+        """Постранично выдавать текст PDF с ранней остановкой по лимитам
+
+        cancel — событие отмены обработки: проверяется между страницами.
+        """
+        workers = workers or PDF_PARSE_WORKERS
+
+        with pdfplumber.open(file_path) as pdf:
+            page_count = len(pdf.pages)
+            if max_pages:
+                page_count = min(page_count, max_pages)
+
+            if workers <= 1 or page_count <= PDF_PAGES_PER_TASK:
+                chars = 0
+                for i in range(page_count):
+                    _check_cancelled(cancel)
+                    page_text = pdf.pages[i].extract_text() or ""
+                    yield page_text
+                    chars += len(page_text) + 1
+                    if max_chars and chars >= max_chars:
+                        return
+                return
+
+        # Параллельный режим: пул процессов по диапазонам страниц, результаты — в порядке страниц
+        ranges = [
+            (start, min(start + PDF_PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)
+        ]
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(ranges)))
+        try:
+            futures = [executor.submit(_extract_pdf_pages, file_path, start, end) for start, end in ranges]
+            chars = 0
+            for future in futures:
+                _check_cancelled(cancel)
+                for page_text in future.result():
+                    yield page_text
+                    chars += len(page_text) + 1
+                    if max_chars and chars >= max_chars:
+                        return
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def parse_pdf(
+        file_path: str,
+        workers: Optional[int] = None,
+        max_pages: Optional[int] = None,
+        max_chars: Optional[int] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> str:
         """Извлечь текст из PDF"""
         try:
-            text = ""
-            with pdfplumber.open(file_path) as pdf:
-                for page in pdf.pages:
-                    text += page.extract_text() + "\n"
-            return text
+            text = "".join(
+                page_text + "\n"
+                for page_text in FileParser.iter_pdf_pages(file_path, workers, max_pages, max_chars, cancel)
+            )
+            return text[:max_chars] if max_chars else text
+        except ParseCancelled:
+            raise
         except Exception as e:
             raise Exception(f"Ошибка при парсинге PDF: {str(e)}")
 
     @staticmethod
-    def parse_excel(file_path: str) -> Dict[str, Any]:
-        """Парсить Excel файл и вернуть структурированные данные"""
+    def iter_excel_rows(file_path: str, max_rows: Optional[int] = None) -> Iterator[tuple]:
+        """Лениво выдавать (лист, заголовки, строка) в режиме read-only (не более max_rows строк)"""
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        rows_total = 0
         try:
-            workbook = load_workbook(file_path)
-            result = {}
-            
             for sheet_name in workbook.sheetnames:
                 ws = workbook[sheet_name]
-                data = []
-                headers = []
-                
-                for idx, row in enumerate(ws.iter_rows(values_only=True)):
-                    if idx == 0:
+                headers = None
+                for row in ws.iter_rows(values_only=True):
+                    if headers is None:
+                        # Один общий список заголовков на лист
                         headers = [str(h) if h else f"Column_{i}" for i, h in enumerate(row)]
-                    else:
-                        row_data = {headers[i]: val for i, val in enumerate(row)}
-                        data.append(row_data)
-                
-                result[sheet_name] = {
-                    "headers": headers,
-                    "data": data
-                }
-            
+                        yield sheet_name, headers, None
+                        continue
+                    if all(val is None for val in row):
+                        continue
+                    if max_rows and rows_total >= max_rows:
+                        return
+                    rows_total += 1
+                    yield sheet_name, headers, row
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def parse_excel(
+        file_path: str,
+        max_rows: Optional[int] = None,
+        max_chars: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Парсить Excel файл и вернуть структурированные данные"""
+        try:
+            result = {}
+            rows_total = 0
+            chars = 0
+
+            with closing(FileParser.iter_excel_rows(file_path, max_rows)) as rows:
+                for sheet_name, headers, row in rows:
+                    sheet = result.setdefault(sheet_name, {"headers": headers, "rows": []})
+                    if row is None:
+                        continue
+
+                    # Компактная строка: кортеж значений в порядке общих заголовков
+                    sheet["rows"].append(tuple(row))
+                    rows_total += 1
+                    chars += sum(len(str(val)) for val in row if val is not None)
+                    if (max_rows and rows_total >= max_rows) or (max_chars and chars >= max_chars):
+                        sheet["truncated"] = True
+                        break
+
             return result
         except Exception as e:
             raise Exception(f"Ошибка при парсинге Excel: {str(e)}")
 
     @staticmethod
-    def parse_xml(file_path: str) -> Dict[str, Any]:
-        """Парсить XML файл (ГрандСмета)"""
+    def parse_xml(source, max_chars: Optional[int] = None, max_rows: Optional[int] = None) -> Dict[str, Any]:
+        """Парсить XML файл (ГрандСмета) — путь или файловый объект"""
         try:
-            tree = etree.parse(file_path)
-            root = tree.getroot()
-            
-            # Конвертировать XML в словарь
-            result = FileParser._xml_to_dict(root)
-            return result
+            positions = []
+            records = []
+            chars = 0
+            for kind, record in FileParser.iter_xml_records(source, max_rows):
+                if kind == "position":
+                    positions.append(record)
+                elif not positions:
+                    records.append(record)
+                chars += sum(len(str(val)) for val in record.values() if val is not None)
+                if max_chars and chars >= max_chars:
+                    break
+
+            # Для XML не в формате ГрандСметы — плоские записи листовых элементов
+            if positions:
+                return {"positions": positions}
+            return {"records": records}
         except Exception as e:
             raise Exception(f"Ошибка при парсинге XML: {str(e)}")
 
     @staticmethod
-    def parse_gsn(file_path: str) -> Dict[str, Any]:
+    def iter_xml_records(source, max_rows: Optional[int] = None) -> Iterator[tuple]:
+        """Потоково (iterparse) выдавать позиции ГрандСметы без построения всего дерева
+
+        max_rows ограничивает число выданных позиций и записей — остаток файла не читается.
+        """
+        context = etree.iterparse(
+            source,
+            events=("start", "end"),
+            huge_tree=True,
+            resolve_entities=False,
+            no_network=True,
+        )
+        path = []
+        sections = []
+        position_depth = 0
+        emitted = 0
+
+        for event, elem in context:
+            tag = etree.QName(elem).localname if isinstance(elem.tag, str) else ""
+
+            if event == "start":
+                path.append(tag)
+                if tag in GS_POSITION_TAGS:
+                    position_depth += 1
+                elif tag in GS_SECTION_TAGS and not position_depth:
+                    sections.append(FileParser._gs_attr(elem, GS_FIELD_ATTRS["name"]))
+                continue
+
+            if tag in GS_POSITION_TAGS:
+                position_depth -= 1
+                if not position_depth:
+                    if max_rows and emitted >= max_rows:
+                        return
+                    emitted += 1
+                    yield "position", FileParser._gs_position_record(elem, sections)
+            elif tag in GS_SECTION_TAGS and not position_depth and sections:
+                sections.pop()
+            elif not position_depth and len(elem) == 0:
+                text = elem.text.strip() if elem.text else ""
+                if text or elem.attrib:
+                    if max_rows and emitted >= max_rows:
+                        return
+                    emitted += 1
+                    record = {"path": "/".join(path)}
+                    record.update(elem.attrib)
+                    if text:
+                        record["text"] = text
+                    yield "record", record
+
+            path.pop()
+            # Освободить обработанные элементы (кроме содержимого незавершённой позиции)
+            if not position_depth:
+                elem.clear()
+                parent = elem.getparent()
+                while parent is not None and elem.getprevious() is not None:
+                    del parent[0]
+
+    @staticmethod
+    def _gs_position_record(elem, sections: List[str]) -> Dict[str, Any]:
+        """Собрать плоскую запись позиции (шифр, наименование, ед. изм., кол-во, цена)"""
+        record = {
+            "section": sections[-1] if sections else None,
+            "code": FileParser._gs_attr(elem, GS_FIELD_ATTRS["code"]),
+            "name": FileParser._gs_attr(elem, GS_FIELD_ATTRS["name"]),
+            "unit": normalize_unit(FileParser._gs_attr(elem, GS_FIELD_ATTRS["unit"])) or None,
+            "quantity": FileParser._gs_attr(elem, GS_FIELD_ATTRS["quantity"]),
+            "price": FileParser._gs_attr(elem, GS_FIELD_ATTRS["price"]),
+        }
+
+        # Количество и цена часто вынесены в дочерние элементы (<Quantity Result=...>, <PriceCurrent .../>)
+        for child in elem:
+            if not isinstance(child.tag, str):
+                continue
+            child_tag = etree.QName(child).localname
+            if record["quantity"] is None and child_tag in GS_QUANTITY_TAGS:
+                record["quantity"] = FileParser._gs_value(child)
+            elif record["price"] is None and child_tag in GS_PRICE_TAGS:
+                record["price"] = FileParser._gs_value(child)
+
+        for field in ("quantity", "price"):
+            record[field] = FileParser._to_number(record[field])
+        return record
+
+    @staticmethod
+    def _gs_attr(elem, names) -> Optional[str]:
+        """Первое непустое значение атрибута из списка синонимов"""
+        for name in names:
+            value = elem.get(name)
+            if value:
+                return value.strip()
+        return None
+
+    @staticmethod
+    def _gs_value(elem) -> Optional[str]:
+        """Значение элемента количества/цены: атрибут-результат или текст"""
+        value = FileParser._gs_attr(elem, GS_VALUE_ATTRS)
+        if value is None and elem.text and elem.text.strip():
+            value = elem.text.strip()
+        return value
+
+    @staticmethod
+    def _to_number(value):
+        """Привести строковое число (в т.ч. с запятой) к float"""
+        if value is None:
+            return None
+        try:
+            return float(str(value).replace(" ", "").replace(",", "."))
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _pick_gsn_member(members: List[zipfile.ZipInfo]) -> zipfile.ZipInfo:
+        """Выбрать основной XML с данными сметы внутри GSN архива"""
+        xml_members = [m for m in members if not m.is_dir() and m.filename.lower().endswith(".xml")]
+        if not xml_members:
+            raise Exception("XML файлы не найдены в GSN архиве")
+
+        # Сначала известные имена основного файла, затем самый крупный XML
+        preferred = ("main.xml", "content.xml", "data.xml", "smeta.xml")
+        for name in preferred:
+            for member in xml_members:
+                if Path(member.filename).name.lower() == name:
+                    return member
+        return max(xml_members, key=lambda m: m.file_size)
+
+    @staticmethod
+    def parse_gsn(file_path: str, max_chars: Optional[int] = None, max_rows: Optional[int] = None) -> Dict[str, Any]:
         """Парсить GSN файл (ГрандСмета, zip архив)"""
         try:
-            # GSN - это ZIP архив с XML файлами
-            with tempfile.TemporaryDirectory() as tmpdir:
-                with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                    zip_ref.extractall(tmpdir)
-                
-                # Найти XML файл с данными (обычно main.xml или content.xml)
-                xml_files = list(Path(tmpdir).glob("**/*.xml"))
-                if not xml_files:
-                    raise Exception("XML файлы не найдены в GSN архиве")
-                
-                # Парсить первый найденный XML
-                result = FileParser.parse_xml(str(xml_files[0]))
-                return result
+            # GSN - это ZIP архив с XML файлами; читаем член архива потоком, без распаковки на диск
+            with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                member = FileParser._pick_gsn_member(zip_ref.infolist())
+                with zip_ref.open(member) as xml_stream:
+                    return FileParser.parse_xml(xml_stream, max_chars=max_chars, max_rows=max_rows)
         except Exception as e:
             raise Exception(f"Ошибка при парсинге GSN: {str(e)}")
 
-    @staticmethod
-    def _xml_to_dict(element) -> Dict[str, Any]:
-        """Рекурсивно конвертировать XML элемент в словарь"""
-        result = {}
-        
-        # Атрибуты
-        if element.attrib:
-            result['@attributes'] = element.attrib
-        
-        # Дочерние элементы
-        children = {}
-        for child in element:
-            child_data = FileParser._xml_to_dict(child)
-            if child.tag in children:
-                if not isinstance(children[child.tag], list):
-                    children[child.tag] = [children[child.tag]]
-                children[child.tag].append(child_data)
-            else:
-                children[child.tag] = child_data
-        
-        if children:
-            result.update(children)
-        
-        # Текстовое содержимое
-        if element.text and element.text.strip():
-            if children or element.attrib:
-                result['#text'] = element.text.strip()
-            else:
-                return element.text.strip()
-        
-        return result if result else None
-
     @staticmethod
     def detect_file_type(file_name: str) -> str:
         """Определить тип файла по расширению"""
@@ -135,36 +362,83 @@ class FileParser:
             return "unknown"
 
     @staticmethod
-    def parse_file(file_path: str) -> Dict[str, Any]:
-        """Парсить файл в зависимости от типа"""
+    def parse_file(
+        file_path: str,
+        max_chars: Optional[int] = PARSE_MAX_CHARS,
+        cancel: Optional[threading.Event] = None,
+        max_rows: Optional[int] = PARSE_MAX_ROWS,
+    ) -> Dict[str, Any]:
+        """Парсить файл в зависимости от типа (с кэшем по содержимому)"""
+        return FileParser.parse_file_with_key(file_path, max_chars, cancel, max_rows)[1]
+
+    @staticmethod
+    def parse_file_with_key(
+        file_path: str,
+        max_chars: Optional[int] = PARSE_MAX_CHARS,
+        cancel: Optional[threading.Event] = None,
+        max_rows: Optional[int] = PARSE_MAX_ROWS,
+    ) -> Tuple[Optional[str], Dict[str, Any]]:
+        """Как parse_file, но вместе с ключом кэша, под которым лежит результат
+
+        Результат всегда из JSON-примитивов (см. json_safe), с кэшем и без.
+        Ключ None — результата в кэше нет (кэш отключён или запись не удалась).
+        """
         file_type = FileParser.detect_file_type(file_path)
-        
+        cache = get_parse_cache() if file_type != "unknown" else None
+        if cache is None:
+            return None, json_safe(FileParser._parse_by_type(file_path, file_type, max_chars, cancel, max_rows))
+
+        key = cache.make_key(
+            file_sha256(file_path), file_type, PARSER_VERSION, {"max_chars": max_chars, "max_rows": max_rows}
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return key, cached
+
+        # Свежий результат и результат из кэша должны совпадать до типов значений
+        result = json_safe(FileParser._parse_by_type(file_path, file_type, max_chars, cancel, max_rows))
+        try:
+            cache.put(key, result)
+        except OSError:
+            # Кэш — оптимизация: ошибка записи не должна ронять обработку
+            return None, result
+        return key, result
+
+    @staticmethod
+    def _parse_by_type(
+        file_path: str,
+        file_type: str,
+        max_chars: Optional[int],
+        cancel: Optional[threading.Event] = None,
+        max_rows: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Парсить файл известного типа без кэша"""
         if file_type == "pdf":
-            text = FileParser.parse_pdf(file_path)
+            text = FileParser.parse_pdf(file_path, max_chars=max_chars, cancel=cancel)
             return {
                 "type": "pdf",
                 "content": text,
                 "text": text
             }
         elif file_type == "excel":
-            data = FileParser.parse_excel(file_path)
+            data = FileParser.parse_excel(file_path, max_rows=max_rows, max_chars=max_chars)
             return {
                 "type": "excel",
                 "content": data,
                 "sheets": data
             }
         elif file_type == "xml":
-            data = FileParser.parse_xml(file_path)
+            data = FileParser.parse_xml(file_path, max_chars=max_chars, max_rows=max_rows)
             return {
                 "type": "xml",
-                "content": json.dumps(data, ensure_ascii=False, indent=2),
+                "content": data,
                 "data": data
             }
         elif file_type == "gsn":
-            data = FileParser.parse_gsn(file_path)
+            data = FileParser.parse_gsn(file_path, max_chars=max_chars, max_rows=max_rows)
             return {
                 "type": "gsn",
-                "content": json.dumps(data, ensure_ascii=False, indent=2),
+                "content": data,
                 "data": data
             }
         else:
@@ -0,0 +1,230 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import aliased
+
+from backend.database import SessionLocal
+from backend.models import Batch, Job, Request
+from backend.services.coalesce import settle_duplicates
+
+logger = logging.getLogger(__name__)
+
+# На сколько секунд задача закрепляется за воркером; продлевается heartbeat-ом
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+# Сколько раз запускать задачу, если воркер пропал во время обработки
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+
+def enqueue_job(db, request_id: int, payload: Dict[str, Any], batch_id: Optional[int] = None) -> Job:
+    """Поставить обработку запроса в очередь (в текущей транзакции)"""
+    job = Job(request_id=request_id, batch_id=batch_id, status="queued", payload=payload, max_attempts=JOB_MAX_ATTEMPTS)
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def claim_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """Взять следующую задачу из очереди
+
+    Строка блокируется FOR UPDATE SKIP LOCKED, поэтому несколько воркеров
+    разбирают очередь параллельно, не получая одну задачу дважды. Задачи пакета,
+    у которого уже выполняется max_concurrency запросов, пропускаются — пакет
+    не занимает все воркеры и не выбирает бюджет Claude целиком.
+    """
+    db = SessionLocal()
+    try:
+        running = aliased(Job)
+        running_in_batch = (
+            select(func.count(running.id))
+            .where(running.batch_id == Job.batch_id, running.status == "running")
+            .scalar_subquery()
+        )
+        batch_limit = select(Batch.max_concurrency).where(Batch.id == Job.batch_id).scalar_subquery()
+        job = (
+            db.query(Job)
+            .filter(Job.status == "queued", or_(Job.batch_id.is_(None), running_in_batch < batch_limit))
+            .order_by(Job.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if job is None:
+            db.rollback()
+            return None
+        if job.batch_id is not None and not _batch_has_slot(db, job.batch_id):
+            # Слот пакета только что занял другой воркер
+            db.rollback()
+            return None
+        now = datetime.utcnow()
+        job.status = "running"
+        job.worker_id = worker_id
+        job.attempts = (job.attempts or 0) + 1
+        job.started_at = now
+        job.heartbeat_at = now
+        job.lease_expires_at = now + timedelta(seconds=JOB_LEASE_SECONDS)
+        db.commit()
+        return {"id": job.id, "request_id": job.request_id, "payload": job.payload, "attempts": job.attempts}
+    finally:
+        db.close()
+
+
+def _batch_has_slot(db, batch_id: int) -> bool:
+    """Перепроверить лимит пакета под блокировкой строки пакета (заявки на слоты по очереди)"""
+    batch = db.query(Batch).filter(Batch.id == batch_id).with_for_update().first()
+    if batch is None:
+        return True
+    running = db.query(func.count(Job.id)).filter(Job.batch_id == batch_id, Job.status == "running").scalar()
+    return running < (batch.max_concurrency or 1)
+
+
+def heartbeat_job(job_id: int, worker_id: str) -> bool:
+    """Продлить аренду задачи; False — задача уже не принадлежит этому воркеру"""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        updated = (
+            db.query(Job)
+            .filter(Job.id == job_id, Job.worker_id == worker_id, Job.status == "running")
+            .update(
+                {Job.heartbeat_at: now, Job.lease_expires_at: now + timedelta(seconds=JOB_LEASE_SECONDS)},
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        return updated == 1
+    finally:
+        db.close()
+
+
+def finish_job(job_id: int, worker_id: str, error: Optional[str] = None):
+    """Отметить задачу выполненной (или упавшей) — если она всё ещё за этим воркером"""
+    db = SessionLocal()
+    try:
+        db.query(Job).filter(Job.id == job_id, Job.worker_id == worker_id, Job.status == "running").update(
+            {
+                Job.status: "failed" if error else "done",
+                Job.error_message: error,
+                Job.finished_at: datetime.utcnow(),
+                Job.lease_expires_at: None,
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def requeue_expired_jobs() -> int:
+    """Вернуть в очередь задачи, чей воркер перестал присылать heartbeat
+
+    Если попытки исчерпаны, задача и запрос помечаются ошибкой, а не висят в обработке.
+    """
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        expired = (
+            db.query(Job)
+            .filter(Job.status == "running", Job.lease_expires_at < now)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        failed = []
+        for job in expired:
+            if (job.attempts or 0) < (job.max_attempts or JOB_MAX_ATTEMPTS):
+                logger.warning("Задача %s: воркер %s пропал, возврат в очередь", job.id, job.worker_id)
+                job.status = "queued"
+                job.worker_id = None
+                job.lease_expires_at = None
+                continue
+            logger.error("Задача %s: попытки исчерпаны", job.id)
+            job.status = "failed"
+            job.error_message = "Обработка прервана: воркер остановился"
+            job.finished_at = now
+            request_record = db.query(Request).filter(Request.id == job.request_id).first()
+            if request_record and request_record.status == "processing":
+                request_record.status = "error"
+                request_record.error_message = job.error_message
+                failed.append(request_record)
+        db.commit()
+        # Присоединённые повторы ждут исходный запрос — передаём им ошибку
+        for request_record in failed:
+            settle_duplicates(db, request_record)
+        return len(expired)
+    finally:
+        db.close()
+
+
+def cancel_jobs(db, request_id: int) -> List[Dict[str, Any]]:
+    """Отменить незавершённые задачи запроса
+
+    Выполняющуюся задачу воркер прервёт при ближайшем heartbeat (или сразу, если она
+    идёт в этом процессе). Возвращает параметры задач, которые ещё не начинались, —
+    их загруженные файлы больше никому не нужны.
+    """
+    jobs = (
+        db.query(Job)
+        .filter(Job.request_id == request_id, Job.status.in_(("queued", "running")))
+        .with_for_update()
+        .all()
+    )
+    not_started = [job.payload or {} for job in jobs if job.status == "queued"]
+    now = datetime.utcnow()
+    for job in jobs:
+        job.status = "cancelled"
+        job.finished_at = now
+        job.lease_expires_at = None
+    db.commit()
+    return not_started
+
+
+def detach_duplicates(db, request_id: int) -> Optional[int]:
+    """Отсоединить повторы отменённого запроса, чтобы их обработка продолжилась
+
+    Повторы могут принадлежать другим пользователям, поэтому отмена исходного запроса
+    на них не распространяется: старший повтор становится самостоятельным запросом со
+    своей задачей (файлы те же — они хранятся по хэшу содержимого), остальные повторы
+    присоединяются к нему. Возвращает id нового исходного запроса.
+    """
+    duplicates = (
+        db.query(Request)
+        .filter(Request.duplicate_of == request_id, Request.status == "processing")
+        .order_by(Request.id)
+        .all()
+    )
+    if not duplicates:
+        return None
+    last_job = db.query(Job).filter(Job.request_id == request_id).order_by(Job.id.desc()).first()
+    original_files = ((last_job.payload or {}) if last_job else {}).get("temp_files", {})
+
+    promoted = duplicates[0]
+    by_hash = {Path(path).stem: path for path in original_files.values()}
+    uploads = promoted.uploaded_files or []
+    if uploads and all(upload.get("sha256") in by_hash for upload in uploads):
+        # Имена файлов — как их загрузил владелец повтора
+        temp_files = {upload["name"]: by_hash[upload["sha256"]] for upload in uploads}
+    else:
+        temp_files = original_files
+
+    promoted.duplicate_of = None
+    for duplicate in duplicates[1:]:
+        duplicate.duplicate_of = promoted.id
+    # Задача ставится до освобождения загрузок отменённого запроса — release_uploads их не удалит
+    enqueue_job(db, promoted.id, {
+        "temp_files": temp_files,
+        "outputs": promoted.requested_outputs,
+        "user_comment": promoted.user_comment,
+        "bypass_cache": False,
+    }, batch_id=promoted.batch_id)
+    logger.info("Запрос %s отменён: повтор %s продолжает обработку сам", request_id, promoted.id)
+    return promoted.id
+
+
+def queue_stats(db) -> Dict[str, int]:
+    """Число задач по статусам"""
+    counts = dict(db.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    return {status: counts.get(status, 0) for status in ("queued", "running", "done", "failed", "cancelled")}
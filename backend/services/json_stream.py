@@ -0,0 +1,183 @@
+import json
+from typing import Any, List, Optional, Tuple
+
+WHITESPACE = " \t\r\n"
+
+
+class JSONArrayStream:
+    """Инкрементальный разбор элементов JSON-массива по мере поступления текста"""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item_start: Optional[int] = None
+        self._array_start = 0
+        self.done = False
+        self.items_count = 0
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    def copy(self) -> "JSONArrayStream":
+        """Независимая копия состояния разбора (для повторной подачи того же ответа)"""
+        clone = JSONArrayStream()
+        clone.__dict__.update({key: value for key, value in self.__dict__.items() if key != "_decoder"})
+        return clone
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Добавить фрагмент текста и вернуть элементы массива, закрывшиеся в нём"""
+        if self.done:
+            return []
+        self._buffer += chunk
+        items = []
+        buffer = self._buffer
+        i = self._pos
+        while True:
+            try:
+                i = self._scan(buffer, i, items)
+                break
+            except json.JSONDecodeError:
+                if self.items_count or items:
+                    raise
+                # Скобка из преамбулы ("[см. ниже]") — ищем массив со следующей "["
+                i = self._array_start + 1
+                self._started = False
+                self._depth = 0
+                self._in_string = self._escape = False
+                self._item_start = None
+
+        # Отбросить уже разобранный префикс, чтобы буфер не рос; до первого элемента
+        # текст держится с открывающей скобки — на случай, если она окажется не той
+        cut = self._item_start if self._item_start is not None else i
+        if self._started and not self.done and not self.items_count and not items:
+            cut = min(cut, self._array_start)
+        self._buffer = buffer[cut:]
+        self._pos = i - cut
+        self._array_start -= cut
+        if self._item_start is not None:
+            self._item_start -= cut
+        self.items_count += len(items)
+        return items
+
+    def _scan(self, buffer: str, i: int, items: List[Any]) -> int:
+        """Разобрать buffer с позиции i, дописывая закрывшиеся элементы в items; вернуть позицию остановки"""
+        while i < len(buffer):
+            char = buffer[i]
+
+            if not self._started:
+                # Пропускаем преамбулу ответа до открывающей скобки массива
+                if char == "[":
+                    self._started = True
+                    self._array_start = i
+                i += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 0:
+                        items.append(self._decode(buffer, i + 1))
+                i += 1
+                continue
+
+            if self._depth == 0 and char in '"[{' and self._item_start is not None:
+                # Новое значение без запятой после предыдущего — это не JSON-массив
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, i)
+            if char == '"':
+                self._in_string = True
+                if self._depth == 0:
+                    self._item_start = i
+            elif char in "[{":
+                if self._depth == 0:
+                    self._item_start = i
+                self._depth += 1
+            elif char in "]}":
+                if self._depth == 0:
+                    # Закрытие самого массива (с возможным скаляром перед ним)
+                    if self._item_start is not None:
+                        items.append(self._decode(buffer, i))
+                    self.done = True
+                    return i + 1
+                self._depth -= 1
+                if self._depth == 0:
+                    items.append(self._decode(buffer, i + 1))
+            elif self._depth == 0:
+                if char == ",":
+                    if self._item_start is not None:
+                        items.append(self._decode(buffer, i))
+                elif char not in WHITESPACE and self._item_start is None:
+                    # Начало скаляра верхнего уровня (число, true/false/null)
+                    self._item_start = i
+            i += 1
+        return i
+
+    def _decode(self, buffer: str, end: int) -> Any:
+        """Декодировать завершённый элемент buffer[item_start:end]"""
+        raw = buffer[self._item_start:end].strip()
+        self._item_start = None
+        value, _ = self._decoder.raw_decode(raw)
+        return value
+
+
+def decode_json_text(text: str) -> Tuple[Any, bool]:
+    """Найти JSON в ответе модели: (значение, получен ли он целиком)
+
+    Границы JSON ищутся с учётом строковых литералов, значение декодируется raw_decode.
+    Если ответ обрезан внутри массива, возвращаются все его завершённые элементы и флаг False.
+    """
+    decoder = json.JSONDecoder()
+    idx = _next_json_start(text, 0)
+    while idx != -1:
+        if _find_json_end(text, idx) is None:
+            # Текст кончился раньше закрывающей скобки — ответ обрезан
+            if text[idx] == "[":
+                parser = JSONArrayStream()
+                return parser.feed(text[idx:]), False
+            raise ValueError("JSON-объект в ответе обрезан")
+        try:
+            value, _ = decoder.raw_decode(text, idx)
+            return value, True
+        except json.JSONDecodeError:
+            # Скобка из преамбулы ("[см. ниже]") — пробуем следующую
+            idx = _next_json_start(text, idx + 1)
+    raise ValueError("JSON не найден в ответе")
+
+
+def _next_json_start(text: str, start: int) -> int:
+    positions = [pos for pos in (text.find("[", start), text.find("{", start)) if pos != -1]
+    return min(positions) if positions else -1
+
+
+def _find_json_end(text: str, start: int) -> Optional[int]:
+    """Позиция после скобки, закрывающей значение с text[start]; None, если текст обрывается"""
+    depth = 0
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "[{":
+            depth += 1
+        elif char in "]}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
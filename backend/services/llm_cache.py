@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from backend.database import SessionLocal
+from backend.models import LLMCacheEntry
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+
+
+class LLMCache:
+    """Кэш ответов Claude в базе данных с TTL и ограничением числа записей"""
+
+    def __init__(self, ttl_hours: float = LLM_CACHE_TTL_HOURS, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_entries = max_entries
+
+    @staticmethod
+    def make_key(model: str, max_tokens: int, prompt) -> str:
+        """Отпечаток запроса: модель + max_tokens + хэш промпта"""
+        raw = json.dumps([model, max_tokens, prompt], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Вернуть сохранённый ответ или None (просроченные записи удаляются)"""
+        db = SessionLocal()
+        try:
+            entry = db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key).first()
+            if entry is None:
+                return None
+            now = datetime.utcnow()
+            if entry.created_at and entry.created_at < now - self.ttl:
+                db.delete(entry)
+                db.commit()
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_used_at = now
+            db.commit()
+            return entry.response
+        except Exception as e:
+            # Кэш — оптимизация: ошибка чтения равна промаху, запрос уйдёт в Claude
+            logger.warning("Не удалось прочитать кэш ответов: %s", e)
+            db.rollback()
+            return None
+        finally:
+            db.close()
+
+    def put(self, key: str, model: str, response: str):
+        """Сохранить ответ и вытеснить просроченные/лишние записи"""
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            db.merge(LLMCacheEntry(
+                key=key,
+                model=model,
+                response=response,
+                size=len(response),
+                hits=0,
+                created_at=now,
+                last_used_at=now
+            ))
+            db.commit()
+            self._evict(db)
+        except Exception:
+            # Параллельная запись того же ключа — не ошибка для кэша
+            db.rollback()
+        finally:
+            db.close()
+
+    def _evict(self, db):
+        """Удалить записи старше TTL и самые давно использованные сверх лимита"""
+        db.query(LLMCacheEntry).filter(
+            LLMCacheEntry.created_at < datetime.utcnow() - self.ttl
+        ).delete(synchronize_session=False)
+
+        overflow = db.query(LLMCacheEntry).count() - self.max_entries
+        if overflow > 0:
+            stale_keys = [
+                key for (key,) in db.query(LLMCacheEntry.key)
+                .order_by(LLMCacheEntry.last_used_at.asc())
+                .limit(overflow)
+            ]
+            db.query(LLMCacheEntry).filter(
+                LLMCacheEntry.key.in_(stale_keys)
+            ).delete(synchronize_session=False)
+        db.commit()
+
+
+_llm_cache: Optional[LLMCache] = None
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """Общий для процесса кэш ответов (None, если отключён)"""
+    global _llm_cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _llm_cache is None:
+        _llm_cache = LLMCache()
+    return _llm_cache
@@ -0,0 +1,146 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+PARSE_CACHE_ENABLED = os.getenv("PARSE_CACHE_ENABLED", "true").lower() == "true"
+PARSE_CACHE_DIR = Path(os.getenv("PARSE_CACHE_DIR", "/data/parse_cache"))
+PARSE_CACHE_MAX_MB = int(os.getenv("PARSE_CACHE_MAX_MB", "512"))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_path: str) -> str:
+    """Посчитать SHA-256 содержимого файла блоками"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def json_safe(value: Any) -> Any:
+    """Привести результат парсинга к JSON-примитивам — ровно к тому, что вернёт кэш
+
+    Кортежи строк Excel становятся списками, даты и Decimal — строками.
+    """
+    return json.loads(json.dumps(value, ensure_ascii=False, default=str))
+
+
+class ParseCache:
+    """Дисковый кэш результатов парсинга по хэшу содержимого с LRU-вытеснением"""
+
+    def __init__(self, cache_dir: Path = PARSE_CACHE_DIR, max_bytes: int = PARSE_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(file_hash: str, file_type: str, parser_version: str, options: Optional[Dict[str, Any]] = None) -> str:
+        """Ключ кэша: хэш файла + версия парсера + параметры парсинга"""
+        raw = json.dumps([file_hash, file_type, parser_version, options or {}], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Вернуть закэшированную структуру или None"""
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._count("misses")
+            return None
+
+        # Обновить время доступа для LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count("hits")
+        return value
+
+    def has(self, key: str) -> bool:
+        """Есть ли запись (без чтения и без учёта в статистике)"""
+        return self._entry_path(key).exists()
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Сохранить структуру атомарно и вытеснить старые записи при превышении лимита"""
+        path = self._entry_path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика кэша: попадания, промахи, размер"""
+        hits = self._counter_value("hits")
+        misses = self._counter_value("misses")
+        entries = list(self._iter_entries())
+        total = hits + misses
+        return {
+            "enabled": True,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(100 * hits / total, 2) if total > 0 else 0,
+            "entries": len(entries),
+            "size_mb": round(sum(size for _, size, _ in entries) / (1024 * 1024), 2),
+            "max_size_mb": round(self.max_bytes / (1024 * 1024), 2),
+        }
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _iter_entries(self):
+        """(путь, размер, время доступа) для всех записей кэша"""
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".json"):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime
+
+    def _evict(self):
+        """Удалить давно не использованные записи, пока кэш больше лимита"""
+        entries = list(self._iter_entries())
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _count(self, name: str):
+        """Счётчик через дозапись байта: безопасно для нескольких процессов"""
+        try:
+            fd = os.open(self.cache_dir / f"_{name}.cnt", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, b".")
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+    def _counter_value(self, name: str) -> int:
+        try:
+            return (self.cache_dir / f"_{name}.cnt").stat().st_size
+        except FileNotFoundError:
+            return 0
+
+
+_parse_cache: Optional[ParseCache] = None
+
+
+def get_parse_cache() -> Optional[ParseCache]:
+    """Общий для процесса кэш парсинга (None, если отключён)"""
+    global _parse_cache
+    if not PARSE_CACHE_ENABLED:
+        return None
+    if _parse_cache is None:
+        _parse_cache = ParseCache()
+    return _parse_cache
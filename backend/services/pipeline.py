@@ -0,0 +1,376 @@
+import time
+import asyncio
+import json
+import threading
+from typing import Optional, Tuple
+from datetime import datetime
+from pathlib import Path
+
+from backend.database import SessionLocal
+from backend.models import Request, OutputFile
+from backend.services.file_parser import FileParser
+from backend.services.parse_cache import get_parse_cache
+from backend.services.claude_service import ClaudeService
+from backend.services.excel_builder import ExcelBuilder
+from backend.services.pdf_builder import PDFBuilder
+from backend.services.stage_graph import StageGraph, StageError
+from backend.services.pricelist_store import get_pricelist_store
+from backend.services.pricelist_index import get_index, select_candidates
+from backend.services.price_matcher import PRICE_MATCH_ENABLED, PriceMatcher, merge_estimate
+from backend.services.units import normalize_units, same_unit
+from backend.services.uploads import release_uploads
+from backend.services.checkpoints import load_checkpoints, save_checkpoint
+from backend.services.coalesce import settle_duplicates
+from backend.services import events
+
+RESULTS_DIR = Path("/data/results")
+RESULTS_DIR.mkdir(exist_ok=True)
+
+# Как часто (сек) сохранять в БД счётчик полученных позиций
+PROGRESS_COMMIT_INTERVAL = 1.0
+
+
+def _set_progress(db, request_record, progress: dict):
+    """Сохранить прогресс запроса и разослать его подписчикам потока событий"""
+    request_record.progress = progress
+    db.commit()
+    events.publish(request_record.id, "progress", progress)
+
+
+def _progress_callback(db, request_record, stage: str, on_item=None):
+    """Счётчик позиций, приходящих из потока Claude, с редкими записями в БД"""
+    state = {"items": 0, "committed_at": 0.0}
+
+    def callback(item):
+        if on_item:
+            on_item(item)
+        state["items"] += 1
+        now = time.monotonic()
+        if now - state["committed_at"] >= PROGRESS_COMMIT_INTERVAL:
+            _set_progress(db, request_record, {"stage": stage, "items": state["items"]})
+            state["committed_at"] = now
+
+    return callback
+
+
+def _pricelist_head(pricelist) -> Tuple[str, int]:
+    """Начало прайса для кэшируемого префикса промпта и число вошедших в него строк"""
+    if pricelist is None:
+        return "", 0
+    return pricelist.head()
+
+
+def _pricelist_candidates(pricelist, list_data, skip: int = 0) -> str:
+    """Текст прайса для промпта: только подходящие к позициям Перечня строки сверх первых skip"""
+    if pricelist is None:
+        return "(прайс-лист не найден)"
+    rows = select_candidates(list_data if isinstance(list_data, list) else [], pricelist, skip=skip)
+    if not rows:
+        return "(подходящих позиций в прайсе нет)" if not skip else "(других подходящих позиций нет)"
+    return pricelist.to_text(rows=rows)
+
+
+def _drop_spurious_unit_discrepancies(comparison):
+    """Убрать «расхождения» единиц, которые совпадают после нормализации (м2 и кв.м)"""
+    if isinstance(comparison, dict) and isinstance(comparison.get("unit_discrepancies"), list):
+        comparison["unit_discrepancies"] = [
+            item for item in comparison["unit_discrepancies"]
+            if not isinstance(item, dict) or not item.get("project_unit")
+            or not same_unit(item.get("project_unit"), item.get("estimate_unit"))
+        ]
+    return comparison
+
+
+# Этапы, создающие результирующие файлы: их сохранённый результат — {ключ: файл}
+OUTPUT_STAGES = ("list_excel", "estimate_excel", "comparison_pdf")
+
+
+def build_stage_graph(
+    db,
+    request_record,
+    temp_files: dict,
+    outputs: list,
+    user_comment,
+    bypass_cache: bool = False,
+    checkpoints: dict = None,
+):
+    """Объявить этапы обработки запроса; возвращает граф и словарь результирующих файлов
+
+    checkpoints — сохранённые результаты этапов прошлого запуска: файлы, созданные
+    тогда, сразу попадают в результат.
+    """
+    request_id = request_record.id
+    checkpoints = checkpoints or {}
+    claude_service = ClaudeService(use_cache=not bypass_cache)
+    output_files = {}
+    for stage in OUTPUT_STAGES:
+        output_files.update(checkpoints.get(stage) or {})
+    # Строки Перечня пишутся в книгу по мере потокового разбора ответа
+    list_writer = ExcelBuilder().list_workbook_writer() if "list" in outputs else None
+    if list_writer and "list_llm" in checkpoints and "list_excel" not in checkpoints:
+        # Перечень получен в прошлый раз — книга собирается из сохранённых позиций
+        for item in checkpoints["list_llm"]:
+            list_writer.append(item)
+
+    def save_output(key: str, file_name: str, content: bytes, file_type: str):
+        # Имя содержит id запроса: параллельные запросы пакета пишут в общий RESULTS_DIR
+        path = RESULTS_DIR / file_name
+        path.write_bytes(content)
+        output_files[key] = {"name": file_name, "path": str(path), "type": file_type}
+        db.add(OutputFile(request_id=request_id, file_name=file_name, file_path=str(path), file_type=file_type))
+        db.commit()
+        return {key: output_files[key]}
+
+    # Разобранные в этом запуске файлы; в контрольной точке — только ключи кэша парсинга
+    parsed_files = {}
+
+    async def parse(results):
+        file_parser = FileParser()
+        cancel = threading.Event()
+
+        async def parse_one(file_name, file_path):
+            try:
+                # Парсинг — блокирующая работа, выносим из event loop
+                key, parsed_files[file_name] = await asyncio.to_thread(
+                    file_parser.parse_file_with_key, file_path, cancel=cancel
+                )
+                return file_name, key
+            except Exception as e:
+                raise Exception(f"Ошибка файла {file_name}: {str(e)}")
+
+        try:
+            keys = await asyncio.gather(*(parse_one(name, path) for name, path in temp_files.items()))
+        except asyncio.CancelledError:
+            # Отмена задачи не прерывает потоки парсинга — они останавливаются между страницами
+            cancel.set()
+            raise
+        return dict(keys)
+
+    async def documents(results):
+        if parsed_files:
+            return dict(parsed_files)
+        # Возобновление: разобранные данные берутся из кэша парсинга по сохранённым ключам
+        return await asyncio.to_thread(_load_parsed_files, results["parse"])
+
+    async def pricelists(results):
+        # Прайсы держатся в памяти процесса и перечитываются только при изменении файлов;
+        # индексы строятся параллельно с Перечнем
+        store = get_pricelist_store()
+
+        def load(kind):
+            pricelist = store.get(kind)
+            if pricelist is not None:
+                get_index(pricelist)
+            return pricelist
+
+        works, materials = await asyncio.gather(asyncio.to_thread(load, "works"), asyncio.to_thread(load, "materials"))
+        return {"works": works, "materials": materials}
+
+    async def list_llm(results):
+        prompt = claude_service.create_list_prompt(results["documents"], user_comment)
+        request_record.claude_prompt = prompt.to_text()[:5000]
+        db.commit()
+        on_item = _progress_callback(db, request_record, "list", list_writer.append if list_writer else None)
+        response, list_data = await claude_service.stream_json_array(prompt, max_tokens=8000, on_item=on_item)
+        request_record.claude_response = response[:5000]
+        _set_progress(db, request_record, {"stage": "list", "items": len(list_data)})
+        return list_data
+
+    async def list_excel(results):
+        list_bytes = await asyncio.to_thread(list_writer.finish)
+        list_filename = f"Перечень_работ_и_материалов_{request_id}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
+        return save_output("list", list_filename, list_bytes, "excel_list")
+
+    async def estimate_llm(results):
+        list_data = results["list_llm"]
+        if isinstance(list_data, list):
+            # Единицы Перечня приводятся к каноническим до сопоставления с прайсами
+            units = normalize_units(item.get("unit") if isinstance(item, dict) else None for item in list_data)
+            list_data = [
+                dict(item, unit=unit or item.get("unit")) if isinstance(item, dict) else item
+                for item, unit in zip(list_data, units)
+            ]
+        on_item = _progress_callback(db, request_record, "estimate")
+
+        # Позиции с уверенным совпадением в прайсе оцениваются локально, без Claude
+        matched, unresolved, pending = {}, [], list_data
+        if PRICE_MATCH_ENABLED and isinstance(list_data, list):
+            matched, unresolved = await asyncio.to_thread(PriceMatcher(results["pricelists"]).split, list_data)
+            pending = [list_data[i] for i in unresolved]
+            for estimate_item in matched.values():
+                on_item(estimate_item)
+
+        llm_items = []
+        if pending:
+            # Начало прайсов одинаково для всех заданий и кэшируется в префиксе промпта;
+            # подобранные под перечень строки сверх него — в переменной части
+            pricelists = results["pricelists"]
+            (works_head, works_skip), (materials_head, materials_skip) = await asyncio.gather(
+                asyncio.to_thread(_pricelist_head, pricelists["works"]),
+                asyncio.to_thread(_pricelist_head, pricelists["materials"]),
+            )
+            works, materials = await asyncio.gather(
+                asyncio.to_thread(_pricelist_candidates, pricelists["works"], pending, works_skip),
+                asyncio.to_thread(_pricelist_candidates, pricelists["materials"], pending, materials_skip),
+            )
+            prompt = claude_service.create_estimate_prompt(pending, works, materials, works_head, materials_head)
+            response, llm_items = await claude_service.stream_json_array(prompt, max_tokens=8000, on_item=on_item)
+
+        estimate_data = merge_estimate(len(list_data), matched, unresolved, llm_items) if matched else llm_items
+        _set_progress(db, request_record, {"stage": "estimate", "items": len(estimate_data), "local": len(matched)})
+        return estimate_data
+
+    async def estimate_excel(results):
+        estimate_bytes = await asyncio.to_thread(ExcelBuilder().create_estimate_workbook, results["estimate_llm"])
+        estimate_filename = f"Смета_{request_id}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.xlsx"
+        return save_output("estimate", estimate_filename, estimate_bytes, "excel_estimate")
+
+    async def comparison_llm(results):
+        project_content = "\n".join([str(v) for v in results["documents"].values()])
+        estimate_content = json.dumps(results.get("estimate_llm") or results["list_llm"], ensure_ascii=False)
+        prompt = claude_service.create_comparison_prompt(project_content, estimate_content)
+        response = await claude_service.call_claude(prompt, max_tokens=4000)
+        return _drop_spurious_unit_discrepancies(claude_service.parse_json_response(response))
+
+    async def comparison_pdf(results):
+        pdf_bytes = await asyncio.to_thread(PDFBuilder().create_comparison_report, results["comparison_llm"])
+        comparison_filename = f"Сравнительный_анализ_{request_id}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.pdf"
+        return save_output("comparison", comparison_filename, pdf_bytes, "pdf_comparison")
+
+    graph = StageGraph()
+    graph.add("parse", parse)
+    # Содержимое файлов занимает много места — в контрольных точках его нет, оно в кэше парсинга
+    graph.add("documents", documents, deps=("parse",), checkpoint=False)
+    if "list" in outputs or "estimate" in outputs or "comparison" in outputs:
+        graph.add("list_llm", list_llm, deps=("documents",), error_label="Ошибка Перечня")
+    if "list" in outputs:
+        graph.add("list_excel", list_excel, deps=("list_llm",), error_label="Ошибка Перечня")
+    if "estimate" in outputs:
+        # Прайс-листы читаются параллельно с парсингом и Перечнем; они уже в памяти
+        # процесса, поэтому в контрольных точках не сохраняются
+        graph.add("pricelists", pricelists, error_label="Ошибка Сметы", checkpoint=False)
+        graph.add("estimate_llm", estimate_llm, deps=("list_llm", "pricelists"), error_label="Ошибка Сметы")
+        graph.add("estimate_excel", estimate_excel, deps=("estimate_llm",), error_label="Ошибка Сметы")
+    if "comparison" in outputs:
+        # Анализ сравнивает со Сметой, если она запрошена, иначе — с Перечнем
+        source = "estimate_llm" if "estimate" in outputs else "list_llm"
+        graph.add("comparison_llm", comparison_llm, deps=(source, "documents"), error_label="Ошибка анализа")
+        graph.add("comparison_pdf", comparison_pdf, deps=("comparison_llm",), error_label="Ошибка анализа")
+    return graph, output_files
+
+
+def parsed_files_available(parse_keys: Optional[dict]) -> bool:
+    """Можно ли возобновить запрос без исходных файлов: все разборы лежат в кэше"""
+    cache = get_parse_cache()
+    if not parse_keys or cache is None:
+        return False
+    return all(key and cache.has(key) for key in parse_keys.values())
+
+
+def _load_parsed_files(parse_keys: dict) -> dict:
+    """Разобранные файлы из кэша парсинга по ключам контрольной точки этапа parse"""
+    cache = get_parse_cache()
+    documents = {}
+    for file_name, key in parse_keys.items():
+        parsed = cache.get(key) if cache is not None and key else None
+        if parsed is None:
+            raise Exception(f"Результат разбора файла {file_name} не сохранился — отправьте запрос заново")
+        documents[file_name] = parsed
+    return documents
+
+
+def _cancelled_by_user(db, request_record) -> bool:
+    """Отменена ли обработка пользователем (а не прервана из-за потери задачи воркером)"""
+    if request_record is None:
+        return False
+    try:
+        db.rollback()
+        db.refresh(request_record)
+    except Exception:
+        return False
+    return request_record.status == "cancelled"
+
+
+def _finish_request(db, request_record, **values) -> bool:
+    """Записать итог обработки, если запрос не отменили, пока шли этапы
+
+    Обновление условное: отмена из API (status="cancelled") не перезаписывается
+    успехом или ошибкой, даже если конвейер успел доработать.
+    """
+    updated = (
+        db.query(Request)
+        .filter(Request.id == request_record.id, Request.status != "cancelled")
+        .update({getattr(Request, name): value for name, value in values.items()}, synchronize_session=False)
+    )
+    db.commit()
+    db.refresh(request_record)
+    return bool(updated)
+
+
+async def process_in_background(
+    request_id: int, temp_files: dict, outputs: list, user_comment, bypass_cache: bool = False
+):
+    db = SessionLocal()
+    request_record = None
+    keep_files = False
+    try:
+        request_record = db.query(Request).filter(Request.id == request_id).first()
+        # Этапы, выполненные в прошлый запуск (до ошибки или падения воркера), не повторяются
+        checkpoints = load_checkpoints(db, request_id)
+        graph, output_files = build_stage_graph(
+            db, request_record, temp_files, outputs, user_comment, bypass_cache, checkpoints
+        )
+        previous_timings = request_record.stage_timings or {}
+
+        def timings():
+            return {**previous_timings, **graph.timings}
+
+        def on_stage_done(stage_name, timing, result):
+            if graph.stages[stage_name].checkpoint:
+                save_checkpoint(db, request_id, stage_name, result)
+            # Время этапов (сек от начала обработки) сохраняется по мере их завершения
+            request_record.stage_timings = timings()
+            db.commit()
+            events.publish(request_id, "stage", {"stage": stage_name, **timing})
+
+        restored = {name: result for name, result in checkpoints.items() if name in graph.stages}
+        events.publish(request_id, "started", {
+            "stages": list(graph.pending_stages(restored)),
+            "completed": list(restored),
+        })
+        try:
+            await graph.run(results=restored, on_stage_done=on_stage_done)
+        except StageError as e:
+            _finish_request(db, request_record, status="error", error_message=str(e), stage_timings=timings())
+            return
+
+        _finish_request(db, request_record, status="success", output_files=output_files, stage_timings=timings())
+
+    except asyncio.CancelledError:
+        if not _cancelled_by_user(db, request_record):
+            # Воркер потерял задачу: её перезапустит другой воркер, загруженные файлы ему ещё нужны
+            keep_files = True
+            events.publish(request_id, "requeued", {})
+        raise
+    except Exception as e:
+        if request_record:
+            db.rollback()
+            _finish_request(db, request_record, status="error", error_message=str(e))
+    finally:
+        if request_record is not None and request_record.status != "processing":
+            # Повторы этого запроса получают тот же результат; при отмене их
+            # отсоединяет API (detach_duplicates), а не отменяет вместе с исходным
+            if request_record.status != "cancelled":
+                try:
+                    settle_duplicates(db, request_record)
+                except Exception:
+                    db.rollback()
+            events.publish(request_id, "done", {
+                "status": request_record.status,
+                "output_files": request_record.output_files or {},
+                "error_message": request_record.error_message,
+            })
+        if not keep_files:
+            release_uploads(temp_files.values(), request_id)
+        db.close()
+
@@ -0,0 +1,102 @@
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.services.pricelist_store import Pricelist, PriceRow
+from backend.services.units import conversion_factor, normalize_unit
+from backend.services.pricelist_index import item_kinds
+
+PRICE_MATCH_ENABLED = os.getenv("PRICE_MATCH_ENABLED", "true").lower() == "true"
+
+
+class PriceMatcher:
+    """Локальное сопоставление позиций Перечня с прайсами без обращения к Claude
+
+    Позиция оценивается локально, только если в прайсе её типа есть строка с тем же
+    нормализованным наименованием и совместимой единицей измерения; цена пересчитывается
+    в единицу Перечня (например, из кг в т). Похожие, но не совпадающие наименования
+    (другой размер, сечение, марка) и позиции без единицы измерения (в Перечне или в прайсе)
+    локально не оцениваются — их оценивает Claude.
+    """
+
+    def __init__(self, pricelists: Dict[str, Optional[Pricelist]]):
+        self.pricelists = pricelists
+
+    def match(self, item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Строка Сметы для позиции или None, если уверенного совпадения нет"""
+        if not isinstance(item, dict) or not item.get("name"):
+            return None
+        kinds = item_kinds(item)
+        if len(kinds) != 1:
+            return None
+        pricelist = self.pricelists.get(kinds[0])
+        if pricelist is None:
+            return None
+
+        found = self._find(pricelist, str(item["name"]), item.get("unit"))
+        if found is None:
+            return None
+        row, factor = found
+        return self._estimate_item(item, kinds[0], row, factor)
+
+    def split(self, items: List[Any]) -> Tuple[Dict[int, Dict[str, Any]], List[int]]:
+        """Разделить Перечень: {номер: строка Сметы} для найденных и номера остальных позиций"""
+        matched = {}
+        unresolved = []
+        for i, item in enumerate(items):
+            estimate_item = self.match(item)
+            if estimate_item is None:
+                unresolved.append(i)
+            else:
+                matched[i] = estimate_item
+        return matched, unresolved
+
+    def _find(self, pricelist: Pricelist, name: str, unit: Optional[str]) -> Optional[Tuple[PriceRow, float]]:
+        target_unit = normalize_unit(unit)
+        # Без единицы с любой стороны цену не с чем сопоставить — позицию оценит Claude
+        if not target_unit:
+            return None
+        for row in pricelist.lookup(name):
+            if not row.unit_norm or row.price is None:
+                continue
+            # Сколько единиц прайса в одной единице Перечня (None — единицы несовместимы)
+            factor = conversion_factor(target_unit, row.unit_norm)
+            if factor is not None:
+                return row, factor
+        return None
+
+    @staticmethod
+    def _estimate_item(item: Dict[str, Any], kind: str, row: PriceRow, factor: float) -> Dict[str, Any]:
+        price = round(row.price * factor, 2)
+        column = min(row.prices, key=row.prices.get)
+        match_note = "точное совпадение"
+        if factor != 1:
+            match_note += f", пересчёт из {row.unit_norm}"
+        return {
+            "type": item.get("type"),
+            "name": item.get("name"),
+            "unit": normalize_unit(item.get("unit")),
+            "quantity": item.get("quantity"),
+            "price_work_per_unit": price if kind == "works" else None,
+            "price_material_per_unit": price if kind == "materials" else None,
+            "name_in_pricelist": row.name,
+            "note": f"Цена из прайса ({match_note}, {column})",
+        }
+
+
+def merge_estimate(
+    total: int,
+    matched: Dict[int, Dict[str, Any]],
+    unresolved: List[int],
+    llm_items: List[Any],
+) -> List[Any]:
+    """Собрать Смету в исходном порядке Перечня: локальные строки и ответ Claude по остальным"""
+    result: List[Any] = [None] * total
+    for i, estimate_item in matched.items():
+        result[i] = estimate_item
+    llm_iter = iter(llm_items)
+    for i in unresolved:
+        result[i] = next(llm_iter, None)
+    # Лишние строки от модели (если она разбила позицию) — в конец
+    merged = [item for item in result if item is not None]
+    merged.extend(llm_iter)
+    return merged
@@ -0,0 +1,157 @@
+import os
+import logging
+from datetime import datetime
+from typing import Any, BinaryIO, Dict, List
+
+from sqlalchemy import func, insert
+
+from backend.database import SessionLocal
+from backend.models import PricelistItem, PricelistVersion
+from backend.services.pricelist_store import PriceRow, iter_table_rows, parse_price_rows
+from backend.services.units import normalize_units
+
+logger = logging.getLogger(__name__)
+
+# Сколько неактивных версий каждого прайса хранить для отката
+PRICELIST_KEEP_VERSIONS = int(os.getenv("PRICELIST_KEEP_VERSIONS", "3"))
+
+IMPORT_BATCH_SIZE = 1000
+ALLOWED_EXTENSIONS = (".xlsx", ".csv")
+
+
+def import_pricelist(kind: str, source: BinaryIO, file_name: str, activate: bool = True) -> Dict[str, Any]:
+    """Потоково загрузить прайс из Excel/CSV в новую версию и (по умолчанию) активировать её
+
+    Строки пишутся в БД пачками, файл целиком в память не читается. Версия становится
+    активной одной транзакцией вместе с последней пачкой, поэтому воркеры никогда
+    не видят прайс загруженным наполовину.
+    """
+    db = SessionLocal()
+    try:
+        number = (
+            db.query(func.max(PricelistVersion.version)).filter(PricelistVersion.kind == kind).scalar() or 0
+        ) + 1
+        version = PricelistVersion(kind=kind, version=number, file_name=file_name, status="importing")
+        db.add(version)
+        db.commit()
+
+        try:
+            price_columns, rows = parse_price_rows(iter_table_rows(source, file_name))
+            batch = []
+            count = 0
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    _insert_batch(db, version.id, count, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                _insert_batch(db, version.id, count, batch)
+                count += len(batch)
+            if count == 0:
+                raise ValueError("в файле нет ни одной позиции")
+
+            version.price_columns = price_columns
+            version.rows_count = count
+            version.status = "ready"
+            if activate:
+                _activate(db, version)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            version.status = "error"
+            version.error_message = str(e)
+            db.commit()
+            raise Exception(f"Ошибка импорта прайс-листа: {str(e)}")
+
+        logger.info("Прайс-лист %s: импортирована версия %s (%s позиций)", kind, number, count)
+        _prune_versions(db, kind)
+        return version_to_dict(version)
+    finally:
+        db.close()
+
+
+def activate_version(version_id: int) -> Dict[str, Any]:
+    """Сделать версию активной (например, откатиться на предыдущую)"""
+    db = SessionLocal()
+    try:
+        version = db.query(PricelistVersion).filter(PricelistVersion.id == version_id).first()
+        if version is None:
+            raise LookupError("Версия прайс-листа не найдена")
+        if version.status != "ready":
+            raise ValueError("Версия прайс-листа не загружена полностью")
+        _activate(db, version)
+        db.commit()
+        return version_to_dict(version)
+    finally:
+        db.close()
+
+
+def list_versions() -> List[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        versions = db.query(PricelistVersion).order_by(PricelistVersion.kind, PricelistVersion.version.desc()).all()
+        return [version_to_dict(v) for v in versions]
+    finally:
+        db.close()
+
+
+def version_to_dict(version: PricelistVersion) -> Dict[str, Any]:
+    return {
+        "id": version.id,
+        "kind": version.kind,
+        "version": version.version,
+        "file_name": version.file_name,
+        "rows_count": version.rows_count,
+        "price_columns": version.price_columns,
+        "status": version.status,
+        "is_active": version.is_active,
+        "error_message": version.error_message,
+        "created_at": version.created_at.isoformat() if version.created_at else None,
+        "activated_at": version.activated_at.isoformat() if version.activated_at else None,
+    }
+
+
+def _insert_batch(db, version_id: int, start: int, rows: List[PriceRow]):
+    """Записать пачку строк прайса; единицы нормализуются сразу для всей пачки"""
+    units = normalize_units(row.unit for row in rows)
+    db.execute(insert(PricelistItem), [
+        {
+            "version_id": version_id,
+            "row_num": start + i,
+            "name": row.name,
+            "name_normalized": row.key,
+            "unit": row.unit[:50],
+            "unit_normalized": unit[:50],
+            "prices": row.prices,
+            "price": row.price,
+        }
+        for i, (row, unit) in enumerate(zip(rows, units))
+    ])
+
+
+def _activate(db, version: PricelistVersion):
+    # Блокируем версии этого вида, чтобы две активации не прошли одновременно
+    db.query(PricelistVersion).filter(PricelistVersion.kind == version.kind).with_for_update().all()
+    db.query(PricelistVersion).filter(
+        PricelistVersion.kind == version.kind, PricelistVersion.id != version.id
+    ).update({PricelistVersion.is_active: False}, synchronize_session=False)
+    version.is_active = True
+    version.activated_at = datetime.utcnow()
+
+
+def _prune_versions(db, kind: str):
+    """Удалить старые неактивные версии сверх PRICELIST_KEEP_VERSIONS"""
+    stale = (
+        db.query(PricelistVersion.id)
+        .filter(PricelistVersion.kind == kind, PricelistVersion.is_active.is_(False))
+        .order_by(PricelistVersion.version.desc())
+        .offset(PRICELIST_KEEP_VERSIONS)
+        .all()
+    )
+    stale_ids = [version_id for (version_id,) in stale]
+    if not stale_ids:
+        return
+    db.query(PricelistItem).filter(PricelistItem.version_id.in_(stale_ids)).delete(synchronize_session=False)
+    db.query(PricelistVersion).filter(PricelistVersion.id.in_(stale_ids)).delete(synchronize_session=False)
+    db.commit()
@@ -0,0 +1,194 @@
+import os
+import math
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.services.pricelist_store import Pricelist, PriceRow, normalize_name
+from backend.services.units import normalize_unit, unit_dimension
+
+# Сколько кандидатов из прайса подбирать на одну позицию перечня
+PRICELIST_TOP_K = int(os.getenv("PRICELIST_TOP_K", "5"))
+# Минимальная похожесть кандидата (косинус TF-IDF по триграммам)
+PRICELIST_MIN_SCORE = float(os.getenv("PRICELIST_MIN_SCORE", "0.2"))
+# Прибавка к похожести при совпадении единицы измерения (половина — при пересчитываемой единице)
+UNIT_MATCH_BONUS = 0.15
+# Триграммы, встречающиеся чаще, почти не влияют на рейтинг и пропускаются при поиске
+MAX_POSTINGS = 5000
+
+WORK_TYPES = ("работа", "работы")
+MATERIAL_TYPES = ("материал", "материалы")
+
+
+def trigrams(key: str) -> Counter:
+    """Символьные триграммы нормализованного наименования (с граничными пробелами)"""
+    padded = f" {key} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def build_trigram_csr(keys: Sequence[str]) -> Dict[str, np.ndarray]:
+    """Инвертированный индекс TF-IDF в формате CSR
+
+    grams — отсортированный словарь триграмм, ptr — границы постингов каждой триграммы
+    в rows/weights, weights — нормированные по строке веса tf*idf.
+    """
+    df: Counter = Counter()
+    for key in keys:
+        df.update(trigrams(key).keys())
+    gram_list = sorted(df)
+    gram_ids = {gram: i for i, gram in enumerate(gram_list)}
+    total = max(len(keys), 1)
+    idf = [math.log(1 + total / df[gram]) for gram in gram_list]
+
+    # Постинги копятся плоскими массивами и затем группируются по триграмме
+    post_grams, post_rows, post_weights = array("i"), array("i"), array("f")
+    for row_id, key in enumerate(keys):
+        counts = trigrams(key)
+        ids = [gram_ids[gram] for gram in counts]
+        weights = [tf * idf[gid] for gid, tf in zip(ids, counts.values())]
+        norm = math.sqrt(sum(w * w for w in weights)) or 1.0
+        post_grams.extend(ids)
+        post_rows.extend([row_id] * len(ids))
+        post_weights.extend([w / norm for w in weights])
+
+    post_grams = np.array(post_grams, dtype=np.int32)
+    order = np.argsort(post_grams, kind="stable")
+    ptr = np.zeros(len(gram_list) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(post_grams, minlength=len(gram_list)), out=ptr[1:])
+    return {
+        "grams": np.array(gram_list, dtype="<U3"),
+        "idf": np.array(idf, dtype=np.float32),
+        "ptr": ptr,
+        "rows": np.array(post_rows, dtype=np.int32)[order],
+        "weights": np.array(post_weights, dtype=np.float32)[order],
+    }
+
+
+def build_unit_codes(units: Sequence[str]) -> Tuple[List[str], np.ndarray]:
+    """Словарь канонических единиц и код единицы для каждой строки"""
+    vocab = sorted(set(units))
+    codes = {unit: i for i, unit in enumerate(vocab)}
+    return vocab, np.array([codes[unit] for unit in units], dtype=np.int32)
+
+
+class TrigramIndex:
+    """Поиск по индексу TF-IDF триграмм наименований прайса
+
+    Работает с массивами CSR — построенными в памяти или отображёнными из снимка
+    прайса (mmap), поэтому индекс снимка не копируется в память каждого воркера.
+    """
+
+    def __init__(self, pricelist, csr: Dict[str, np.ndarray], unit_vocab: List[str], unit_codes: np.ndarray):
+        self.pricelist = pricelist
+        self.grams = csr["grams"]
+        self.idf = csr["idf"]
+        self.ptr = csr["ptr"]
+        self.post_rows = csr["rows"]
+        self.post_weights = csr["weights"]
+        self.unit_vocab = {unit: i for i, unit in enumerate(unit_vocab)}
+        self.unit_codes = unit_codes
+        # Размерность каждой единицы словаря (площадь, масса...) кодом; 0 — неизвестна
+        dims = [unit_dimension(unit) for unit in unit_vocab]
+        self.dim_codes = {dim: i + 1 for i, dim in enumerate(sorted({d for d in dims if d}))}
+        self.unit_dims = np.array([self.dim_codes.get(dim, 0) for dim in dims], dtype=np.int32)
+
+    @classmethod
+    def from_pricelist(cls, pricelist: Pricelist) -> "TrigramIndex":
+        unit_vocab, unit_codes = build_unit_codes([row.unit_norm for row in pricelist.rows])
+        return cls(pricelist, build_trigram_csr([row.key for row in pricelist.rows]), unit_vocab, unit_codes)
+
+    def search(self, name: str, unit: Optional[str] = None, k: int = PRICELIST_TOP_K) -> List[Tuple[PriceRow, float]]:
+        """Лучшие k позиций прайса для наименования (с учётом единицы измерения)"""
+        return [(self.row(row_id), score) for row_id, score in self.search_ids(name, unit, k)]
+
+    def search_ids(self, name: str, unit: Optional[str] = None, k: int = PRICELIST_TOP_K) -> List[Tuple[int, float]]:
+        """То же, что search, но с номерами строк прайса"""
+        query = {}
+        for gram, tf in trigrams(normalize_name(name)).items():
+            gid = int(np.searchsorted(self.grams, gram))
+            if gid < len(self.grams) and self.grams[gid] == gram:
+                query[gid] = tf * float(self.idf[gid])
+        if not query:
+            return []
+        norm = math.sqrt(sum(w * w for w in query.values()))
+
+        sizes = {gid: int(self.ptr[gid + 1] - self.ptr[gid]) for gid in query}
+        gids = [gid for gid in query if sizes[gid] <= MAX_POSTINGS]
+        if not gids:
+            # Все триграммы частые — берём несколько самых редких из них
+            gids = sorted(query, key=sizes.get)[:3]
+
+        rows = np.concatenate([self.post_rows[self.ptr[g]:self.ptr[g + 1]] for g in gids])
+        weights = np.concatenate([
+            self.post_weights[self.ptr[g]:self.ptr[g + 1]] * (query[g] / norm) for g in gids
+        ])
+        row_ids, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+
+        target_unit = normalize_unit(unit)
+        if target_unit:
+            codes = self.unit_codes[row_ids]
+            same = codes == self.unit_vocab.get(target_unit, -1)
+            scores += UNIT_MATCH_BONUS * same
+            target_dim = self.dim_codes.get(unit_dimension(target_unit))
+            if target_dim:
+                scores += (UNIT_MATCH_BONUS / 2) * (~same & (self.unit_dims[codes] == target_dim))
+
+        top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(row_ids[i]), float(scores[i])) for i in top if scores[i] >= PRICELIST_MIN_SCORE]
+
+    def row(self, row_id: int) -> PriceRow:
+        return self.pricelist.rows[row_id]
+
+
+_indexes: Dict[str, TrigramIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(pricelist) -> TrigramIndex:
+    """Индекс прайса; перестраивается, только если хранилище перечитало прайс
+
+    Снимок прайса (см. pricelist_snapshot) хранит готовый индекс — он используется напрямую.
+    """
+    with _indexes_lock:
+        index = _indexes.get(pricelist.kind)
+        if index is None or index.pricelist is not pricelist:
+            snapshot_index = getattr(pricelist, "trigram_index", None)
+            index = snapshot_index() if snapshot_index else TrigramIndex.from_pricelist(pricelist)
+            _indexes[pricelist.kind] = index
+        return index
+
+
+def item_kinds(item: Dict[str, Any]) -> Tuple[str, ...]:
+    """В каких прайсах искать позицию перечня: по типу Работа/Материал или в обоих"""
+    item_type = str(item.get("type") or "").strip().lower()
+    if item_type in WORK_TYPES:
+        return ("works",)
+    if item_type in MATERIAL_TYPES:
+        return ("materials",)
+    return ("works", "materials")
+
+
+def select_candidates(
+    items: Iterable[Dict[str, Any]],
+    pricelist,
+    k: int = PRICELIST_TOP_K,
+    skip: int = 0,
+) -> List[PriceRow]:
+    """Объединение top-k кандидатов прайса по всем позициям перечня, в порядке прайса
+
+    skip — сколько первых строк прайса уже есть в промпте; они в результат не попадают.
+    """
+    index = get_index(pricelist)
+    selected = set()
+    for item in items:
+        if not isinstance(item, dict) or pricelist.kind not in item_kinds(item):
+            continue
+        for row_id, _ in index.search_ids(str(item.get("name") or ""), item.get("unit"), k):
+            if row_id >= skip:
+                selected.add(row_id)
+    return [index.row(row_id) for row_id in sorted(selected)]
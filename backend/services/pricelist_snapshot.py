@@ -0,0 +1,212 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from backend.services.pricelist_store import Pricelist, PricelistText, PriceRow, normalize_name
+from backend.services.pricelist_index import TrigramIndex, build_trigram_csr, build_unit_codes
+
+logger = logging.getLogger(__name__)
+
+PRICELIST_SNAPSHOT_DIR = Path(os.getenv("PRICELIST_SNAPSHOT_DIR", "/data/pricelist_snapshots"))
+
+# Версия формата снимка: при изменении раскладки старые снимки просто не находятся
+SNAPSHOT_FORMAT = 1
+
+# Массивы снимка (файлы .npy, отображаются в память только для чтения)
+ARRAYS = (
+    "names_off", "keys_off", "units_off", "unit_codes", "prices",
+    "key_hashes", "key_hash_rows",
+    "grams", "idf", "ptr", "post_rows", "post_weights",
+)
+BLOBS = ("names", "keys", "units")
+
+
+def _key_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _write_blob(directory: Path, name: str, values: List[str]):
+    """Строки одним UTF-8 блобом и массив смещений (n + 1) для доступа по номеру"""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    with open(directory / f"{name}.bin", "wb") as f:
+        for data in encoded:
+            f.write(data)
+    np.save(directory / f"{name}_off.npy", offsets)
+
+
+def build_snapshot(pricelist: Pricelist, directory: Path):
+    """Записать снимок прайса: колонки NumPy, строки в блобах со смещениями, индекс триграмм"""
+    directory.mkdir(parents=True)
+    rows = pricelist.rows
+
+    _write_blob(directory, "names", [row.name for row in rows])
+    _write_blob(directory, "keys", [row.key for row in rows])
+    _write_blob(directory, "units", [row.unit for row in rows])
+
+    unit_vocab, unit_codes = build_unit_codes([row.unit_norm for row in rows])
+    np.save(directory / "unit_codes.npy", unit_codes)
+
+    prices = np.full((len(rows), len(pricelist.price_columns)), np.nan, dtype=np.float64)
+    for i, row in enumerate(rows):
+        for j, column in enumerate(pricelist.price_columns):
+            if column in row.prices:
+                prices[i, j] = row.prices[column]
+    np.save(directory / "prices.npy", prices)
+
+    # Точный поиск по наименованию: отсортированные хэши нормализованных наименований
+    hashes = np.array([_key_hash(row.key) for row in rows], dtype=np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    np.save(directory / "key_hashes.npy", hashes[order])
+    np.save(directory / "key_hash_rows.npy", order.astype(np.int32))
+
+    csr = build_trigram_csr([row.key for row in rows])
+    np.save(directory / "grams.npy", csr["grams"])
+    np.save(directory / "idf.npy", csr["idf"])
+    np.save(directory / "ptr.npy", csr["ptr"])
+    np.save(directory / "post_rows.npy", csr["rows"])
+    np.save(directory / "post_weights.npy", csr["weights"])
+
+    # meta.json пишется последним: снимок без него считается недописанным
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "kind": pricelist.kind,
+        "token": pricelist.token,
+        "version_id": pricelist.version_id,
+        "rows": len(rows),
+        "price_columns": pricelist.price_columns,
+        "unit_vocab": unit_vocab,
+    }
+    with open(directory / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+
+class _SnapshotRows(Sequence):
+    """Ленивый список строк снимка: PriceRow собирается только при обращении"""
+
+    def __init__(self, snapshot: "PricelistSnapshot"):
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return self.snapshot.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.snapshot.row(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.snapshot.row(index)
+
+
+class PricelistSnapshot(PricelistText):
+    """Прайс, отображённый в память из снимка (общий для всех процессов, только чтение)"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        with open(directory / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.kind = meta["kind"]
+        self.token = meta["token"]
+        self.version_id = meta["version_id"]
+        self.size = meta["rows"]
+        self.price_columns = meta["price_columns"]
+        self.unit_vocab = meta["unit_vocab"]
+        self.arrays: Dict[str, np.ndarray] = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in ARRAYS
+        }
+        self.blobs: Dict[str, np.ndarray] = {name: self._map_blob(name) for name in BLOBS}
+        self.rows = _SnapshotRows(self)
+
+    def _map_blob(self, name: str) -> np.ndarray:
+        path = self.directory / f"{name}.bin"
+        if path.stat().st_size == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(path, dtype=np.uint8, mode="r")
+
+    def _text(self, name: str, index: int) -> str:
+        offsets = self.arrays[f"{name}_off"]
+        return bytes(self.blobs[name][offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def row(self, index: int) -> PriceRow:
+        prices = self.arrays["prices"][index]
+        return PriceRow(
+            name=self._text("names", index),
+            unit=self._text("units", index),
+            prices={col: float(prices[j]) for j, col in enumerate(self.price_columns) if not np.isnan(prices[j])},
+            key=self._text("keys", index),
+            unit_norm=self.unit_vocab[self.arrays["unit_codes"][index]],
+        )
+
+    def lookup(self, name: str) -> List[PriceRow]:
+        """Позиции с точно совпадающим нормализованным наименованием (двоичный поиск по хэшам)"""
+        key = normalize_name(name)
+        target = np.uint64(_key_hash(key))
+        hashes = self.arrays["key_hashes"]
+        start = int(np.searchsorted(hashes, target, side="left"))
+        end = int(np.searchsorted(hashes, target, side="right"))
+        found = []
+        for index in sorted(int(i) for i in self.arrays["key_hash_rows"][start:end]):
+            if self._text("keys", index) == key:
+                found.append(self.row(index))
+        return found
+
+    def trigram_index(self) -> TrigramIndex:
+        """Индекс триграмм прямо на отображённых массивах снимка"""
+        csr = {
+            "grams": self.arrays["grams"],
+            "idf": self.arrays["idf"],
+            "ptr": self.arrays["ptr"],
+            "rows": self.arrays["post_rows"],
+            "weights": self.arrays["post_weights"],
+        }
+        return TrigramIndex(self, csr, self.unit_vocab, self.arrays["unit_codes"])
+
+
+def snapshot_dir(kind: str, token: str) -> Path:
+    return PRICELIST_SNAPSHOT_DIR / f"{kind}-{token}-f{SNAPSHOT_FORMAT}"
+
+
+def get_or_build_snapshot(kind: str, token: str, loader: Callable[[], Pricelist]) -> PricelistSnapshot:
+    """Открыть снимок прайса; если его ещё нет — прочитать прайс из источника и построить
+
+    Снимок строится во временном каталоге и переименовывается целиком, поэтому
+    воркеры, строящие его одновременно, не мешают друг другу.
+    """
+    directory = snapshot_dir(kind, token)
+    if (directory / "meta.json").exists():
+        return PricelistSnapshot(directory)
+
+    pricelist = loader()
+    pricelist.token = token
+    tmp_dir = directory.with_name(f".{directory.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        build_snapshot(pricelist, tmp_dir)
+        os.rename(tmp_dir, directory)
+        logger.info("Построен снимок прайса %s: %s", kind, directory)
+    except OSError:
+        # Снимок уже построил другой воркер
+        if not (directory / "meta.json").exists():
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _remove_stale(kind, directory)
+    return PricelistSnapshot(directory)
+
+
+def _remove_stale(kind: str, current: Path):
+    """Удалить прежние снимки этого прайса (открытые воркерами mmap остаются валидными)"""
+    for path in PRICELIST_SNAPSHOT_DIR.glob(f"{kind}-*"):
+        if path != current and path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,333 @@
+import os
+import re
+import csv
+import time
+import codecs
+import hashlib
+import functools
+import logging
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from openpyxl import load_workbook
+
+from backend.database import SessionLocal
+from backend.models import PricelistItem, PricelistVersion
+from backend.services.units import normalize_units
+
+logger = logging.getLogger(__name__)
+
+PRICELISTS_DIR = Path(os.getenv("PRICELISTS_DIR", "pricelists"))
+# Сколько символов прайса отдавать в промпт Сметы (на каждый прайс)
+PRICELIST_PROMPT_MAX_CHARS = int(os.getenv("PRICELIST_PROMPT_MAX_CHARS", "20000"))
+# Как часто (сек) воркеры проверяют в БД, не активирована ли новая версия прайса
+PRICELIST_POLL_SECONDS = float(os.getenv("PRICELIST_POLL_SECONDS", "15"))
+# Держать прайсы в общих для воркеров снимках (mmap) вместо копии в памяти каждого процесса
+PRICELIST_SNAPSHOTS_ENABLED = os.getenv("PRICELIST_SNAPSHOTS_ENABLED", "true").lower() == "true"
+
+PRICELIST_FILES = {
+    "works": "price_works.xlsx",
+    "materials": "price_materials.xlsx",
+}
+
+NAME_HEADERS = ("наименование", "название", "наим")
+UNIT_HEADERS = ("ед. изм", "ед.изм", "единица", "ед")
+
+# Размер пачки строк при загрузке прайса из БД
+DB_FETCH_SIZE = 5000
+
+
+def normalize_name(text: str) -> str:
+    """Нормализованное наименование: нижний регистр, ё→е, только буквы и цифры через пробел"""
+    text = str(text or "").lower().replace("ё", "е")
+    return " ".join(re.findall(r"\w+", text))
+
+
+def _to_price(value) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    cleaned = re.sub(r"[^\d,.\-]", "", str(value)).replace(",", ".")
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+@dataclass
+class PriceRow:
+    """Позиция прайс-листа"""
+    name: str
+    unit: str
+    prices: Dict[str, float]  # колонка прайса -> цена
+    key: str = ""  # нормализованное наименование
+    unit_norm: str = ""  # каноническая единица измерения
+
+    @property
+    def price(self) -> Optional[float]:
+        """Самая низкая цена по всем колонкам"""
+        return min(self.prices.values()) if self.prices else None
+
+
+class PricelistText:
+    """Представление прайса в промпте (общее для прайса в памяти и снимка)"""
+    price_columns: List[str]
+    rows: Sequence[PriceRow]
+
+    def row_text(self, row: PriceRow) -> str:
+        prices = " | ".join(
+            f"{row.prices[col]:g}" if col in row.prices else "-" for col in self.price_columns
+        )
+        return f"{row.name} | {row.unit} | {prices}"
+
+    def to_text(self, max_chars: int = PRICELIST_PROMPT_MAX_CHARS, rows: Optional[List[PriceRow]] = None) -> str:
+        """Компактная таблица для промпта, обрезанная по границе строки"""
+        return self._render(self.rows if rows is None else rows, max_chars)[0]
+
+    def head(self, max_chars: int = PRICELIST_PROMPT_MAX_CHARS) -> Tuple[str, int]:
+        """Начало прайса для промпта и число вошедших в него строк (стабильно, пока прайс не изменится)"""
+        return self._render(self.rows, max_chars)
+
+    def _render(self, rows: Sequence[PriceRow], max_chars: int) -> Tuple[str, int]:
+        lines = [" | ".join(["Наименование", "Ед. изм.", *self.price_columns])]
+        chars = len(lines[0])
+        count = 0
+        for row in rows:
+            line = self.row_text(row)
+            if chars + len(line) + 1 > max_chars:
+                lines.append(f"... (ещё {len(rows) - count} позиций)")
+                break
+            lines.append(line)
+            chars += len(line) + 1
+            count += 1
+        return "\n".join(lines), count
+
+
+@dataclass
+class Pricelist(PricelistText):
+    """Прайс-лист в памяти с индексом по нормализованному наименованию"""
+    kind: str
+    path: Optional[Path]
+    mtime: float
+    size: int
+    price_columns: List[str]
+    rows: List[PriceRow] = field(default_factory=list)
+    by_name: Dict[str, List[int]] = field(default_factory=dict)
+    version_id: Optional[int] = None  # версия в БД (None — прайс из файла)
+    token: str = ""  # идентификатор источника: версия в БД или состояние файла
+
+    def add(self, row: PriceRow):
+        self.by_name.setdefault(row.key, []).append(len(self.rows))
+        self.rows.append(row)
+
+    def normalize_units(self):
+        """Проставить канонические единицы всем строкам одним пакетом"""
+        for row, unit in zip(self.rows, normalize_units(row.unit for row in self.rows)):
+            row.unit_norm = unit
+
+    def lookup(self, name: str) -> List[PriceRow]:
+        """Позиции с точно совпадающим нормализованным наименованием"""
+        return [self.rows[i] for i in self.by_name.get(normalize_name(name), [])]
+
+
+def parse_price_rows(rows: Iterable[Tuple[Any, ...]]) -> Tuple[List[str], Iterator[PriceRow]]:
+    """Разобрать табличные строки прайса (первая — заголовки): колонки цен и ленивый поток позиций"""
+    rows = iter(rows)
+    headers = [str(h).strip() if h is not None else "" for h in next(rows, ())]
+    name_col, unit_col = _detect_columns(headers)
+    price_cols = [i for i in range(len(headers)) if i not in (name_col, unit_col) and headers[i]]
+
+    def generate() -> Iterator[PriceRow]:
+        for values in rows:
+            if name_col >= len(values) or values[name_col] in (None, ""):
+                continue
+            prices = {}
+            for i in price_cols:
+                price = _to_price(values[i]) if i < len(values) else None
+                if price is not None:
+                    prices[headers[i]] = price
+            unit = values[unit_col] if unit_col is not None and unit_col < len(values) else None
+            name = str(values[name_col]).strip()
+            yield PriceRow(
+                name=name,
+                unit=str(unit).strip() if unit is not None else "",
+                prices=prices,
+                key=normalize_name(name),
+            )
+
+    return [headers[i] for i in price_cols], generate()
+
+
+def iter_table_rows(source: BinaryIO, file_name: str) -> Iterator[Tuple[Any, ...]]:
+    """Потоково читать строки первого листа Excel или CSV (разделитель определяется автоматически)"""
+    if file_name.lower().endswith(".csv"):
+        text = codecs.getreader("utf-8-sig")(source)
+        first = text.readline()
+        delimiter = ";" if first.count(";") > first.count(",") else ","
+        yield from csv.reader([first], delimiter=delimiter)
+        yield from csv.reader(text, delimiter=delimiter)
+        return
+
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def load_pricelist(kind: str, path: Path) -> Pricelist:
+    """Прочитать прайс из файла потоково (read-only) и построить индекс"""
+    stat = path.stat()
+    with open(path, "rb") as source:
+        price_columns, rows = parse_price_rows(iter_table_rows(source, path.name))
+        pricelist = Pricelist(kind=kind, path=path, mtime=stat.st_mtime, size=stat.st_size, price_columns=price_columns)
+        for row in rows:
+            pricelist.add(row)
+    pricelist.normalize_units()
+    return pricelist
+
+
+def load_pricelist_version(kind: str, version_id: int) -> Pricelist:
+    """Загрузить версию прайса из БД пачками в порядке строк исходного файла"""
+    db = SessionLocal()
+    try:
+        version = db.query(PricelistVersion).filter(PricelistVersion.id == version_id).first()
+        pricelist = Pricelist(
+            kind=kind, path=None, mtime=0.0, size=version.rows_count or 0,
+            price_columns=list(version.price_columns or []), version_id=version_id,
+        )
+        items = (
+            db.query(PricelistItem.name, PricelistItem.unit, PricelistItem.prices, PricelistItem.name_normalized)
+            .filter(PricelistItem.version_id == version_id)
+            .order_by(PricelistItem.row_num)
+            .yield_per(DB_FETCH_SIZE)
+        )
+        for name, unit, prices, key in items:
+            pricelist.add(PriceRow(name=name, unit=unit or "", prices=prices or {}, key=key))
+        pricelist.normalize_units()
+        return pricelist
+    finally:
+        db.close()
+
+
+def _active_version_id(kind: str) -> Optional[int]:
+    db = SessionLocal()
+    try:
+        row = (
+            db.query(PricelistVersion.id)
+            .filter(PricelistVersion.kind == kind, PricelistVersion.is_active.is_(True))
+            .first()
+        )
+        return row[0] if row else None
+    finally:
+        db.close()
+
+
+def _detect_columns(headers: List[str]) -> Tuple[int, Optional[int]]:
+    """Найти колонки наименования и единицы измерения по заголовкам (по умолчанию A и B)"""
+    lowered = [h.lower() for h in headers]
+    name_col = next((i for i, h in enumerate(lowered) if h.startswith(NAME_HEADERS)), 0)
+    unit_col = next(
+        (i for i, h in enumerate(lowered) if i != name_col and h.startswith(UNIT_HEADERS)),
+        1 if len(headers) > 1 and name_col != 1 else None,
+    )
+    return name_col, unit_col
+
+
+class PricelistStore:
+    """Прайс-листы, загруженные один раз на процесс
+
+    Источник — активная версия в БД (загружается через админку); воркеры раз в
+    PRICELIST_POLL_SECONDS сверяют её номер и перечитывают прайс при смене версии.
+    Пока версий в БД нет, используется файл, перечитываемый при изменении.
+    Со снимками (PRICELIST_SNAPSHOTS_ENABLED) прайс читается из источника один раз,
+    а все воркеры отображают готовый снимок в память только для чтения.
+    """
+
+    def __init__(self, directory: Path = PRICELISTS_DIR, poll_seconds: float = PRICELIST_POLL_SECONDS):
+        self.directory = Path(directory)
+        self.poll_seconds = poll_seconds
+        self._pricelists: Dict[str, Any] = {}
+        self._active: Dict[str, Tuple[float, Optional[int]]] = {}  # вид -> (время проверки, id версии)
+        self._lock = threading.Lock()
+
+    def get(self, kind: str):
+        """Прайс-лист вида works/materials (None, если его нет ни в БД, ни в файле)"""
+        with self._lock:
+            current = self._pricelists.get(kind)
+            version_id = self._active_version(kind)
+            if version_id is not None:
+                token = f"v{version_id}"
+                loader = functools.partial(load_pricelist_version, kind, version_id)
+            else:
+                path = self.directory / PRICELIST_FILES[kind]
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    return None
+                state = f"{path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+                token = "f" + hashlib.sha1(state.encode("utf-8")).hexdigest()[:16]
+                loader = functools.partial(load_pricelist, kind, path)
+
+            if current is None or current.token != token:
+                current = self._load(kind, token, loader)
+                self._pricelists[kind] = current
+                logger.info("Прайс-лист %s (%s): %s позиций", kind, token, len(current.rows))
+            return current
+
+    def _load(self, kind: str, token: str, loader: Callable[[], Pricelist]):
+        if PRICELIST_SNAPSHOTS_ENABLED:
+            # Снимок строится поверх этого модуля и индекса, поэтому импортируется здесь
+            from backend.services.pricelist_snapshot import get_or_build_snapshot
+            return get_or_build_snapshot(kind, token, loader)
+        pricelist = loader()
+        pricelist.token = token
+        return pricelist
+
+    def invalidate(self, kind: Optional[str] = None):
+        """Перепроверить активную версию при следующем обращении (после загрузки или активации)"""
+        with self._lock:
+            if kind is None:
+                self._active.clear()
+            else:
+                self._active.pop(kind, None)
+
+    def render(self, kind: str, max_chars: int = PRICELIST_PROMPT_MAX_CHARS) -> str:
+        """Текст прайса для промпта"""
+        try:
+            pricelist = self.get(kind)
+        except Exception as e:
+            return f"(ошибка при чтении прайс-листа: {str(e)})"
+        if pricelist is None:
+            return "(прайс-лист не найден)"
+        return pricelist.to_text(max_chars)
+
+    def _active_version(self, kind: str) -> Optional[int]:
+        """id активной версии в БД с редкой перепроверкой"""
+        now = time.monotonic()
+        checked_at, version_id = self._active.get(kind, (None, None))
+        if checked_at is not None and now - checked_at < self.poll_seconds:
+            return version_id
+        try:
+            version_id = _active_version_id(kind)
+        except Exception as e:
+            # БД недоступна — продолжаем с тем, что уже загружено
+            logger.warning("Не удалось проверить версию прайса %s: %s", kind, e)
+            current = self._pricelists.get(kind)
+            version_id = current.version_id if current else None
+        self._active[kind] = (now, version_id)
+        return version_id
+
+
+_store: Optional[PricelistStore] = None
+
+
+def get_pricelist_store() -> PricelistStore:
+    """Общее для процесса хранилище прайс-листов"""
+    global _store
+    if _store is None:
+        _store = PricelistStore()
+    return _store
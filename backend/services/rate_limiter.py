@@ -0,0 +1,237 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import anthropic
+from sqlalchemy.exc import IntegrityError
+
+from backend.database import SessionLocal
+from backend.models import ClaudeRateWindow
+
+logger = logging.getLogger(__name__)
+
+# Лимиты аккаунта Claude API (в минуту) и параметры повторов
+CLAUDE_RPM = int(os.getenv("CLAUDE_RPM", "50"))
+CLAUDE_INPUT_TPM = int(os.getenv("CLAUDE_INPUT_TPM", "100000"))
+CLAUDE_OUTPUT_TPM = int(os.getenv("CLAUDE_OUTPUT_TPM", "40000"))
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "4"))
+CLAUDE_MAX_RETRIES = int(os.getenv("CLAUDE_MAX_RETRIES", "6"))
+CLAUDE_RETRY_BASE_DELAY = float(os.getenv("CLAUDE_RETRY_BASE_DELAY", "2"))
+CLAUDE_RETRY_MAX_DELAY = float(os.getenv("CLAUDE_RETRY_MAX_DELAY", "60"))
+# Согласовывать лимиты между процессами-воркерами через БД
+CLAUDE_RATE_LIMIT_SHARED = os.getenv("CLAUDE_RATE_LIMIT_SHARED", "false").lower() == "true"
+
+# Грубая оценка числа токенов по длине текста (кириллица ~3 символа на токен)
+CHARS_PER_TOKEN = 3
+
+T = TypeVar("T")
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценить число входных токенов по длине текста"""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class TokenBucket:
+    """Асинхронное ведро токенов с равномерным пополнением за минуту"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        """Дождаться и списать amount токенов (запрос крупнее ёмкости ждёт полное ведро)"""
+        amount = min(float(amount), self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def refund(self, amount: float):
+        """Вернуть неиспользованный резерв (например, разницу max_tokens и фактического вывода)"""
+        if amount > 0:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class SharedRateWindow:
+    """Минутные счётчики в БД, общие для всех процессов-воркеров"""
+
+    def __init__(self, rpm: int, input_tpm: int, output_tpm: int):
+        self.rpm = rpm
+        self.input_tpm = input_tpm
+        self.output_tpm = output_tpm
+
+    async def acquire(self, input_tokens: int, output_tokens: int):
+        while True:
+            wait = await asyncio.to_thread(self._try_reserve, input_tokens, output_tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def _try_reserve(self, input_tokens: int, output_tokens: int) -> float:
+        """Зарезервировать квоту в текущей минуте; вернуть 0 или сколько ждать до следующей"""
+        now = datetime.utcnow()
+        window_start = now.replace(second=0, microsecond=0)
+        db = SessionLocal()
+        try:
+            window = (
+                db.query(ClaudeRateWindow)
+                .filter(ClaudeRateWindow.window_start == window_start)
+                .with_for_update()
+                .first()
+            )
+            if window is None:
+                window = ClaudeRateWindow(window_start=window_start, requests=0, input_tokens=0, output_tokens=0)
+                db.add(window)
+                # Старые окна больше не нужны
+                db.query(ClaudeRateWindow).filter(
+                    ClaudeRateWindow.window_start < window_start - timedelta(hours=1)
+                ).delete(synchronize_session=False)
+                db.flush()
+
+            over_limit = window.requests > 0 and (
+                window.requests + 1 > self.rpm
+                or window.input_tokens + input_tokens > self.input_tpm
+                or window.output_tokens + output_tokens > self.output_tpm
+            )
+            if over_limit:
+                db.rollback()
+                return (window_start + timedelta(minutes=1) - now).total_seconds() + random.uniform(0, 1)
+
+            window.requests += 1
+            window.input_tokens += input_tokens
+            window.output_tokens += output_tokens
+            db.commit()
+            return 0
+        except IntegrityError:
+            # Окно одновременно создал другой воркер — повторить сразу
+            db.rollback()
+            return 0.05
+        finally:
+            db.close()
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """Значение заголовков retry-after(-ms) ответа API, если есть"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+class ClaudeRateGovernor:
+    """Ограничение запросов и токенов в минуту, числа одновременных вызовов и повторы с backoff"""
+
+    def __init__(
+        self,
+        rpm: int = CLAUDE_RPM,
+        input_tpm: int = CLAUDE_INPUT_TPM,
+        output_tpm: int = CLAUDE_OUTPUT_TPM,
+        max_concurrency: int = CLAUDE_MAX_CONCURRENCY,
+        max_retries: int = CLAUDE_MAX_RETRIES,
+        shared: bool = CLAUDE_RATE_LIMIT_SHARED,
+    ):
+        self.requests = TokenBucket(rpm)
+        self.input_tokens = TokenBucket(input_tpm)
+        self.output_tokens = TokenBucket(output_tpm)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.shared = SharedRateWindow(rpm, input_tpm, output_tpm) if shared else None
+        self.paused_until = 0.0
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable[T]],
+        input_tokens: int,
+        max_tokens: int,
+        can_retry: Optional[Callable[[], bool]] = None,
+    ) -> T:
+        """Выполнить вызов Claude с учётом лимитов; повторять при 429/5xx/обрывах соединения"""
+        attempt = 0
+        while True:
+            await self._wait_pause()
+            await self.requests.acquire(1)
+            await self.input_tokens.acquire(input_tokens)
+            await self.output_tokens.acquire(max_tokens)
+            if self.shared:
+                await self.shared.acquire(input_tokens, max_tokens)
+
+            async with self.semaphore:
+                try:
+                    return await call()
+                except Exception as e:
+                    retry_allowed = can_retry() if can_retry else True
+                    if not _is_retryable(e) or not retry_allowed or attempt >= self.max_retries:
+                        raise
+                    delay = self._backoff(attempt, _retry_after(e))
+                    if isinstance(e, anthropic.APIStatusError) and e.status_code == 429:
+                        # Лимит аккаунта исчерпан — притормозить все вызовы процесса
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    logger.warning("Claude API: %s, повтор %s через %.1f с", e, attempt + 1, delay)
+                    attempt += 1
+            await asyncio.sleep(delay)
+
+    def settle(self, usage: Any, input_estimate: int, max_tokens: int):
+        """Скорректировать резерв по фактическому расходу токенов из ответа"""
+        if usage is None:
+            return
+        actual_input = (usage.input_tokens or 0) + (getattr(usage, "cache_creation_input_tokens", 0) or 0)
+        self.input_tokens.refund(input_estimate - actual_input)
+        self.output_tokens.refund(max_tokens - (usage.output_tokens or 0))
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 1)
+        # Экспоненциальная задержка с полным джиттером
+        return random.uniform(0, min(CLAUDE_RETRY_MAX_DELAY, CLAUDE_RETRY_BASE_DELAY * (2 ** attempt)))
+
+    async def _wait_pause(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_governor: Optional[ClaudeRateGovernor] = None
+_governor_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_rate_governor() -> ClaudeRateGovernor:
+    """Общий для процесса ограничитель вызовов Claude (привязан к текущему event loop)"""
+    global _governor, _governor_loop
+    loop = asyncio.get_running_loop()
+    if _governor is None or _governor_loop is not loop:
+        _governor = ClaudeRateGovernor()
+        _governor_loop = loop
+    return _governor
@@ -0,0 +1,112 @@
+import time
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+StageFunc = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+@dataclass
+class Stage:
+    """Этап конвейера: асинхронная функция и имена этапов, от которых она зависит"""
+    name: str
+    func: StageFunc
+    deps: Tuple[str, ...] = ()
+    error_label: Optional[str] = None  # префикс сообщения об ошибке, например "Ошибка Сметы"
+    checkpoint: bool = True  # сохранять ли результат этапа для возобновления обработки
+
+
+class StageError(Exception):
+    """Ошибка конкретного этапа графа"""
+
+    def __init__(self, stage: Stage, error: BaseException):
+        self.stage = stage
+        self.error = error
+        message = f"{stage.error_label}: {error}" if stage.error_label else str(error)
+        super().__init__(message)
+
+
+@dataclass
+class StageGraph:
+    """Граф этапов, выполняемый с максимальным параллелизмом по готовности зависимостей"""
+    stages: Dict[str, Stage] = field(default_factory=dict)
+    timings: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+    def add(
+        self,
+        name: str,
+        func: StageFunc,
+        deps: Tuple[str, ...] = (),
+        error_label: Optional[str] = None,
+        checkpoint: bool = True,
+    ):
+        """Объявить этап; зависимости должны быть объявлены раньше"""
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Этап {name}: неизвестные зависимости {missing}")
+        self.stages[name] = Stage(name, func, tuple(deps), error_label, checkpoint)
+
+    def pending_stages(self, results: Dict[str, Any]) -> Dict[str, Stage]:
+        """Этапы, которые нужно выполнить при уже готовых results
+
+        Этап без результата выполняется, если он конечный или нужен хотя бы одному
+        невыполненному этапу — например, прайсы не читаются, когда Смета уже готова.
+        """
+        needed: Dict[str, Stage] = {}
+        for name, stage in reversed(list(self.stages.items())):
+            if name in results:
+                continue
+            dependents = [s for s in self.stages.values() if name in s.deps]
+            if not dependents or any(s.name in needed for s in dependents):
+                needed[name] = stage
+        return {name: stage for name, stage in self.stages.items() if name in needed}
+
+    async def run(
+        self,
+        results: Optional[Dict[str, Any]] = None,
+        on_stage_done: Optional[Callable[[str, Dict[str, float], Any], None]] = None,
+    ) -> Dict[str, Any]:
+        """Выполнить граф; results — уже готовые результаты этапов (они не перезапускаются)
+
+        on_stage_done(имя, время, результат) вызывается после каждого выполненного этапа.
+        """
+        results = dict(results or {})
+        pending = self.pending_stages(results)
+        running: Dict[asyncio.Task, Stage] = {}
+        started = time.monotonic()
+
+        try:
+            while pending or running:
+                # Запустить все этапы, зависимости которых уже выполнены
+                for name, stage in list(pending.items()):
+                    if all(dep in results for dep in stage.deps):
+                        task = asyncio.create_task(self._run_stage(stage, results, started))
+                        running[task] = stage
+                        del pending[name]
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage = running.pop(task)
+                    if task.exception() is not None:
+                        raise StageError(stage, task.exception())
+                    results[stage.name] = task.result()
+                    if on_stage_done:
+                        on_stage_done(stage.name, self.timings[stage.name], results[stage.name])
+        finally:
+            # При ошибке или отмене — остановить остальные выполняющиеся этапы
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+        return results
+
+    async def _run_stage(self, stage: Stage, results: Dict[str, Any], started: float) -> Any:
+        stage_start = time.monotonic()
+        try:
+            return await stage.func(results)
+        finally:
+            self.timings[stage.name] = {
+                "start": round(stage_start - started, 3),
+                "duration": round(time.monotonic() - stage_start, 3),
+            }
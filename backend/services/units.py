@@ -0,0 +1,112 @@
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+# Канонические единицы: (размерность, множитель к базовой единице размерности, написания)
+# Написания сравниваются после очистки: нижний регистр, без точек и пробелов, ё→е, 2/3→²/³
+UNITS: Dict[str, Tuple[str, float, Tuple[str, ...]]] = {
+    "м²": ("area", 1, ("м²", "кв м", "квм", "м кв", "мкв", "кв метр", "квадратный метр", "sqm", "m²")),
+    "100 м²": ("area", 100, ("100 м²", "100м²", "100 кв м")),
+    "1000 м²": ("area", 1000, ("1000 м²", "1000м²")),
+    "га": ("area", 10000, ("га", "гектар")),
+    "см²": ("area", 0.0001, ("см²",)),
+    "м³": ("volume", 1, ("м³", "куб м", "кубм", "м куб", "мкуб", "кубометр", "m³")),
+    "100 м³": ("volume", 100, ("100 м³", "100м³")),
+    "л": ("volume", 0.001, ("л", "литр", "литры", "литров", "l")),
+    "м": ("length", 1, ("м", "метр", "метров", "m")),
+    "м.п.": ("length", 1, ("мп", "пм", "пог м", "погм", "м пог", "мпог", "погонный метр")),
+    "100 м": ("length", 100, ("100 м", "100м", "100 мп", "100 пм")),
+    "км": ("length", 1000, ("км", "km")),
+    "мм": ("length", 0.001, ("мм", "mm")),
+    "см": ("length", 0.01, ("см", "cm")),
+    "кг": ("mass", 1, ("кг", "килограмм", "kg")),
+    "т": ("mass", 1000, ("т", "тн", "тонна", "тонн", "t")),
+    "г": ("mass", 0.001, ("г", "гр", "грамм", "g")),
+    "шт.": ("count", 1, ("шт", "штука", "штук", "штуки", "pcs", "pc", "ед")),
+    "10 шт.": ("count", 10, ("10 шт", "10шт")),
+    "100 шт.": ("count", 100, ("100 шт", "100шт")),
+    "1000 шт.": ("count", 1000, ("1000 шт", "1000шт", "тыс шт", "тысшт")),
+    "компл.": ("set", 1, ("компл", "комп", "комплект", "кт", "к-т", "set")),
+    "маш.-ч": ("machine_time", 1, ("маш-ч", "машч", "маш-час", "машчас", "мч")),
+    "чел.-ч": ("labour_time", 1, ("чел-ч", "челч", "чел-час", "челчас", "нормо-час", "нч")),
+    "ч": ("time", 1, ("ч", "час", "часов", "h")),
+    "смена": ("time", 8, ("смена", "смен")),
+    "рейс": ("trip", 1, ("рейс", "рейсов")),
+    "точка": ("point", 1, ("точка", "точек", "тчк")),
+    # Тара разного вида между собой не пересчитывается — у каждой своя размерность
+    "баллон": ("cylinder", 1, ("баллон", "баллонов")),
+    "упак.": ("package", 1, ("упак", "уп", "упаковка")),
+    "рул.": ("roll", 1, ("рул", "рулон", "рулонов")),
+    "меш.": ("bag", 1, ("меш", "мешок", "мешков")),
+}
+
+_CLEAN_RE = re.compile(r"[.\s^]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _clean(text: str) -> str:
+    """Ключ написания: нижний регистр, ё→е, степени ²/³, без точек и пробелов"""
+    text = _CLEAN_RE.sub("", str(text).strip().lower().replace("ё", "е"))
+    # Степень заменяется после очистки: "м^2" и "м 2" тоже дают "м²"
+    return text.replace("м2", "м²").replace("м3", "м³").replace("m2", "m²").replace("m3", "m³")
+
+
+def _compile() -> Dict[str, str]:
+    table = {}
+    for canonical, (_, _, aliases) in UNITS.items():
+        for alias in (canonical, *aliases):
+            table[_clean(alias)] = canonical
+    return table
+
+
+# Скомпилированная таблица: очищенное написание -> каноническая единица
+_ALIASES = _compile()
+
+
+def normalize_unit(unit: Any) -> str:
+    """Каноническое написание единицы измерения (неизвестные — очищенный исходный текст)"""
+    if unit is None:
+        return ""
+    text = str(unit).strip()
+    if not text or text.lower() == "nan":
+        return ""
+    return _ALIASES.get(_clean(text), _SPACE_RE.sub(" ", text))
+
+
+def normalize_units(units: Iterable[Any]) -> List[str]:
+    """Пакетная нормализация (для целого прайса): каждое уникальное написание разбирается один раз"""
+    series = pd.Series(list(units), dtype="object")
+    if series.empty:
+        return []
+    mapping = {value: normalize_unit(value) for value in series.dropna().unique()}
+    return series.map(mapping).fillna("").tolist()
+
+
+def unit_dimension(unit: Any) -> Optional[str]:
+    entry = UNITS.get(normalize_unit(unit))
+    return entry[0] if entry else None
+
+
+def conversion_factor(from_unit: Any, to_unit: Any) -> Optional[float]:
+    """Сколько to_unit в одной from_unit (None — единицы несовместимы или неизвестны)"""
+    source, target = normalize_unit(from_unit), normalize_unit(to_unit)
+    if source == target:
+        return 1.0
+    source_entry, target_entry = UNITS.get(source), UNITS.get(target)
+    if not source_entry or not target_entry or source_entry[0] != target_entry[0]:
+        return None
+    return source_entry[1] / target_entry[1]
+
+
+def convert(quantity: Optional[float], from_unit: Any, to_unit: Any) -> Optional[float]:
+    """Перевести количество из from_unit в to_unit"""
+    factor = conversion_factor(from_unit, to_unit)
+    if quantity is None or factor is None:
+        return None
+    return quantity * factor
+
+
+def same_unit(a: Any, b: Any) -> bool:
+    """Одинаковые ли единицы после нормализации (м2 = кв.м = м²)"""
+    return normalize_unit(a) == normalize_unit(b)
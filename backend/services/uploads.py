@@ -0,0 +1,121 @@
+import os
+import uuid
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Optional
+
+from backend.database import SessionLocal
+from backend.models import Job
+
+logger = logging.getLogger(__name__)
+
+# Загруженные файлы ждут воркера здесь — каталог должен быть общим для API и воркеров
+UPLOADS_DIR = Path(os.getenv("UPLOADS_DIR", "/data/uploads"))
+# Ограничения размера загрузки (МБ): на один файл и на все файлы запроса
+UPLOAD_MAX_FILE_MB = int(os.getenv("UPLOAD_MAX_FILE_MB", "200"))
+UPLOAD_MAX_REQUEST_MB = int(os.getenv("UPLOAD_MAX_REQUEST_MB", "500"))
+# Ограничение на все файлы пакетной отправки (/api/tasks/batch)
+UPLOAD_MAX_BATCH_MB = int(os.getenv("UPLOAD_MAX_BATCH_MB", "2000"))
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Метки "файл нужен запросу, задача которого ещё не в очереди" — по одной на загрузку
+UPLOAD_HOLDS_DIR = UPLOADS_DIR / ".holds"
+
+
+class UploadTooLarge(Exception):
+    """Загрузка превысила допустимый размер"""
+
+
+@contextmanager
+def _uploads_lock():
+    """Межпроцессная блокировка каталога загрузок: появление файла и его удаление не пересекаются"""
+    UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(UPLOADS_DIR / ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _is_held(path: Path) -> bool:
+    return any(UPLOAD_HOLDS_DIR.glob(f"{path.name}.*"))
+
+
+def store_upload(
+    source: BinaryIO,
+    file_name: str,
+    max_bytes: int = UPLOAD_MAX_FILE_MB * 1024 * 1024,
+) -> Dict[str, object]:
+    """Скопировать загруженный файл на диск блоками, считая SHA-256 по ходу копирования
+
+    Файл сохраняется под именем по хэшу содержимого (с исходным расширением — по нему
+    парсер определяет тип), поэтому одноимённые файлы разных запросов не пересекаются.
+    Копирование прерывается, как только файл превысил max_bytes.
+
+    Вместе с файлом ставится метка удержания: пока задача запроса не в очереди,
+    release_uploads другого запроса с тем же содержимым файл не удалит. Метку снимает
+    unhold_uploads после постановки задачи.
+    """
+    UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = UPLOADS_DIR / f".{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Файл {file_name} превышает допустимый размер загрузки")
+                digest.update(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        path = UPLOADS_DIR / f"{sha256}{Path(file_name).suffix.lower()}"
+        hold = UPLOAD_HOLDS_DIR / f"{path.name}.{uuid.uuid4().hex}"
+        with _uploads_lock():
+            UPLOAD_HOLDS_DIR.mkdir(parents=True, exist_ok=True)
+            hold.touch()
+            # Одинаковое содержимое даёт то же имя: замена атомарна и не портит файл другого запроса
+            os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return {"name": file_name, "path": str(path), "size": size, "sha256": sha256, "hold": str(hold)}
+
+
+def unhold_uploads(uploads: Iterable[Dict[str, object]]):
+    """Снять метки удержания загрузок (задача поставлена или загрузка не нужна)"""
+    for upload in uploads:
+        if upload.get("hold"):
+            Path(upload["hold"]).unlink(missing_ok=True)
+
+
+def release_uploads(paths: Iterable[str], request_id: Optional[int] = None):
+    """Удалить загруженные файлы, если они не нужны другим задачам в очереди
+
+    Файлы хранятся по хэшу содержимого, и один файл может принадлежать нескольким
+    запросам одновременно — удаляются только те, на которые не ссылаются другие
+    незавершённые задачи и метки удержания ещё не поставленных в очередь загрузок.
+    """
+    paths = set(paths)
+    if not paths:
+        return
+    with _uploads_lock():
+        db = SessionLocal()
+        try:
+            active = db.query(Job.payload).filter(Job.status.in_(("queued", "running")))
+            if request_id is not None:
+                active = active.filter(Job.request_id != request_id)
+            in_use = set()
+            for (payload,) in active.all():
+                in_use.update((payload or {}).get("temp_files", {}).values())
+        except Exception as e:
+            logger.warning("Не удалось проверить использование загруженных файлов: %s", e)
+            return
+        finally:
+            db.close()
+        for path in paths - in_use:
+            if not _is_held(Path(path)):
+                Path(path).unlink(missing_ok=True)
@@ -0,0 +1,131 @@
+"""
+Воркер обработки запросов: разбирает очередь задач из БД.
+
+Запуск отдельным процессом (можно несколько экземпляров):
+    python -m backend.worker
+"""
+
+import os
+import uuid
+import socket
+import signal
+import asyncio
+import logging
+from typing import Dict, Optional
+
+import backend.models  # noqa: F401 — регистрация таблиц перед init_db
+from backend.database import init_db
+from backend.services.claude_service import close_async_client
+from backend.services.job_queue import (
+    JOB_HEARTBEAT_SECONDS, claim_job, finish_job, heartbeat_job, requeue_expired_jobs
+)
+from backend.services.pipeline import process_in_background
+
+logger = logging.getLogger(__name__)
+
+# Сколько задач воркер обрабатывает одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "2"))
+# Пауза между опросами пустой очереди (сек)
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))
+
+
+# Обработки запросов, идущие в этом процессе: {request_id: задача}
+_processing: Dict[int, asyncio.Task] = {}
+
+
+def cancel_local(request_id: int) -> bool:
+    """Сразу прервать обработку запроса, если она идёт в этом процессе"""
+    task = _processing.get(request_id)
+    if task is None or task.done():
+        return False
+    task.cancel()
+    return True
+
+
+class Worker:
+    """Цикл воркера: забирает задачи, продлевает их аренду и возвращает потерянные в очередь"""
+
+    def __init__(self, worker_id: Optional[str] = None, concurrency: int = WORKER_CONCURRENCY):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.concurrency = concurrency
+        self.running: Dict[int, asyncio.Task] = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        """Перестать брать новые задачи; начатые дорабатываются"""
+        self._stopping.set()
+
+    async def run(self):
+        logger.info("Воркер %s запущен (задач одновременно: %s)", self.worker_id, self.concurrency)
+        while not self._stopping.is_set():
+            try:
+                await asyncio.to_thread(requeue_expired_jobs)
+                job = None
+                if len(self.running) < self.concurrency:
+                    job = await asyncio.to_thread(claim_job, self.worker_id)
+                if job is not None:
+                    task = asyncio.create_task(self._execute(job))
+                    self.running[job["id"]] = task
+                    task.add_done_callback(lambda _, job_id=job["id"]: self.running.pop(job_id, None))
+                    continue
+            except Exception as e:
+                logger.exception("Ошибка цикла воркера: %s", e)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+        logger.info("Воркер %s остановлен", self.worker_id)
+
+    async def _execute(self, job: dict):
+        job_id = job["id"]
+        logger.info("Задача %s (запрос %s), попытка %s", job_id, job["request_id"], job["attempts"])
+        processing = asyncio.create_task(process_in_background(job["request_id"], **job["payload"]))
+        _processing[job["request_id"]] = processing
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, processing))
+        error = None
+        try:
+            await processing
+        except asyncio.CancelledError:
+            # Задачу отменил пользователь или забрал другой воркер — итог уже зафиксирован
+            logger.warning("Задача %s прервана", job_id)
+            return
+        except Exception as e:
+            error = str(e)
+            logger.exception("Задача %s завершилась ошибкой", job_id)
+        finally:
+            heartbeat.cancel()
+            if _processing.get(job["request_id"]) is processing:
+                del _processing[job["request_id"]]
+        await asyncio.to_thread(finish_job, job_id, self.worker_id, error)
+
+    async def _heartbeat(self, job_id: int, processing: asyncio.Task):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                owned = await asyncio.to_thread(heartbeat_job, job_id, self.worker_id)
+            except Exception as e:
+                logger.warning("Heartbeat задачи %s не удался: %s", job_id, e)
+                continue
+            if not owned:
+                processing.cancel()
+                return
+
+
+async def main():
+    init_db()
+    worker = Worker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        await close_async_client()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main())
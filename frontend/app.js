@@ -1,6 +1,7 @@
 let accessToken = null;
 let isAdmin = false;
 let uploadedFiles = [];
+let currentRequestId = null;
 const API_BASE = '/api';
 
 document.addEventListener('DOMContentLoaded', () => {
@@ -42,6 +43,7 @@ function setupEventListeners() {
         document.getElementById('file-input').value = '';
     });
     document.getElementById('process-btn').addEventListener('click', handleProcess);
+    document.getElementById('cancel-btn').addEventListener('click', cancelProcessing);
     const adminLink = document.getElementById('admin-link');
     if (adminLink) adminLink.addEventListener('click', showAdminScreen);
     document.getElementById('back-to-main').addEventListener('click', showMainScreen);
@@ -149,6 +151,7 @@ async function handleProcess() {
     formData.append('requested_outputs', JSON.stringify(outputs));
     const comment = document.getElementById('user-comment').value;
     if (comment) formData.append('user_comment', comment);
+    if (document.getElementById('bypass-cache').checked) formData.append('bypass_cache', 'true');
 
     document.getElementById('process-btn').disabled = true;
     document.getElementById('progress-container').style.display = 'block';
@@ -173,40 +176,15 @@ async function handleProcess() {
         const requestId = data.request_id;
         document.getElementById('status-message').innerHTML = '<div>⏳ Обработка документов...</div>';
 
-        // Поллинг статуса каждые 3 секунды
-        let attempts = 0;
-        const poll = setInterval(async () => {
-            attempts++;
-            if (attempts > 100) {
-                clearInterval(poll);
-                document.getElementById('status-message').innerHTML = '<div class="error">Таймаут обработки</div>';
-                document.getElementById('process-btn').disabled = false;
-                return;
-            }
-            try {
-                const statusRes = await fetch(`${API_BASE}/tasks/status/${requestId}`, {
-                    headers: { 'Authorization': `Bearer ${accessToken}` }
-                });
-                const statusData = await statusRes.json();
-                updateProgressBar(Math.min(10 + attempts * 3, 90));
-
-                if (statusData.status === 'success') {
-                    clearInterval(poll);
-                    updateProgressBar(100);
-                    displayResults(statusData.output_files);
-                    loadHistory();
-                    uploadedFiles = [];
-                    updateFileList();
-                    document.getElementById('file-input').value = '';
-                    document.getElementById('user-comment').value = '';
-                    document.getElementById('process-btn').disabled = false;
-                } else if (statusData.status === 'error') {
-                    clearInterval(poll);
-                    document.getElementById('status-message').innerHTML = `<div class="error">Ошибка: ${statusData.error_message}</div>`;
-                    document.getElementById('process-btn').disabled = false;
-                }
-            } catch(e) { console.error('Ошибка поллинга:', e); }
-        }, 3000);
+        updateProgressBar(10);
+        currentRequestId = requestId;
+        document.getElementById('cancel-btn').style.display = 'inline-block';
+        try {
+            await watchRequest(requestId);
+        } finally {
+            currentRequestId = null;
+            document.getElementById('cancel-btn').style.display = 'none';
+        }
 
     } catch (error) {
         document.getElementById('status-message').innerHTML = `<div class="error">Ошибка: ${error.message}</div>`;
@@ -214,6 +192,97 @@ async function handleProcess() {
     }
 }
 
+// ==================== ХОД ОБРАБОТКИ (SSE) ====================
+// Поток событий читается через fetch, а не EventSource: нужен заголовок Authorization
+async function watchRequest(requestId) {
+    const progress = { total: 0, done: 0 };
+    for (let reconnects = 0; reconnects < 20; reconnects++) {
+        try {
+            const response = await fetch(`${API_BASE}/tasks/${requestId}/events`, {
+                headers: { 'Authorization': `Bearer ${accessToken}` }
+            });
+            if (!response.ok) throw new Error(`Ошибка сервера (${response.status})`);
+            const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += value;
+                let sep;
+                while ((sep = buffer.indexOf('\n\n')) >= 0) {
+                    const event = parseServerEvent(buffer.slice(0, sep));
+                    buffer = buffer.slice(sep + 2);
+                    if (event && handleProcessingEvent(event.type, event.data, progress)) return;
+                }
+            }
+        } catch(e) { console.error('Ошибка потока событий:', e); }
+        // Соединение оборвалось — переподключаемся: сервер сразу пришлёт текущее состояние
+        await new Promise(resolve => setTimeout(resolve, 3000));
+    }
+    document.getElementById('status-message').innerHTML = '<div class="error">Соединение с сервером потеряно</div>';
+    document.getElementById('process-btn').disabled = false;
+}
+
+async function cancelProcessing() {
+    if (!currentRequestId || !confirm('Отменить обработку?')) return;
+    document.getElementById('cancel-btn').disabled = true;
+    try {
+        // Итог (status: cancelled) придёт в поток событий
+        const response = await fetch(`${API_BASE}/tasks/${currentRequestId}/cancel`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${accessToken}` }
+        });
+        if (!response.ok && response.status !== 409) alert('Не удалось отменить обработку');
+    } catch(e) { alert('Ошибка: ' + e.message); }
+    document.getElementById('cancel-btn').disabled = false;
+}
+
+function parseServerEvent(block) {
+    let type = 'message';
+    const data = [];
+    block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) type = line.slice(6).trim();
+        else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+    });
+    if (!data.length) return null;  // комментарий-пинг
+    return { type, data: JSON.parse(data.join('\n')) };
+}
+
+// Возвращает true, когда обработка завершена
+function handleProcessingEvent(type, data, progress) {
+    if (type === 'started') {
+        progress.total = data.stages.length + data.completed.length;
+        progress.done = data.completed.length;
+    } else if (type === 'stage') {
+        progress.done++;
+    } else if (type === 'state' || type === 'progress') {
+        const current = type === 'state' ? data.progress : data;
+        if (current && current.items) {
+            const stageName = current.stage === 'estimate' ? 'Смета' : 'Перечень';
+            document.getElementById('status-message').innerHTML =
+                `<div>⏳ ${stageName}: получено позиций — ${current.items}</div>`;
+        }
+    } else if (type === 'done') {
+        if (data.status === 'success') {
+            updateProgressBar(100);
+            displayResults(data.output_files);
+            loadHistory();
+            uploadedFiles = [];
+            updateFileList();
+            document.getElementById('file-input').value = '';
+            document.getElementById('user-comment').value = '';
+        } else if (data.status === 'cancelled') {
+            document.getElementById('status-message').innerHTML = '<div class="error">Обработка отменена</div>';
+        } else {
+            document.getElementById('status-message').innerHTML = `<div class="error">Ошибка: ${data.error_message}</div>`;
+        }
+        document.getElementById('process-btn').disabled = false;
+        return true;
+    }
+    if (progress.total) updateProgressBar(Math.min(10 + Math.round(85 * progress.done / progress.total), 95));
+    return false;
+}
+
 function updateProgressBar(percent) {
     document.getElementById('progress-fill').style.width = percent + '%';
     const currentStep = Math.ceil((percent / 100) * 4);
@@ -274,7 +343,8 @@ function displayHistory(history) {
         const date = new Date(req.created_at);
         const dateStr = date.toLocaleDateString('ru-RU') + ' ' + date.toLocaleTimeString('ru-RU');
         const statusClass = req.status === 'success' ? 'status-success' : (req.status === 'processing' ? '' : 'status-error');
-        const statusText = req.status === 'success' ? 'Успешно' : (req.status === 'processing' ? '⏳ Обработка' : 'Ошибка');
+        const statusText = req.status === 'success' ? 'Успешно'
+            : (req.status === 'processing' ? '⏳ Обработка' : (req.status === 'cancelled' ? 'Отменено' : 'Ошибка'));
         const filesHtml = req.output_files ? Object.values(req.output_files).map(f =>
             `<button class="btn btn-success btn-small" onclick="downloadFile('${f.name}')">📥 ${f.name}</button>`
         ).join('') : '';
@@ -302,6 +372,8 @@ async function loadAdminStats() {
         document.getElementById('successful-requests').textContent = data.successful;
         document.getElementById('failed-requests').textContent = data.failed;
         document.getElementById('success-rate').textContent = data.success_rate + '%';
+        const parseCache = data.parse_cache || {};
+        document.getElementById('parse-cache-hit-rate').textContent = parseCache.enabled ? parseCache.hit_rate + '%' : '-';
     } catch (error) { console.error('Ошибка загрузки статистики:', error); }
 }
 
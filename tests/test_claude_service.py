@@ -0,0 +1,183 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import rate_limiter
+from backend.services.claude_service import CLAUDE_CACHE_MIN_TOKENS, ClaudeService
+from backend.services.pipeline import _pricelist_candidates, _pricelist_head
+from backend.services.pricelist_store import Pricelist, parse_price_rows
+
+
+class FakeStream:
+    """Потоковый ответ messages.stream: фрагменты текста и, при необходимости, обрыв"""
+
+    def __init__(self, chunks, error=None, stop_reason="end_turn"):
+        self.chunks = chunks
+        self.error = error
+        self.stop_reason = stop_reason
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    def text_stream(self):
+        return self._iter()
+
+    async def _iter(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error:
+            raise self.error
+
+    async def get_final_message(self):
+        return SimpleNamespace(
+            content=[SimpleNamespace(text="".join(self.chunks))],
+            stop_reason=self.stop_reason,
+            usage=SimpleNamespace(input_tokens=10, output_tokens=10,
+                                  cache_creation_input_tokens=0, cache_read_input_tokens=0),
+        )
+
+
+class FakeClient:
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.calls = []
+        self.messages = self
+
+    def stream(self, **params):
+        self.calls.append(params)
+        return self.streams.pop(0)
+
+
+@pytest.fixture
+def make_service(monkeypatch):
+    # Обрыв соединения повторяется без задержки
+    monkeypatch.setattr(rate_limiter, "_is_retryable", lambda error: isinstance(error, ConnectionResetError))
+    monkeypatch.setattr(rate_limiter.ClaudeRateGovernor, "_backoff", lambda self, attempt, retry_after: 0)
+
+    def make(streams):
+        client = FakeClient(streams)
+        monkeypatch.setattr(ClaudeService, "client", property(lambda self: client))
+        service = ClaudeService(use_cache=False)
+        service.cache = None
+        return service, client
+
+    return make
+
+
+def run_stream(service):
+    received = []
+    response, items = asyncio.run(service.stream_json_array("промпт", on_item=received.append))
+    return response, items, received
+
+
+def test_retry_after_dropped_partial_stream(make_service):
+    # Первая попытка обрывается внутри первого элемента — повтор разбирается с чистого листа
+    service, client = make_service([
+        FakeStream(['Перечень: [{"name": "Клад', 'ка", "unit": "м'], error=ConnectionResetError("reset")),
+        FakeStream(['Перечень: [{"name": "Кладка", "unit": "м²"}, ', '{"name": "Штукатурка"}]']),
+    ])
+    response, items, received = run_stream(service)
+    assert items == [{"name": "Кладка", "unit": "м²"}, {"name": "Штукатурка"}]
+    assert received == items
+    assert len(client.calls) == 2
+
+
+def test_bracket_in_preamble(make_service):
+    service, client = make_service([
+        FakeStream(['Перечень [см. ', 'ниже]:\n[{"name": "Кладка"}, ', '{"name": "Штукатурка"}]']),
+    ])
+    response, items, received = run_stream(service)
+    assert items == [{"name": "Кладка"}, {"name": "Штукатурка"}]
+    assert received == items
+
+
+def test_no_retry_after_items_were_emitted(make_service):
+    service, client = make_service([
+        FakeStream(['[{"a": 1}, {"b"'], error=ConnectionResetError("reset")),
+        FakeStream(['[{"a": 1}, {"b": 2}]']),
+    ])
+    with pytest.raises(Exception, match="Ошибка при запросе к Claude"):
+        run_stream(service)
+    assert len(client.calls) == 1
+
+
+def test_truncated_response_is_continued(make_service):
+    service, client = make_service([
+        FakeStream(['[{"a": 1}, {"b"'], stop_reason="max_tokens"),
+        FakeStream([': 2}]']),
+    ])
+    response, items, received = run_stream(service)
+    assert items == [{"a": 1}, {"b": 2}]
+    assert received == items
+    # Продолжение запрашивается с уже полученным текстом в начале ответа ассистента
+    assert client.calls[1]["messages"][-1] == {"role": "assistant", "content": '[{"a": 1}, {"b"'}
+
+
+def test_retry_of_continuation_restarts_from_prefill(make_service):
+    service, client = make_service([
+        FakeStream(['[{"a": 1}, {"b"'], stop_reason="max_tokens"),
+        FakeStream([': 2'], error=ConnectionResetError("reset")),
+        FakeStream([': 2}, {"c": 3}]']),
+    ])
+    response, items, received = run_stream(service)
+    assert items == [{"a": 1}, {"b": 2}, {"c": 3}]
+    assert received == items
+
+
+def test_incomplete_array_after_last_continuation_raises(make_service):
+    service, client = make_service([
+        FakeStream(['[{"a": 1}, {"b"'], stop_reason="max_tokens"),
+        FakeStream([': 2}, {"c"'], stop_reason="max_tokens"),
+        FakeStream([': 3'], stop_reason="max_tokens"),
+    ])
+    with pytest.raises(Exception, match="ответ обрезан"):
+        run_stream(service)
+
+
+def make_pricelist(kind, count):
+    price_columns, rows = parse_price_rows(
+        [("Наименование", "Ед. изм.", "Цена")]
+        + [(f"Позиция прайса {kind} номер {i}", "шт", 100 + i) for i in range(count)]
+    )
+    pricelist = Pricelist(kind=kind, path=None, mtime=0, size=0, price_columns=price_columns)
+    for row in rows:
+        pricelist.add(row)
+    pricelist.normalize_units()
+    return pricelist
+
+
+def test_estimate_prompt_caches_instructions_and_pricelists(make_service):
+    service, client = make_service([FakeStream(['[{"name": "Кладка"}]'])])
+    works, materials = make_pricelist("works", 3000), make_pricelist("materials", 3000)
+    items = [{"type": "Материал", "name": "Позиция прайса materials номер 2999", "unit": "шт"}]
+    (works_head, works_skip), (materials_head, materials_skip) = _pricelist_head(works), _pricelist_head(materials)
+    prompt = service.create_estimate_prompt(
+        items,
+        _pricelist_candidates(works, items, works_skip),
+        _pricelist_candidates(materials, items, materials_skip),
+        works_head,
+        materials_head,
+    )
+    asyncio.run(service.stream_json_array(prompt))
+
+    system = client.calls[0]["system"]
+    assert system[-1]["cache_control"] == {"type": "ephemeral"}
+    assert "Позиция прайса works номер 0 " in system[-1]["text"]
+    # Строки за пределами начала прайса подбираются под перечень в переменной части
+    assert "номер 2999 " in client.calls[0]["messages"][0]["content"]
+    assert "номер 2999 " not in system[-1]["text"]
+    # Префикс одинаков для разных перечней
+    other = service.create_estimate_prompt([], "", "", works_head, materials_head)
+    assert other.system == prompt.system
+
+
+def test_short_prefix_is_not_marked_for_caching(make_service):
+    service, client = make_service([])
+    prompt = service.create_list_prompt({"ТЗ.pdf": "текст"})
+    assert all("cache_control" not in block for block in prompt.system)
+    assert rate_limiter.estimate_tokens(prompt.system[0]["text"]) < CLAUDE_CACHE_MIN_TOKENS
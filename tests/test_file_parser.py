@@ -0,0 +1,108 @@
+import io
+import json
+import zipfile
+from datetime import datetime
+
+import openpyxl
+
+from backend.services import file_parser
+from backend.services.file_parser import FileParser
+from backend.services.parse_cache import ParseCache
+
+GSN_XML = """<?xml version="1.0" encoding="utf-8"?>
+<Document xmlns="http://www.grandsmeta.ru/schema">
+  <Properties Description="Локальная смета" />
+  <Chapters>
+    <Chapter Caption="Раздел 1. Демонтаж">
+      <Position Code="ФЕР46-04-001-01" Caption="Разборка кирпичных стен" Units="м3">
+        <Quantity Result="12,5" />
+        <PriceCurrent Total="1 234,50" />
+        <Resources>
+          <Position Caption="Ресурс внутри позиции" Units="шт" Quantity="1" />
+        </Resources>
+      </Position>
+    </Chapter>
+    <Chapter Caption="Раздел 2. Полы">
+      <Position Шифр="ФЕР11-01-011-01" Наименование="Устройство стяжек" ЕдИзм="100 м2" Количество="0.48">
+        <Цена>5600</Цена>
+      </Position>
+    </Chapter>
+  </Chapters>
+</Document>
+"""
+
+
+def test_iter_xml_records_positions():
+    records = list(FileParser.iter_xml_records(io.BytesIO(GSN_XML.encode("utf-8"))))
+    positions = [record for kind, record in records if kind == "position"]
+    assert positions == [
+        {
+            "section": "Раздел 1. Демонтаж",
+            "code": "ФЕР46-04-001-01",
+            "name": "Разборка кирпичных стен",
+            "unit": "м³",
+            "quantity": 12.5,
+            "price": 1234.5,
+        },
+        {
+            "section": "Раздел 2. Полы",
+            "code": "ФЕР11-01-011-01",
+            "name": "Устройство стяжек",
+            "unit": "100 м²",
+            "quantity": 0.48,
+            "price": 5600.0,
+        },
+    ]
+    # Вложенные в позицию ресурсы не становятся отдельными позициями
+    assert all(record.get("name") != "Ресурс внутри позиции" for _, record in records)
+
+
+def test_iter_xml_records_max_rows():
+    records = list(FileParser.iter_xml_records(io.BytesIO(GSN_XML.encode("utf-8")), max_rows=2))
+    assert len(records) == 2
+
+
+def test_parse_xml_plain_records():
+    xml = b"<root><item id='1'>A</item><item id='2'/><empty/></root>"
+    assert FileParser.parse_xml(io.BytesIO(xml)) == {
+        "records": [
+            {"path": "root/item", "id": "1", "text": "A"},
+            {"path": "root/item", "id": "2"},
+        ]
+    }
+
+
+def test_parse_gsn_reads_main_member(tmp_path):
+    path = tmp_path / "smeta.gsn"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("Settings/settings.xml", "<Settings><Option Name='x' /></Settings>" * 50)
+        archive.writestr("Data/main.xml", GSN_XML)
+    result = FileParser.parse_gsn(str(path))
+    assert [position["name"] for position in result["positions"]] == [
+        "Разборка кирпичных стен",
+        "Устройство стяжек",
+    ]
+
+
+def test_cached_and_fresh_parse_are_identical(tmp_path, monkeypatch):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(["Наименование", "Дата", "Количество"])
+    sheet.append(["Кладка", datetime(2024, 3, 1, 12, 30), 12.5])
+    sheet.append(["Штукатурка", None, 3])
+    path = tmp_path / "Перечень.xlsx"
+    workbook.save(path)
+
+    monkeypatch.setattr(file_parser, "get_parse_cache", lambda: None)
+    uncached = FileParser.parse_file(str(path))
+
+    cache = ParseCache(tmp_path / "cache")
+    monkeypatch.setattr(file_parser, "get_parse_cache", lambda: cache)
+    key, fresh = FileParser.parse_file_with_key(str(path))
+    cached_key, cached = FileParser.parse_file_with_key(str(path))
+
+    assert cached_key == key
+    assert cache.stats()["hits"] == 1
+    assert fresh == cached == uncached
+    assert fresh["sheets"]["Sheet"]["rows"][0] == ["Кладка", "2024-03-01 12:30:00", 12.5]
+    json.dumps(fresh)
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from backend.services.json_stream import JSONArrayStream, decode_json_text
+
+ITEMS = [
+    {"name": "Кладка [стен], \"М150\"", "unit": "м²", "quantity": 12.5},
+    {"name": "Путь C:\\\\tmp\\\\", "note": "строка с } и ] внутри"},
+    "скаляр-строка с \\\" кавычкой",
+    42,
+    None,
+    [1, [2, 3]],
+]
+RESPONSE = "Вот перечень:\n" + json.dumps(ITEMS, ensure_ascii=False, indent=2) + "\nГотово."
+
+
+def feed_chunks(chunks):
+    parser = JSONArrayStream()
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(chunk))
+    return parser, items
+
+
+def test_whole_response():
+    parser, items = feed_chunks([RESPONSE])
+    assert items == ITEMS
+    assert parser.started and parser.done
+    assert parser.items_count == len(ITEMS)
+
+
+@pytest.mark.parametrize("split", range(1, len(RESPONSE)))
+def test_split_at_any_position(split):
+    # Граница фрагментов может прийтись на середину строки, escape-последовательности или числа
+    parser, items = feed_chunks([RESPONSE[:split], RESPONSE[split:]])
+    assert items == ITEMS
+    assert parser.done
+
+
+def test_char_by_char():
+    parser, items = feed_chunks(list(RESPONSE))
+    assert items == ITEMS
+    assert parser.done
+
+
+def test_escaped_backslash_before_closing_quote():
+    # "\\" закрывает строку: экранирован обратный слэш, а не кавычка
+    text = '["a\\\\", "b"]'
+    for split in range(1, len(text)):
+        _, items = feed_chunks([text[:split], text[split:]])
+        assert items == ["a\\", "b"]
+
+
+def test_items_are_emitted_as_they_close():
+    parser = JSONArrayStream()
+    assert parser.feed('[{"a": 1}, {"b"') == [{"a": 1}]
+    assert not parser.done
+    assert parser.feed(': 2}]') == [{"b": 2}]
+    assert parser.done
+
+
+PREAMBLE_RESPONSE = 'Перечень [см. ниже]:\n[{"a": 1}, {"b": [2]}]'
+
+
+@pytest.mark.parametrize("split", range(1, len(PREAMBLE_RESPONSE)))
+def test_bracket_in_preamble_is_skipped(split):
+    # Скобка из преамбулы не массив: разбор продолжается со следующей "["
+    parser, items = feed_chunks([PREAMBLE_RESPONSE[:split], PREAMBLE_RESPONSE[split:]])
+    assert items == [{"a": 1}, {"b": [2]}]
+    assert parser.done
+
+
+def test_unclosed_bracket_in_preamble_is_skipped():
+    parser, items = feed_chunks(list('Позиции [ниже\n[{"a": 1}, 2]'))
+    assert items == [{"a": 1}, 2]
+    assert parser.done
+
+
+def test_bracket_in_preamble_without_array():
+    parser, items = feed_chunks(["Перечень [см. ниже] не составлен."])
+    assert items == []
+    assert not parser.started
+
+
+def test_invalid_item_after_first_is_an_error():
+    parser = JSONArrayStream()
+    assert parser.feed('[{"a": 1}, ') == [{"a": 1}]
+    with pytest.raises(json.JSONDecodeError):
+        parser.feed("см. ниже]")
+
+
+def test_no_array_in_response():
+    parser, items = feed_chunks(["Не могу ответить.", " Попробуйте позже."])
+    assert items == []
+    assert not parser.started
+
+
+def test_text_after_array_is_ignored():
+    parser = JSONArrayStream()
+    assert parser.feed("[1, 2]") == [1, 2]
+    assert parser.feed(" [3]") == []
+    assert parser.items_count == 2
+
+
+def test_copy_is_independent():
+    parser = JSONArrayStream()
+    parser.feed('[{"a": 1}, {"b": "x')
+    clone = parser.copy()
+    assert parser.feed('yz"}]') == [{"b": "xyz"}]
+    # Копия продолжает с момента копирования и не видит того, что получил оригинал
+    assert clone.feed('"}]') == [{"b": "x"}]
+    assert clone.done
+
+
+def test_decode_truncated_array():
+    value, complete = decode_json_text('Ответ: [{"a": 1}, {"b": 2}, {"c"')
+    assert value == [{"a": 1}, {"b": 2}]
+    assert complete is False
+
+
+def test_decode_skips_bracket_in_preamble():
+    value, complete = decode_json_text('[см. ниже]\n{"summary": "ok"}')
+    assert value == {"summary": "ok"}
+    assert complete is True
@@ -0,0 +1,65 @@
+from backend.services.price_matcher import PriceMatcher, merge_estimate
+from backend.services.pricelist_store import Pricelist, parse_price_rows
+
+
+def make_pricelist(kind, rows):
+    price_columns, parsed = parse_price_rows([("Наименование", "Ед. изм.", "Цена"), *rows])
+    pricelist = Pricelist(kind=kind, path=None, mtime=0, size=0, price_columns=price_columns)
+    for row in parsed:
+        pricelist.add(row)
+    pricelist.normalize_units()
+    return pricelist
+
+
+MATERIALS = make_pricelist("materials", [
+    ("Кабель ВВГнг(А)-LS 3х1.5 мм² 0,66 кВ", "м", 80),
+    ("Труба полипропиленовая PN20 Ø25", "м", 120),
+    ("Арматура А500С", "т", 65000),
+    ("Грунтовка", "", 300),
+])
+
+
+def material(name, unit):
+    return {"type": "Материал", "name": name, "unit": unit, "quantity": 10}
+
+
+def test_exact_name_is_priced_locally():
+    matcher = PriceMatcher({"materials": MATERIALS})
+    estimate_item = matcher.match(material("кабель ВВГнг(А)-LS 3х1.5 мм² 0,66 кВ", "м."))
+    assert estimate_item["price_material_per_unit"] == 80.0
+    assert estimate_item["price_work_per_unit"] is None
+    assert estimate_item["unit"] == "м"
+    assert "точное совпадение" in estimate_item["note"]
+
+
+def test_unit_conversion():
+    matcher = PriceMatcher({"materials": MATERIALS})
+    estimate_item = matcher.match(material("Арматура А500С", "кг"))
+    assert estimate_item["price_material_per_unit"] == 65.0
+    assert "пересчёт из т" in estimate_item["note"]
+
+
+def test_names_differing_in_size_go_to_llm():
+    matcher = PriceMatcher({"materials": MATERIALS})
+    assert matcher.match(material("Кабель ВВГнг(А)-LS 3х2.5 мм² 0,66 кВ", "м")) is None
+    assert matcher.match(material("Труба полипропиленовая PN20 Ø32", "м")) is None
+
+
+def test_missing_or_incompatible_unit_goes_to_llm():
+    matcher = PriceMatcher({"materials": MATERIALS})
+    assert matcher.match(material("Арматура А500С", "")) is None
+    assert matcher.match(material("Арматура А500С", "м²")) is None
+    assert matcher.match(material("Грунтовка", "л")) is None
+
+
+def test_split_and_merge_keep_order():
+    matcher = PriceMatcher({"materials": MATERIALS})
+    items = [
+        material("Арматура А500С", "т"),
+        material("Кабель ВВГнг(А)-LS 3х2.5 мм² 0,66 кВ", "м"),
+    ]
+    matched, unresolved = matcher.split(items)
+    assert list(matched) == [0]
+    assert unresolved == [1]
+    merged = merge_estimate(len(items), matched, unresolved, [{"name": "от Claude"}])
+    assert [item["name"] for item in merged] == ["Арматура А500С", "от Claude"]
@@ -0,0 +1,82 @@
+import pytest
+
+from backend.services.units import (
+    conversion_factor, convert, normalize_unit, normalize_units, same_unit, unit_dimension
+)
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("м2", "м²"),
+    ("кв.м", "м²"),
+    ("М 2", "м²"),
+    ("м^2", "м²"),
+    ("куб.м", "м³"),
+    ("м3", "м³"),
+    ("п.м.", "м.п."),
+    ("пог. м", "м.п."),
+    ("шт", "шт."),
+    ("Штук", "шт."),
+    ("тн", "т"),
+    ("КГ", "кг"),
+    ("100 м2", "100 м²"),
+    ("компл", "компл."),
+    ("маш.-час", "маш.-ч"),
+    ("тыс. шт", "1000 шт."),
+])
+def test_normalize_known_spellings(raw, expected):
+    assert normalize_unit(raw) == expected
+
+
+@pytest.mark.parametrize("raw", [None, "", "  ", "nan", "NaN"])
+def test_normalize_empty(raw):
+    assert normalize_unit(raw) == ""
+
+
+def test_unknown_unit_keeps_text():
+    assert normalize_unit("  рулон   10 м ") == "рулон 10 м"
+
+
+def test_normalize_units_batch():
+    assert normalize_units(["м2", None, "кв.м", "шт"]) == ["м²", "", "м²", "шт."]
+    assert normalize_units([]) == []
+
+
+@pytest.mark.parametrize("source, target, factor", [
+    ("т", "кг", 1000),
+    ("кг", "т", 0.001),
+    ("100 м²", "м²", 100),
+    ("м²", "кв.м", 1),
+    ("м", "мм", 1000),
+    ("м.п.", "м", 1),
+    ("л", "м³", 0.001),
+    ("1000 шт.", "шт", 1000),
+    ("смена", "ч", 8),
+])
+def test_conversion_factor(source, target, factor):
+    assert conversion_factor(source, target) == pytest.approx(factor)
+
+
+@pytest.mark.parametrize("source, target", [
+    ("м²", "м³"),
+    ("кг", "шт"),
+    ("рулон 10 м", "м"),
+    ("", "кг"),
+    ("баллон", "упак."),
+    ("рул.", "меш."),
+    ("упаковка", "шт"),
+])
+def test_incompatible_units(source, target):
+    assert conversion_factor(source, target) is None
+
+
+def test_convert():
+    assert convert(2.5, "т", "кг") == pytest.approx(2500)
+    assert convert(None, "т", "кг") is None
+    assert convert(1, "кг", "м") is None
+
+
+def test_dimension_and_same_unit():
+    assert unit_dimension("кв.м") == "area"
+    assert unit_dimension("рулон 10 м") is None
+    assert same_unit("м2", "кв. м")
+    assert not same_unit("м2", "м3")
@@ -0,0 +1,84 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from backend import models  # noqa: F401 — регистрирует таблицы в Base.metadata
+from backend.database import Base
+from backend.routes import tasks
+from backend.services import uploads
+
+
+@pytest.fixture
+def uploads_dir(tmp_path, monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(uploads, "SessionLocal", sessionmaker(bind=engine))
+    monkeypatch.setattr(uploads, "UPLOADS_DIR", tmp_path)
+    monkeypatch.setattr(uploads, "UPLOAD_HOLDS_DIR", tmp_path / ".holds")
+    return tmp_path
+
+
+def leftovers(directory):
+    return sorted(
+        path.relative_to(directory).as_posix()
+        for path in directory.rglob("*")
+        if path.is_file() and path.name != ".lock"
+    )
+
+
+class BrokenFile(io.BytesIO):
+    def read(self, size=-1):
+        raise OSError("соединение оборвано")
+
+
+def upload(name, content):
+    return UploadFile(file=io.BytesIO(content), filename=name)
+
+
+def test_store_upload_holds_file(uploads_dir):
+    stored = uploads.store_upload(io.BytesIO(b"data"), "ТЗ.PDF")
+    assert stored["path"].endswith(".pdf")
+    uploads.release_uploads([stored["path"]])
+    # Пока задача не поставлена, файл удержан
+    assert leftovers(uploads_dir)
+    uploads.unhold_uploads([stored])
+    uploads.release_uploads([stored["path"]])
+    assert leftovers(uploads_dir) == []
+
+
+def test_too_large_upload_is_discarded(uploads_dir):
+    files = [upload("a.pdf", b"a" * 10), upload("b.pdf", b"b" * (2 * 1024 * 1024))]
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(tasks._store_files(files, max_total_mb=1))
+    assert error.value.status_code == 413
+    assert leftovers(uploads_dir) == []
+
+
+def test_failed_copy_is_discarded(uploads_dir):
+    files = [upload("a.pdf", b"a"), UploadFile(file=BrokenFile(), filename="b.pdf")]
+    with pytest.raises(OSError):
+        asyncio.run(tasks._store_files(files, max_total_mb=1))
+    assert leftovers(uploads_dir) == []
+
+
+def test_failed_submit_is_discarded(uploads_dir, monkeypatch):
+    async def failing_submit(*args, **kwargs):
+        raise RuntimeError("БД недоступна")
+
+    monkeypatch.setattr(tasks, "_submit_request", failing_submit)
+    with pytest.raises(RuntimeError):
+        asyncio.run(tasks.process_request(
+            files=[upload("a.pdf", b"a"), upload("b.xlsx", b"b")],
+            input_type="project",
+            requested_outputs='["list"]',
+            user_comment=None,
+            bypass_cache=False,
+            current_user={},
+            db=None,
+        ))
+    assert leftovers(uploads_dir) == []